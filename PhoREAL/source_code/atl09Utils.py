@@ -30,7 +30,6 @@ import numpy as np
 import matplotlib.pyplot as plt
 from scipy import signal
 from scipy.stats import skew, kurtosis, shapiro
-from tqdm import tqdm
 
 
 def get_beam_feature(atl09):
@@ -177,6 +176,184 @@ def smooth(x, window_len=11, window='hanning'):
     return y
 
 
+def smooth_rows(x, window_len=11, window='hanning'):
+    """
+    Row-wise version of smooth for a 2-D array (same padding and kernel)
+    """
+
+    if window_len < 3:
+        return x
+
+    if window == 'flat':  # moving average
+        w = np.ones(window_len, 'd')
+    else:
+        w = eval('np.' + window + '(window_len)')
+    w = w / w.sum()
+
+    s = np.concatenate([x[:, window_len - 1:0:-1], x,
+                        x[:, -2:-window_len - 1:-1]], axis=1)
+
+    n_out = s.shape[1] - window_len + 1
+    y = np.zeros((x.shape[0], n_out))
+    for k in range(window_len):
+        y += w[window_len - 1 - k] * s[:, k:k + n_out]
+    return y
+
+
+def get_slice_bounds(start, stop, length):
+    """
+    Vectorized slice.indices: bounds of x[start:stop] for len(x) == length
+    """
+
+    start = np.where(start < 0, start + length, start)
+    stop = np.where(stop < 0, stop + length, stop)
+    start = np.clip(start, 0, length)
+    stop = np.clip(stop, start, length)
+    return start, stop
+
+
+def get_dem_error_stats(atl09):
+    """
+    Granule-level DEM error (dem_h - surface_height) used for the DEM cutoff
+    """
+
+    surf_mask = atl09.df.surface_bin < 800
+    error_h = np.asarray(atl09.df.dem_h[surf_mask] -
+                         atl09.df.surface_height[surf_mask], dtype=float)
+    if len(error_h) == 0:
+        return None
+    stdev = np.std(error_h)
+    dem_below_bins = np.around((error_h.mean() - 2 * stdev) / 30)
+    return dem_below_bins
+
+
+def get_cab_cutoff_bin(atl09, idx, cab_i, dem_below_bins,
+                       show_plots=False,
+                       column_search_radius=5,
+                       track_search_radius=5,
+                       window_len=7,
+                       peak_threshold=2e-5):
+    """
+    Surface cutoff bin and removal method for one ATL09 profile
+    """
+
+    surf_removal_method = 0
+
+    # Get surface bin and CAB profile
+    surf_bin_i = atl09.df.loc[idx, 'surface_bin'] - 1
+    lowest_layer_h = min(atl09.df.loc[idx,
+                                      ['layer_bot_' + str(x)
+                                        for x in np.arange(10)]])
+    lowest_layer_bin = np.around((max(atl09.ds_va_bin_h) - lowest_layer_h) / 30) + 2
+
+    if surf_bin_i < 701:
+        # If surface was found by ATL09, confirm location with CAB profile
+
+        # too overzealous with low clouds
+        # surf_bin_check = cab_i.iloc[surf_bin_i - column_search_radius:\
+        #                             surf_bin_i + column_search_radius].idxmax()
+        # cutoff_bin = int(surf_bin_check - 1)  # 30m buffer
+
+        cutoff_bin = int(surf_bin_i - 3)
+        surf_removal_method = 1
+
+        if show_plots:
+            # Visualize
+            plt.figure()
+            plt.title(str(idx) + ', ATL09 Located surface')
+            plt.plot(cab_i)
+            # plt.axvline(surf_bin_check, color='green', label='Found surface')
+            plt.axvline(surf_bin_i, color='blue', label='ATL09 surface')
+            plt.axvline(cutoff_bin, color='red', label='Cutoff point')
+            plt.axvline(surf_bin_i + column_search_radius, color='yellow')
+            plt.axvline(surf_bin_i - column_search_radius, color='yellow')
+            plt.xlim([surf_bin_i - 10, surf_bin_i + 10])
+            plt.legend()
+
+    else:
+        # If ATL09 couldn't find surface
+        # See if ATL09 found the surface for nearby neighbors
+        local_surf_bin = atl09.df.loc[idx - track_search_radius:
+                                      idx + track_search_radius, 'surface_bin'] - 1
+        min_local_bin = local_surf_bin[local_surf_bin < 701].min()
+        max_local_bin = local_surf_bin[local_surf_bin < 701].max()
+        mean_local_bin = local_surf_bin[local_surf_bin < 701].mean()
+
+        pk_idx = []
+        use_dem = np.isnan(mean_local_bin)
+        if not use_dem:
+            # Use neighbors to define window to search for peak in CAB
+            cab_smooth = smooth(cab_i, window_len=window_len)
+            bin_smooth = np.linspace(0, 700 + window_len / 3, 699 + window_len)
+            cab_search = cab_smooth[min_local_bin - column_search_radius:
+                                    max_local_bin + column_search_radius]
+
+            pk_idx, pk_h = signal.find_peaks(cab_search, height=peak_threshold)
+
+            if len(pk_idx) == 1:
+                # IF a peak is found based on CAB, define this as surface
+                peak = np.around(bin_smooth[min_local_bin - column_search_radius + pk_idx - 1]) - 1
+                cutoff_bin = int(peak[0])
+                surf_removal_method = 3
+                if show_plots:
+                    plt.figure()
+                    plt.title(str(idx) + ', Smoothed peak finding')
+                    plt.plot(cab_i, label='CAB')
+                    plt.plot(bin_smooth, cab_smooth, label='Smoothed CAB profile')
+                    plt.axvline(np.around(mean_local_bin), color='cyan', label='Avg nearby surface location')
+                    plt.axvline(cutoff_bin, color='green', label='Cutoff bin')
+                    plt.axvline(min_local_bin - column_search_radius, color='red', label='Search window')
+                    plt.axvline(min_local_bin + column_search_radius, color='red')
+                    plt.axvline(surf_bin_i - column_search_radius, color='red')
+                    plt.axvline(lowest_layer_bin, color='black')
+                    plt.xlim([min([cutoff_bin, lowest_layer_bin, min_local_bin, surf_bin_i]) - 100,
+                              max([cutoff_bin, lowest_layer_bin, min_local_bin, surf_bin_i]) + 100])
+                    plt.legend()
+            else:
+                use_dem = True
+
+        if use_dem:
+            # IF no peaks identified,
+            # OR no singular peak identified
+            # OR no nearby surface detected
+            # Use DEM to estimate surface location
+            # Use 2 sigma difference above DEM for cutoff
+            dem_bin = np.around((max(atl09.ds_va_bin_h) - atl09.df.loc[idx, 'dem_h']) / 30) + 1
+            if dem_below_bins is None:
+                # ATL09 did not find any surface points in this granule
+                cutoff_bin = int(dem_bin)
+            else:
+                bin_2sigma_above_dem = dem_bin + dem_below_bins
+
+                cutoff_bin = int(bin_2sigma_above_dem)
+                surf_removal_method = 4
+
+            if show_plots:
+                plt.figure()
+                plt.title(str(idx) + ', DEM Approach')
+                plt.plot(cab_i, label='CAB')
+                if len(pk_idx) > 1:
+                    found_peaks = np.around(bin_smooth[min_local_bin - column_search_radius + pk_idx - 1])
+                    for pk in found_peaks:
+                        if pk == found_peaks[0]:
+                            plt.axvline(pk, color='cyan', label='Peaks found')
+                        else:
+                            plt.axvline(pk, color='cyan')
+                plt.axvline(lowest_layer_bin, color='black', label='Lowest cloud layer')
+                plt.axvline(dem_bin, label='DEM Surface', color='magenta')
+                plt.axvline(cutoff_bin, label='Cutoff', color='red')
+                plt.xlim([min([cutoff_bin, dem_bin, lowest_layer_bin]) - 30,
+                          max([cutoff_bin, dem_bin, lowest_layer_bin]) + 30])
+                plt.legend()
+
+    if np.abs(lowest_layer_bin - cutoff_bin) < 5:
+        # safety check if clouds are low
+        cutoff_bin = int(lowest_layer_bin + 5)
+        surf_removal_method = 5
+
+    return cutoff_bin, surf_removal_method
+
+
 def get_cab_no_surf(atl09,
                     show_plots=False,
                     idxing=None,
@@ -191,168 +368,124 @@ def get_cab_no_surf(atl09,
     cab_no_surf = pd.DataFrame(np.copy(atl09.cab_prof), index=atl09.df.index)
     cab_no_surf[cab_no_surf > 1e30] = 0
     # Surface estimate algorithm
-    cab = pd.DataFrame(atl09.cab_prof,
-                       index=atl09.df.index)
+    cab = np.array(atl09.cab_prof, dtype=float)
     cab[cab > 1e30] = 0
 
     cutoff_bins = np.full(atl09.df.shape[0], 700)
     surf_removal_method = np.zeros_like(cutoff_bins)
 
+    # Granule-level DEM error stats (same for every profile)
+    dem_below_bins = get_dem_error_stats(atl09)
+
+    kwargs = dict(column_search_radius=column_search_radius,
+                  track_search_radius=track_search_radius,
+                  window_len=window_len,
+                  peak_threshold=peak_threshold)
+
     # Don't accidentally terrorize matplotlib
     if idxing.shape[0] > 20:
         show_plots = False
 
-    for idx in tqdm(idxing):
-        # Get surface bin and CAB profile
-        surf_bin_i = atl09.df.loc[idx, 'surface_bin'] - 1
-        cab_i = cab.loc[idx, :]
-        lowest_layer_h = min(atl09.df.loc[idx,
-                                          ['layer_bot_' + str(x)
-                                            for x in np.arange(10)]])
-        lowest_layer_bin = np.around((max(atl09.ds_va_bin_h) - lowest_layer_h) / 30) + 2
-
-        if surf_bin_i < 701:
-            # If surface was found by ATL09, confirm location with CAB profile
-
-            # too overzealous with low clouds
-            # surf_bin_check = cab_i.iloc[surf_bin_i - column_search_radius:\
-            #                             surf_bin_i + column_search_radius].idxmax()
-            # cutoff_bin = int(surf_bin_check - 1)  # 30m buffer
-
-            cutoff_bin = int(surf_bin_i - 3)
-            surf_removal_method[idx] = 1
-
-            if show_plots:
-                # Visualize
-                plt.figure()
-                plt.title(str(idx) + ', ATL09 Located surface')
-                plt.plot(cab_i)
-                # plt.axvline(surf_bin_check, color='green', label='Found surface')
-                plt.axvline(surf_bin_i, color='blue', label='ATL09 surface')
-                plt.axvline(cutoff_bin, color='red', label='Cutoff point')
-                plt.axvline(surf_bin_i + column_search_radius, color='yellow')
-                plt.axvline(surf_bin_i - column_search_radius, color='yellow')
-                plt.xlim([surf_bin_i - 10, surf_bin_i + 10])
-                plt.legend()
+    rows = np.asarray(idxing)
+    if show_plots:
+        # Few profiles, run per-profile logic so plots can be drawn
+        for idx in rows:
+            cutoff_bins[idx], surf_removal_method[idx] = \
+                get_cab_cutoff_bin(atl09, idx, cab[idx, :], dem_below_bins,
+                                   show_plots=True, **kwargs)
 
+    else:
+        n_bins = cab.shape[1]
+        max_bin_h = max(atl09.ds_va_bin_h)
+        surf_bin = atl09.df.surface_bin.to_numpy() - 1
+        layer_bot = atl09.df.loc[:, ['layer_bot_' + str(x)
+                                     for x in np.arange(10)]].to_numpy()
+        lowest_layer_bin = np.around((max_bin_h - layer_bot.min(axis=1)) / 30) + 2
+        dem_bin = np.around((max_bin_h - atl09.df.dem_h.to_numpy()) / 30) + 1
+
+        # Rolling min/max/mean of nearby surface bins found by ATL09
+        local_surf_bin = pd.Series(np.where(surf_bin < 701, surf_bin, np.nan))
+        local_roll = local_surf_bin.rolling(2 * track_search_radius + 1,
+                                            center=True, min_periods=1)
+        min_local_bin = local_roll.min().to_numpy()[rows]
+        max_local_bin = local_roll.max().to_numpy()[rows]
+
+        # 1) ATL09 found surface
+        cutoff = (surf_bin[rows] - 3).astype(float)
+        method = np.ones(len(rows), dtype=cutoff_bins.dtype)
+        no_surf = surf_bin[rows] >= 701
+
+        # 4) DEM approach (default when ATL09 found no surface)
+        if dem_below_bins is None:
+            cutoff[no_surf] = dem_bin[rows][no_surf]
+            method[no_surf] = 0
         else:
-            # If ATL09 couldn't find surface
-            # See if ATL09 found the surface for nearby neighbors
-            local_surf_bin = atl09.df.loc[idx - track_search_radius:
-                                          idx + track_search_radius, 'surface_bin'] - 1
-            min_local_bin = local_surf_bin[local_surf_bin < 701].min()
-            max_local_bin = local_surf_bin[local_surf_bin < 701].max()
-            mean_local_bin = local_surf_bin[local_surf_bin < 701].mean()
-
-            if np.isnan(mean_local_bin):
-                # IF no peaks identified,
-                # OR no singular peak identified
-                # OR no nearby surface detected
-                # Use DEM to estimate surface location
-                # Check granule-level surface height difference
-                # Use 2 sigma difference above DEM for cutoff
-                # Check DEM for estimated surface location
-                dem_bin = np.around((max(atl09.ds_va_bin_h) - atl09.df.loc[idx, 'dem_h']) / 30) + 1
-                error_h = atl09.df.dem_h[atl09.df.surface_bin < 800] - \
-                    atl09.df.surface_height[atl09.df.surface_bin < 800]
-                if len(error_h) == 0:
-                    # ATL09 did not find any surface points in this granule
-                    cutoff_bin = int(dem_bin)
-                else:
-                    stdev = np.std(error_h)
-                    dem_above_bins = np.around((error_h.mean() + 2 * stdev) / 30)
-                    dem_below_bins = np.around((error_h.mean() - 2 * stdev) / 30)
-
-                    bin_2sigma_above_dem = dem_bin + dem_below_bins
-
-                    cutoff_bin = int(bin_2sigma_above_dem)
-                    surf_removal_method[idx] = 4
+            cutoff[no_surf] = dem_bin[rows][no_surf] + dem_below_bins
+            method[no_surf] = 4
+
+        # 3) Single peak in smoothed CAB near neighbors' surface
+        peak_rows = np.where(no_surf & ~np.isnan(min_local_bin))[0]
+        ambiguous = np.zeros(len(rows), dtype=bool)
+        if len(peak_rows) > 0:
+            cab_smooth = smooth_rows(cab[rows[peak_rows], :], window_len=window_len)
+            n_smooth = cab_smooth.shape[1]
+            bin_smooth = np.linspace(0, n_bins + window_len / 3, n_bins - 1 + window_len)
+
+            win_start = min_local_bin[peak_rows].astype(int) - column_search_radius
+            win_stop = max_local_bin[peak_rows].astype(int) + column_search_radius
+            start, stop = get_slice_bounds(win_start, win_stop, n_smooth)
+
+            # Strict local maxima above threshold (find_peaks, no plateaus)
+            left = cab_smooth[:, 1:-1] - cab_smooth[:, :-2]
+            right = cab_smooth[:, 1:-1] - cab_smooth[:, 2:]
+            high = cab_smooth[:, 1:-1]
+            is_peak = (left > 0) & (right > 0) & (high >= peak_threshold)
+
+            # Flat or near-tied tops are left to signal.find_peaks
+            tol = 1e-9 * peak_threshold
+            is_tie = (high >= peak_threshold - tol) & \
+                ((np.abs(left) <= tol) | (np.abs(right) <= tol) |
+                 (np.abs(high - peak_threshold) <= tol))
+
+            # Count peaks with start < i < stop - 1 (inner window points)
+            cols = np.arange(1, n_smooth - 1)
+            in_win = (cols[None, :] > start[:, None]) & \
+                (cols[None, :] < (stop - 1)[:, None])
+            n_peaks = np.sum(is_peak & in_win, axis=1)
+            ambiguous[peak_rows] = np.any(is_tie & in_win, axis=1)
+
+            single = np.where(n_peaks == 1)[0]
+            pk_col = np.argmax(is_peak[single] & in_win[single], axis=1) + 1
+            pk_idx = pk_col - start[single]
+            peak = np.around(np.take(bin_smooth, win_start[single] + pk_idx - 1,
+                                     mode='wrap')) - 1
+            cutoff[peak_rows[single]] = peak
+            method[peak_rows[single]] = 3
+
+        # 5) Safety check if clouds are low
+        low_cloud = np.abs(lowest_layer_bin[rows] - cutoff) < 5
+        cutoff[low_cloud] = lowest_layer_bin[rows][low_cloud] + 5
+        method[low_cloud] = 5
+
+        cutoff_bins[rows] = cutoff.astype(int)
+        surf_removal_method[rows] = method
+
+        # Rare ambiguous profiles use the per-profile logic
+        for idx in rows[ambiguous]:
+            cutoff_bins[idx], surf_removal_method[idx] = \
+                get_cab_cutoff_bin(atl09, idx, cab[idx, :], dem_below_bins,
+                                   **kwargs)
+
+    # Zero everything past each cutoff (same as .iloc[idx, cutoff_bin:] = 0)
+    n_cols = cab.shape[1]
+    cut_start, _ = get_slice_bounds(cutoff_bins[rows], np.full(len(rows), n_cols), n_cols)
+    cab_rows = cab_no_surf.to_numpy()[rows]
+    cab_rows[np.arange(n_cols)[None, :] >= cut_start[:, None]] = 0
+    cab_no_surf.iloc[rows, :] = cab_rows
 
-                if show_plots:
-                    plt.figure()
-                    plt.title(str(idx) + ', DEM Approach')
-                    plt.plot(cab_i, label='CAB')
-                    plt.axvline(dem_bin, label='DEM Surface', color='magenta')
-                    plt.axvline(cutoff_bin, label='Cutoff', color='red')
-                    plt.xlim([min([cutoff_bin, dem_bin]) - 30, max([cutoff_bin, dem_bin]) + 30])
-                    plt.legend()
-
-            else:
-                # Use neighbors to define window to search for peak in CAB
-                cab_smooth = smooth(cab_i, window_len=window_len)
-                bin_smooth = np.linspace(0, 700 + window_len / 3, 699 + window_len)
-                cab_search = cab_smooth[min_local_bin - column_search_radius:
-                                        max_local_bin + column_search_radius]
-
-                pk_idx, pk_h = signal.find_peaks(cab_search, height=peak_threshold)
-
-                if len(pk_idx) == 1:
-                    # IF a peak is found based on CAB, define this as surface
-                    peak = np.around(bin_smooth[min_local_bin - column_search_radius + pk_idx - 1]) - 1
-                    cutoff_bin = int(peak)
-                    surf_removal_method[idx] = 3
-                    if show_plots:
-                        plt.figure()
-                        plt.title(str(idx) + ', Smoothed peak finding')
-                        plt.plot(cab_i, label='CAB')
-                        plt.plot(bin_smooth, cab_smooth, label='Smoothed CAB profile')
-                        plt.axvline(np.around(mean_local_bin), color='cyan', label='Avg nearby surface location')
-                        plt.axvline(cutoff_bin, color='green', label='Cutoff bin')
-                        plt.axvline(min_local_bin - column_search_radius, color='red', label='Search window')
-                        plt.axvline(min_local_bin + column_search_radius, color='red')
-                        plt.axvline(surf_bin_i - column_search_radius, color='red')
-                        plt.axvline(lowest_layer_bin, color='black')
-                        plt.xlim([min([cutoff_bin, lowest_layer_bin, min_local_bin, surf_bin_i]) - 100,
-                                  max([cutoff_bin, lowest_layer_bin, min_local_bin, surf_bin_i]) + 100])
-                        plt.legend()
-
-                else:
-                    # IF no clear peak identified, USE DEM approach
-                    dem_bin = np.around((max(atl09.ds_va_bin_h) - atl09.df.loc[idx, 'dem_h']) / 30) + 1
-                    error_h = atl09.df.dem_h[atl09.df.surface_bin < 800] - \
-                        atl09.df.surface_height[atl09.df.surface_bin < 800]
-                    if len(error_h) == 0:
-                        # ATL09 did not find any surface points in this granule
-                        cutoff_bin = int(dem_bin)
-                    else:
-                        stdev = np.std(error_h)
-                        dem_above_bins = np.around((error_h.mean() + 2 * stdev) / 30)
-                        dem_below_bins = np.around((error_h.mean() - 2 * stdev) / 30)
-
-                        bin_2sigma_above_dem = dem_bin + dem_below_bins
-
-                        cutoff_bin = int(bin_2sigma_above_dem)
-                        surf_removal_method[idx] = 4
-
-                    if show_plots:
-                        plt.figure()
-                        plt.title(str(idx) + ', DEM approach, finding peaks w smooth CAB')
-                        plt.plot(cab_i, label='CAB')
-                        found_peaks = np.around(bin_smooth[min_local_bin - column_search_radius + pk_idx - 1])
-                        if len(found_peaks) > 1:
-                            for pk in found_peaks:
-                                if pk == found_peaks[0]:
-                                    plt.axvline(pk, color='cyan', label='Peaks found')
-                                else:
-                                    plt.axvline(pk, color='cyan')
-
-                        plt.axvline(lowest_layer_bin, color='black', label='Lowest cloud layer')
-                        plt.axvline(dem_bin, label='DEM Surface', color='magenta')
-                        plt.axvline(cutoff_bin, label='Cutoff', color='red')
-                        plt.xlim([min([min(found_peaks), cutoff_bin, lowest_layer_bin]) - 15,
-                                  max([max(found_peaks), cutoff_bin, lowest_layer_bin]) + 15])
-                        plt.legend()
-
-        if np.abs(lowest_layer_bin - cutoff_bin) < 5:
-            # safety check if clouds are low
-            cutoff_bin = int(lowest_layer_bin + 5)
-            surf_removal_method[idx] = 5
-
-        cutoff_bins[idx] = cutoff_bin
-        cab_no_surf.iloc[idx, cutoff_bin:] = 0
+    return cab_no_surf.iloc[idxing], surf_removal_method
 
 
-    return cab_no_surf.iloc[idxing], surf_removal_method
 def get_ml_features(atl09):
     df_ml = pd.DataFrame(index=atl09.df.index,
                          columns=['profile', 'beam', 'file', 'cab_int',
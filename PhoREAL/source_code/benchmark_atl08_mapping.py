@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the ATL08 -> ATL03 photon classification mapping
+
+Times the legacy ismember-based mapping against icesatUtils.getAtl08Mapping
+for every beam of a granule and checks that both return the same
+classifications. With no inputs a synthetic 6-beam granule is generated.
+
+Usage:
+    python benchmark_atl08_mapping.py --atl03 ATL03.h5 --atl08 ATL08.h5
+    python benchmark_atl08_mapping.py --photons 12000000
+
+Date: October 2026
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from icesatUtils import ismember, getAtl08Mapping
+
+
+GT_NAMES = ['gt1l', 'gt1r', 'gt2l', 'gt2r', 'gt3l', 'gt3r']
+
+
+##### Legacy mapping (np.isin + np.unique), kept for comparison
+def getAtl08MappingLegacy(atl03_ph_index_beg, atl03_segment_id,
+                          atl08_classed_pc_indx, atl08_classed_pc_flag,
+                          atl08_segment_id):
+
+    indsNotZero = atl03_ph_index_beg != 0
+    atl03_ph_index_beg = atl03_ph_index_beg[indsNotZero]
+    atl03_segment_id = atl03_segment_id[indsNotZero]
+    atl03SegsIn08TF, atl03SegsIn08Inds = ismember(atl08_segment_id,
+                                                  atl03_segment_id)
+    atl08classed_inds = atl08_classed_pc_indx[atl03SegsIn08TF]
+    atl08classed_vals = atl08_classed_pc_flag[atl03SegsIn08TF]
+    atl03_ph_beg_val = atl03_ph_index_beg[atl03SegsIn08Inds]
+    newMapping = atl08classed_inds + atl03_ph_beg_val - 2
+    allph_classed = (np.zeros(newMapping[-1] + 1).astype(int)) - 1
+    allph_classed[newMapping] = atl08classed_vals
+
+    return allph_classed
+
+
+##### Synthetic beam with ATL03 geolocation segments and ATL08 signal photons
+def makeSyntheticBeam(numPhotons, seed=0):
+
+    rng = np.random.default_rng(seed)
+
+    # ~20 m geolocation segments, some empty (ph_index_beg = 0)
+    numSegs = int(numPhotons / 10)
+    segment_ph_cnt = rng.poisson(10, numSegs)
+    segment_ph_cnt[rng.random(numSegs) < 0.05] = 0
+    segment_id = np.arange(numSegs) + 555000
+    ph_index_beg = np.cumsum(segment_ph_cnt) - segment_ph_cnt + 1
+    ph_index_beg[segment_ph_cnt == 0] = 0
+
+    # ATL08 classifies roughly half the photons of each segment
+    hasPh = segment_ph_cnt > 0
+    cnt = segment_ph_cnt[hasPh]
+    seg = np.repeat(segment_id[hasPh], cnt)
+    indx = np.arange(np.sum(cnt)) - np.repeat(np.cumsum(cnt) - cnt, cnt) + 1
+    keep = rng.random(len(seg)) < 0.5
+    classed_pc_indx = indx[keep]
+    classed_pc_flag = rng.integers(0, 4, len(classed_pc_indx))
+    atl08_segment_id = seg[keep]
+
+    return (ph_index_beg, segment_id, classed_pc_indx, classed_pc_flag,
+            atl08_segment_id)
+
+
+##### Read the mapping inputs of one beam from ATL03/ATL08 files
+def readBeam(atl03filepath, atl08filepath, gt):
+
+    from icesatIO import readAtl03DataMapping, readAtl08DataMapping
+
+    ph_index_beg, segment_id = readAtl03DataMapping(atl03filepath, gt)
+    classed_pc_indx, classed_pc_flag, atl08_segment_id = \
+        readAtl08DataMapping(atl08filepath, gt)
+
+    return (np.asarray(ph_index_beg), np.asarray(segment_id),
+            np.asarray(classed_pc_indx), np.asarray(classed_pc_flag),
+            np.asarray(atl08_segment_id))
+
+
+def runBenchmark(beams):
+
+    totalLegacy = 0.0
+    totalNew = 0.0
+    for gt, inputs in beams:
+
+        if(len(inputs[2]) == 0):
+            print('   %s: no ATL08 signal photons, skipped' % gt)
+            continue
+        # endIf
+
+        t0 = time.perf_counter()
+        legacy = getAtl08MappingLegacy(*inputs)
+        t1 = time.perf_counter()
+        new = getAtl08Mapping(*inputs)
+        t2 = time.perf_counter()
+
+        same = np.array_equal(legacy, new)
+        totalLegacy += t1 - t0
+        totalNew += t2 - t1
+        print('   %s: %9d photons  legacy %7.3f s  new %7.3f s  match %s'
+              % (gt, len(inputs[2]), t1 - t0, t2 - t1, same))
+    # endFor
+
+    if(totalNew > 0):
+        print('   Total: legacy %.3f s  new %.3f s  (%.1fx)'
+              % (totalLegacy, totalNew, totalLegacy / totalNew))
+    # endIf
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--atl03', type=str, default=None)
+    parser.add_argument('--atl08', type=str, default=None)
+    parser.add_argument('--photons', type=int, default=12000000,
+                        help='ATL03 photons per synthetic beam')
+    args = parser.parse_args()
+
+    if(args.atl03 and args.atl08):
+        print('ATL08 mapping benchmark: %s' % args.atl03)
+        beams = [(gt, readBeam(args.atl03, args.atl08, gt))
+                 for gt in GT_NAMES]
+    else:
+        print('ATL08 mapping benchmark: synthetic 6-beam granule')
+        beams = [(gt, makeSyntheticBeam(args.photons, seed))
+                 for seed, gt in enumerate(GT_NAMES)]
+    # endIf
+
+    runBenchmark(beams)
@@ -48,30 +48,25 @@ def search(DIR, search_list, logical='and', case=True, ignore_perms=True, ext=No
     if len(search_list) == 0:
         return []
 
-    import subprocess
-    cmd = 'find %s' % DIR
-    if not recursive:
-        cmd += ' -maxdepth 1'
-    for i, s in enumerate(search_list):
+    from fnmatch import fnmatchcase
+    patterns = []
+    for s in search_list:
         if not case:
             s = s.upper()
-        if i == 0:
-            cmd += ' -name \'*%s*\' -type f' % s
-        else:
-            cmd += ' -%s -name \'*%s*\' -type f' % (logical, s)
-
-    # if ignore_perms:
-    cmd += " 2>&1 | grep -v \"Permission denied\"" # ignore permission denied files
-    if debug:
-        print(cmd)
+        patterns.append('*%s*' % s)
 
-    try:
-        output = subprocess.check_output(cmd, shell=True)
-    except subprocess.CalledProcessError:
-        return []
+    if logical == 'or':
+        match = lambda name: any(fnmatchcase(name, p) for p in patterns)
+    else:
+        match = lambda name: all(fnmatchcase(name, p) for p in patterns)
 
-    s = output.decode()
-    files = s.split('\n')[:-1]
+    # walk directories natively; unreadable directories are skipped
+    # the same way "Permission denied" lines were dropped from find
+    files = []
+    for dir_path, _, names, _ in walk_dir(DIR, recursive=recursive):
+        for name in names:
+            if match(name):
+                files.append(os.path.join(dir_path, name))
 
     if ext != None:
         files = filter_ext(files, ext)
@@ -79,6 +74,354 @@ def search(DIR, search_list, logical='and', case=True, ignore_perms=True, ext=No
     return files
 
 
+def scan_dir(DIR, mtime_known=None):
+
+    """
+    Lists a single directory with os.scandir. Only regular files and real
+    sub-directories are returned (symlinks are not followed, as with find's
+    default behavior).
+
+    Input:
+        DIR - directory to list
+        mtime_known - previously cataloged mtime of DIR; if it still matches,
+                        the directory is not listed again
+
+    Output:
+        return mtime, names, subdirs
+        names/subdirs are None when mtime == mtime_known
+        return None if DIR could not be read (permissions, removed, etc)
+
+    """
+
+    try:
+        # stat before listing, so a change during the listing shows up
+        # as a newer mtime on the next refresh
+        mtime = os.stat(DIR).st_mtime
+        if mtime_known != None and mtime == mtime_known:
+            return mtime, None, None
+
+        names, subdirs = [], []
+        with os.scandir(DIR) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        names.append(entry.name)
+                except OSError:
+                    continue
+    except OSError:
+        return None
+
+    return mtime, names, subdirs
+
+
+def walk_dir(DIR, recursive=True, workers=8, mtimes_known=None, subdirs_known=None):
+
+    """
+    Walks DIR breadth-first, listing each level of sub-directories in
+    parallel (directory listings on network storage are latency-bound,
+    so threads overlap the round-trips).
+
+    Input:
+        DIR - top directory
+        recursive - if False, only DIR itself is listed
+        workers - number of threads listing directories
+        mtimes_known - optional dict of {dir: mtime} from a previous walk
+        subdirs_known - optional dict of {dir: [subdirs]} from a previous walk;
+                        used to descend through directories whose mtime
+                        has not changed
+
+    Output:
+        generator of (dir, mtime, names, subdirs)
+        names is None for directories whose mtime matched mtimes_known
+
+    Example:
+        import file_search as fs
+        for dir_path, mtime, names, subdirs in fs.walk_dir(DATA_DIR):
+            print(dir_path, len(names))
+
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    if mtimes_known == None:
+        mtimes_known = {}
+    if subdirs_known == None:
+        subdirs_known = {}
+
+    level = [DIR]
+    with ThreadPoolExecutor(max_workers=max(int(workers), 1)) as pool:
+        while len(level) > 0:
+            scans = pool.map(lambda d: scan_dir(d, mtimes_known.get(d)), level)
+            level_next = []
+            for dir_path, scan in zip(level, scans):
+                if scan == None:
+                    continue
+                mtime, names, subdirs = scan
+                if names == None:
+                    subdirs = subdirs_known.get(dir_path, [])
+                yield dir_path, mtime, names, subdirs
+                if recursive:
+                    level_next.extend(subdirs)
+            level = level_next
+
+
+def parse_atl_name(file, file_start='ATL'):
+
+    """
+    Parses the parts of an ATL granule name once, such as
+        ATL03_20190819234642_08080403_002_01_sreq_3040.h5
+    Offsets follow iu.get_h5_meta(), relative to file_start.
+
+    Input:
+        file - ATL file, full-path or not
+        file_start - prefix marking the start of the ATL name
+
+    Output:
+        dict with keys name, atl, year, month, day, doy, hms, date,
+        track, cycle, region, release, f_type, version
+        (name is the basename from file_start on; date is int YYYYMMDD)
+        return None if file is not an ATL granule name
+
+    """
+
+    file_sub = os.path.basename(file)
+    try:
+        i0 = file_sub.index(file_start)
+    except ValueError:
+        return None
+
+    name = file_sub[i0:]
+    if len(name) < 36 or name[5] != '_' or name[20] != '_' or name[29] != '_':
+        return None
+    if not (name[3:5].isdigit() and name[6:20].isdigit() and name[21:29].isdigit()):
+        return None
+
+    year, month, day = int(name[6:10]), int(name[10:12]), int(name[12:14])
+    try:
+        doy = int(iu.get_date(year, month, day))
+    except Exception:
+        return None
+
+    r = name[30:34]
+    f_type = 'rapid'
+    if '_' in r:
+        r = name[30:33]
+        f_type = 'final'
+
+    v = name[34:36]
+    if '_' in v:
+        v = name[35:37]
+
+    return {'name': name, 'atl': int(name[3:5]),
+            'year': year, 'month': month, 'day': day, 'doy': doy,
+            'hms': name[14:20], 'date': int(name[6:14]),
+            'track': int(name[21:25]), 'cycle': int(name[25:27]), 'region': int(name[27:29]),
+            'release': r, 'f_type': f_type, 'version': v}
+
+
+CATALOG_COLUMNS = ['path', 'dir', 'name', 'atl', 'year', 'month', 'day', 'doy', 'hms', 'date',
+                    'track', 'cycle', 'region', 'release', 'f_type', 'version']
+
+
+def open_catalog(db_file):
+
+    """
+    Opens (and creates, if needed) the sqlite ATL granule catalog.
+    dirs holds each directory with its mtime (NULL if not walked yet) and parent,
+    granules holds the parsed name parts of each ATL file.
+    """
+
+    import sqlite3
+    con = sqlite3.connect(db_file)
+    con.execute('CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, parent TEXT, mtime REAL)')
+    con.execute('CREATE TABLE IF NOT EXISTS granules (path TEXT PRIMARY KEY, dir TEXT, name TEXT, '
+                'atl INTEGER, year INTEGER, month INTEGER, day INTEGER, doy INTEGER, hms TEXT, '
+                'date INTEGER, track INTEGER, cycle INTEGER, region INTEGER, '
+                'release TEXT, f_type TEXT, version TEXT)')
+    con.execute('CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent)')
+    con.execute('CREATE INDEX IF NOT EXISTS granules_dir ON granules (dir)')
+    con.execute('CREATE INDEX IF NOT EXISTS granules_name ON granules (name)')
+    con.execute('CREATE INDEX IF NOT EXISTS granules_track ON granules (atl, track, cycle, region)')
+    con.execute('CREATE INDEX IF NOT EXISTS granules_date ON granules (atl, date)')
+    return con
+
+
+def get_subtree_bounds(DIR):
+    # every path under DIR sorts between DIR + sep and DIR + (sep+1),
+    # which lets sqlite use the primary key index instead of LIKE
+    return DIR + os.sep, DIR + chr(ord(os.sep) + 1)
+
+
+def update_catalog(DIR, db_file=None, ext='h5', recursive=True, workers=8, file_start='ATL', debug=0):
+
+    """
+    Builds or refreshes a persistent catalog of the ATL granules under DIR.
+    Directories whose mtime has not changed since the last refresh are not
+    listed again, so a refresh of a large archive only touches the
+    directories where files were added, removed or renamed.
+
+    Input:
+        DIR - top directory of the archive
+        db_file - sqlite catalog file, default is DIR/atl_catalog.db
+        ext - only files with this extension are cataloged
+        recursive - catalog sub-directories (default); if False, only the
+                    files directly in DIR are refreshed
+        workers - number of threads listing directories
+        file_start - prefix marking the start of the ATL name
+        debug - prints refresh counts
+
+    Output:
+        return db_file
+
+    Example:
+        import file_search as fs
+        DIR_08 = fs.get_dir('003', 8)
+        db_file = fs.update_catalog(DIR_08, db_file='atl08_r003.db')
+        files_08 = fs.query_catalog(db_file, atl=8, track=808, date_start=20190801, date_end=20190831)
+
+    """
+
+    DIR = os.path.abspath(DIR)
+    if db_file == None:
+        db_file = os.path.join(DIR, 'atl_catalog.db')
+
+    con = open_catalog(db_file)
+    lo, hi = get_subtree_bounds(DIR)
+    rows = con.execute('SELECT path, parent, mtime FROM dirs WHERE path = ? OR (path >= ? AND path < ?)',
+                        (DIR, lo, hi)).fetchall()
+    mtimes_known, subdirs_known = {}, {}
+    for path, parent, mtime in rows:
+        mtimes_known[path] = mtime
+        if parent != None:
+            subdirs_known.setdefault(parent, []).append(path)
+
+    visited = set()
+    n_changed, n_granules = 0, 0
+    with con:
+        for dir_path, mtime, names, subdirs in walk_dir(DIR, recursive, workers, mtimes_known, subdirs_known):
+            visited.add(dir_path)
+            if names == None:
+                continue
+
+            # directory is new or changed; replace its granules
+            n_changed += 1
+            con.execute('DELETE FROM granules WHERE dir = ?', (dir_path,))
+            granules = []
+            for name in names:
+                if ext != None and name[-len(ext):] != ext:
+                    continue
+                meta = parse_atl_name(name, file_start)
+                if meta == None:
+                    continue
+                meta['path'] = os.path.join(dir_path, name)
+                meta['dir'] = dir_path
+                granules.append(tuple(meta[c] for c in CATALOG_COLUMNS))
+            con.executemany('INSERT OR REPLACE INTO granules VALUES (%s)' % ','.join('?'*len(CATALOG_COLUMNS)), granules)
+            n_granules += len(granules)
+
+            con.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)', (dir_path, os.path.dirname(dir_path), mtime))
+
+            # record sub-directories right away (mtime NULL until walked), so
+            # later refreshes descend into them even if this one did not
+            # (recursive=False) and this directory's mtime stays the same
+            con.executemany('INSERT OR IGNORE INTO dirs VALUES (?, ?, NULL)', [(d, dir_path) for d in subdirs])
+            con.executemany('UPDATE dirs SET parent = ? WHERE path = ?', [(dir_path, d) for d in subdirs])
+
+        # directories that were removed (or became unreadable)
+        stale = [path for path in mtimes_known if path not in visited]
+        if not recursive:
+            stale = [path for path in stale if path == DIR]
+        con.executemany('DELETE FROM granules WHERE dir = ?', [(path,) for path in stale])
+        con.executemany('DELETE FROM dirs WHERE path = ?', [(path,) for path in stale])
+
+    con.close()
+
+    if debug:
+        print('catalog %s: %d dirs walked, %d changed, %d removed, %d granules updated' % \
+                (db_file, len(visited), n_changed, len(stale), n_granules))
+
+    return db_file
+
+
+def query_catalog(db_file, atl=None, track=None, cycle=None, region=None, date_start=None, date_end=None,
+                        release=None, version=None, f_type=None, prefix=None, DIR=None, recursive=True):
+
+    """
+    Indexed lookup of ATL granules in a catalog made by update_catalog().
+
+    Input:
+        All inputs can be stacked ('and' logic), as with filter_atl()
+
+        db_file - sqlite catalog file
+        atl - product number, such as 3, '08' or 'ATL09'
+        track - reference ground track, string or int
+        cycle - cycle number (2-digit field), string or int
+        region - region number (2-digit field), string or int
+        date_start - first date, YYYYMMDD string or int (inclusive)
+        date_end - last date, YYYYMMDD string or int (inclusive)
+        release - release number, string or int
+        version - version number, string or int
+        f_type - either 'rapid' or 'final'
+        prefix - start of the ATL name, such as 'ATL08_20190819234642_0808'
+        DIR - only return granules under DIR
+        recursive - if False, only granules directly in DIR
+
+    Output:
+        sorted list of full-path files
+
+    Example:
+        import file_search as fs
+        files_03 = fs.query_catalog(db_file, atl='ATL03', track=808, cycle=4)
+
+    """
+
+    where, params = [], []
+
+    def add(cond, *vals):
+        where.append(cond)
+        params.extend(vals)
+
+    if atl != None:
+        add('atl = ?', int(str(atl)[-2:]))
+    if track != None:
+        add('track = ?', int(track))
+    if cycle != None:
+        add('cycle = ?', int(cycle))
+    if region != None:
+        add('region = ?', int(region))
+    if date_start != None:
+        add('date >= ?', int(date_start))
+    if date_end != None:
+        add('date <= ?', int(date_end))
+    if release != None:
+        add('release = ?', str(release).zfill(3))
+    if version != None:
+        add('version = ?', str(version).zfill(2))
+    if f_type != None:
+        add('f_type = ?', f_type.lower())
+    if prefix != None:
+        add('name >= ? AND name < ?', prefix, prefix + '\uffff')
+    if DIR != None:
+        DIR = os.path.abspath(DIR)
+        if recursive:
+            lo, hi = get_subtree_bounds(DIR)
+            add('(dir = ? OR (dir >= ? AND dir < ?))', DIR, lo, hi)
+        else:
+            add('dir = ?', DIR)
+
+    cmd = 'SELECT path FROM granules'
+    if len(where) > 0:
+        cmd += ' WHERE ' + ' AND '.join(where)
+    cmd += ' ORDER BY path'
+
+    con = open_catalog(db_file)
+    files = [row[0] for row in con.execute(cmd, params)]
+    con.close()
+
+    return files
+
 
 def show_h5(h5_file, key_main='/'):
 
@@ -375,17 +718,17 @@ def remove_duplicate_atl(files_h5, release='latest', version='latest', file_star
     _, index = np.unique(files_h5_sub, return_index=True)
     files_h5 = list(np.array(files_h5)[index])
 
-    # this next bit prioritizes either release or version, if applicable
-    files_h5_new = []
+    # group files by their track/cycle name once, instead of
+    # filtering the whole list again for every file
+    groups = {}
     for file0 in files_h5:
-        # files_new = filter_atl(files_h5, name=file0)
-
-        # file0_sub = file0.split('/')[-1]
         file0_sub = os.path.basename(file0)
         i0 = check_file_start(file0_sub, file_start, debug)
-        files_name = filter_atl(files_h5, name=file0_sub[i0:i0+29])
-        # print(i0)
-        # print(files_name)
+        groups.setdefault(file0_sub[i0:i0+29], []).append(file0)
+
+    # this next bit prioritizes either release or version, if applicable
+    files_h5_new = []
+    for files_name in groups.values():
         if len(files_name) > 1:
             # multiple versions or releases, or some 
             # files have nreq or sub or some other bs
@@ -394,7 +737,6 @@ def remove_duplicate_atl(files_h5, release='latest', version='latest', file_star
                 # filter by release first
                 r = []
                 for file_n in files_name:
-                    # file_n_sub = file_n.split('/')[-1]
                     file_n_sub = os.path.basename(file_n)
                     i0 = check_file_start(file_n_sub, file_start, debug)
                     r.append(int(file_n_sub[i0+30:i0+33]))
@@ -408,7 +750,6 @@ def remove_duplicate_atl(files_h5, release='latest', version='latest', file_star
                 # filter by version second
                 v = []
                 for file_n in files_name_r:
-                    # file_n_sub = file_n.split('/')[-1]
                     file_n_sub = os.path.basename(file_n)
                     i0 = check_file_start(file_n_sub, file_start, debug)
                     v.append(int(file_n_sub[i0+34:i0+36]))
@@ -428,7 +769,7 @@ def remove_duplicate_atl(files_h5, release='latest', version='latest', file_star
 
 
 def find_match(file, search_type, SEARCH_DIR=None, recursive=True, match_ymd=True, match_trackcycle=True,
-                 match_release=False, match_version=False, debug=0):
+                 match_release=False, match_version=False, catalog=None, debug=0):
 
     """
     This code finds matches between ATL files, 03 to 08, 03 to 09, 09 to 12 - anything.
@@ -442,6 +783,8 @@ def find_match(file, search_type, SEARCH_DIR=None, recursive=True, match_ymd=Tru
         match_trackcycle - match both track and cycle (default)
         match_release - match release number
         match_version - match version number
+        catalog - optional sqlite catalog from update_catalog(); matches
+                    are then an indexed lookup instead of a directory search
 
     Output:
         return files_out
@@ -464,12 +807,16 @@ def find_match(file, search_type, SEARCH_DIR=None, recursive=True, match_ymd=Tru
         file_08 = '/bigtex_data/data/release/002/ATL08_r002/ATL08_20190819234642_08080403_002_02.h5'
         files_03 = fs.find_match(file_08, search_type='ATL03', SEARCH_DIR='/bigtex_data/data/release/002/ATL03_r002')
 
+        # matching many files, catalog the search directory once
+        db_file = fs.update_catalog('/bigtex_data/data/release/002/ATL08_r002', db_file='atl08_r002.db')
+        files_08 = fs.find_match(file_03, search_type='ATL08', catalog=db_file)
+
     """
 
     file_start='ATL'
     search_type = search_type.lower()
 
-    if SEARCH_DIR == None:
+    if SEARCH_DIR == None and catalog == None:
         SEARCH_DIR = get_dir('data')
         if debug:
             print('searching all of %s...'% SEARCH_DIR)
@@ -509,7 +856,10 @@ def find_match(file, search_type, SEARCH_DIR=None, recursive=True, match_ymd=Tru
         print(SEARCH_DIR)
         print(file_cmp_new)
 
-    files_out = search(SEARCH_DIR, [file_cmp_new], ext='h5', recursive=recursive)
+    if catalog != None:
+        files_out = query_catalog(catalog, prefix=file_cmp_new, DIR=SEARCH_DIR, recursive=recursive)
+    else:
+        files_out = search(SEARCH_DIR, [file_cmp_new], ext='h5', recursive=recursive)
 
     if len(files_out) == 0:
         if debug:
@@ -559,6 +909,9 @@ if __name__ == "__main__":
     DIR_08 = get_dir('003', 8)
     files_03 = search(DIR_03, ['ATL03'], ext='h5', recursive=False)
     # files_08 = search(DIR_08, ['ATL08'], ext='h5', recursive=False)
+
+    # catalog the 08 directory once; later runs only re-list changed dirs
+    db_08 = update_catalog(DIR_08, db_file='atl08_r003.db', recursive=False)
     
     print('match 03 files to 08 files')
     files_03_match = []
@@ -568,7 +921,7 @@ if __name__ == "__main__":
     from tqdm import tqdm
     for i in tqdm(range(n_03)):
         file_03 = files_03[i]
-        files_08 = find_match(file_03, 'atl08', DIR_08) #, recursive=False)
+        files_08 = find_match(file_03, 'atl08', DIR_08, recursive=False, catalog=db_08)
         # files_09 = find_match(file_03, 'atl09', DIR_09) #, recursive=False)
         if len(files_08) == 0:
             continue
@@ -19,10 +19,10 @@ Date: September 20, 2019
 import os
 import numpy as np
 import time as runTime
-from icesatIO import (readAtl03H5, readAtl08H5,
-                      readAtl03DataMapping, readAtl08DataMapping,
+from icesatIO import (readAtlH5Multi,
                       readTruthRegionsTxtFile,
                       writeLas, writeKml, writeArrayToCSV, writeLog,
+                      writeArrayToColumnar,
                       GtToBeamNum, GtToBeamSW,
                       atlRotationStruct, atl03Struct, atl08Struct)
 from icesatUtils import (getNameParts,
@@ -35,7 +35,8 @@ def getAtlMeasuredSwath(atl03FilePath = False, atl08FilePath = False,
                         outFilePath = False, gtNum = 'gt1r', trimInfo = 'auto', 
                         createAtl03LasFile = False, createAtl03KmlFile = False, 
                         createAtl08KmlFile = False, createAtl03CsvFile = False, 
-                        createAtl08CsvFile = False, logFileID = False):
+                        createAtl08CsvFile = False, logFileID = False,
+                        outFileFormat = 'csv'):
                         # pklHeaderFile = None, LAS_DIR = None):
     
     # Initialize outputs
@@ -88,16 +89,24 @@ def getAtlMeasuredSwath(atl03FilePath = False, atl08FilePath = False,
         
         # Read ATL03 data from h5 file
         writeLog('   Reading ATL03 .h5 file: %s' % atl03FilePath, logFileID)
-        lat_all = readAtl03H5(atl03FilePath, '/heights/lat_ph', gtNum)
-        lon_all = readAtl03H5(atl03FilePath, '/heights/lon_ph', gtNum)
-        z_all = readAtl03H5(atl03FilePath, '/heights/h_ph', gtNum)
-        deltaTime_all = readAtl03H5(atl03FilePath, '/heights/delta_time', gtNum)
-        signalConf_all = readAtl03H5(atl03FilePath, '/heights/signal_conf_ph', gtNum)
-        zGeoidal = readAtl03H5(atl03FilePath, '/geophys_corr/geoid', gtNum)
-        zGeoidal_deltaTime = readAtl03H5(atl03FilePath, '/geophys_corr/delta_time', gtNum)
-        solar_elev = readAtl03H5(atl03FilePath, '/geolocation/solar_elevation', gtNum)
-        solar_time = readAtl03H5(atl03FilePath, '/geolocation/delta_time', gtNum)
-        atl03_ph_index_beg, atl03_segment_id, atl03_seg_deltaTime = readAtl03DataMapping(atl03FilePath, gtNum, return_delta_time=True)
+        atl03Fields = ['/heights/lat_ph', '/heights/lon_ph', '/heights/h_ph',
+                       '/heights/delta_time', '/heights/signal_conf_ph',
+                       '/geophys_corr/geoid', '/geophys_corr/delta_time',
+                       '/geolocation/solar_elevation', '/geolocation/delta_time',
+                       '/geolocation/ph_index_beg', '/geolocation/segment_id']
+        atl03Arrays = readAtlH5Multi(atl03FilePath, atl03Fields, gtNum)
+        lat_all = atl03Arrays['/heights/lat_ph']
+        lon_all = atl03Arrays['/heights/lon_ph']
+        z_all = atl03Arrays['/heights/h_ph']
+        deltaTime_all = atl03Arrays['/heights/delta_time']
+        signalConf_all = atl03Arrays['/heights/signal_conf_ph']
+        zGeoidal = atl03Arrays['/geophys_corr/geoid']
+        zGeoidal_deltaTime = atl03Arrays['/geophys_corr/delta_time']
+        solar_elev = atl03Arrays['/geolocation/solar_elevation']
+        solar_time = atl03Arrays['/geolocation/delta_time']
+        atl03_ph_index_beg = atl03Arrays['/geolocation/ph_index_beg']
+        atl03_segment_id = atl03Arrays['/geolocation/segment_id']
+        atl03_seg_deltaTime = atl03Arrays['/geolocation/delta_time']
         try:
             zGeoidal_all = interp_vals(zGeoidal_deltaTime, zGeoidal, deltaTime_all, removeThresh=True)
             zMsl_all = z_all - zGeoidal_all
@@ -166,17 +175,28 @@ def getAtlMeasuredSwath(atl03FilePath = False, atl08FilePath = False,
                 
                 # Read ATL08 data from .h5 file
                 writeLog('   Reading ATL08 .h5 file: %s' % atl08FilePath, logFileID) 
-                atl08_lat = readAtl08H5(atl08FilePath, '/land_segments/latitude', gtNum)
-                atl08_lon = readAtl08H5(atl08FilePath, '/land_segments/longitude', gtNum)
-                atl08_maxCanopy = readAtl08H5(atl08FilePath, '/land_segments/canopy/h_max_canopy_abs', gtNum)
-                atl08_teBestFit = readAtl08H5(atl08FilePath, '/land_segments/terrain/h_te_best_fit', gtNum)
-                atl08_teMedian = readAtl08H5(atl08FilePath, '/land_segments/terrain/h_te_median', gtNum)
-                atl08_deltaTime = readAtl08H5(atl08FilePath, '/land_segments/delta_time', gtNum)
+                atl08Fields = ['/land_segments/latitude', '/land_segments/longitude',
+                               '/land_segments/canopy/h_max_canopy_abs',
+                               '/land_segments/terrain/h_te_best_fit',
+                               '/land_segments/terrain/h_te_median',
+                               '/land_segments/delta_time',
+                               '/signal_photons/classed_pc_indx',
+                               '/signal_photons/classed_pc_flag',
+                               '/signal_photons/ph_segment_id']
+                atl08Arrays = readAtlH5Multi(atl08FilePath, atl08Fields, gtNum)
+                atl08_lat = atl08Arrays['/land_segments/latitude']
+                atl08_lon = atl08Arrays['/land_segments/longitude']
+                atl08_maxCanopy = atl08Arrays['/land_segments/canopy/h_max_canopy_abs']
+                atl08_teBestFit = atl08Arrays['/land_segments/terrain/h_te_best_fit']
+                atl08_teMedian = atl08Arrays['/land_segments/terrain/h_te_median']
+                atl08_deltaTime = atl08Arrays['/land_segments/delta_time']
                 atl08_zGeoidal = interp_vals(zGeoidal_deltaTime, zGeoidal, atl08_deltaTime, removeThresh=True)
                 atl08_maxCanopyMsl = atl08_maxCanopy - atl08_zGeoidal
                 atl08_teBestFitMsl = atl08_teBestFit - atl08_zGeoidal
                 atl08_teMedianMsl = atl08_teMedian - atl08_zGeoidal
-                atl08_classed_pc_indx, atl08_classed_pc_flag, atl08_segment_id = readAtl08DataMapping(atl08FilePath, gtNum)
+                atl08_classed_pc_indx = atl08Arrays['/signal_photons/classed_pc_indx']
+                atl08_classed_pc_flag = atl08Arrays['/signal_photons/classed_pc_flag']
+                atl08_segment_id = atl08Arrays['/signal_photons/ph_segment_id']
                 atl08_signalConf = np.zeros(np.size(atl08_lat))
                 atl08_classification = np.zeros(np.size(atl08_lat))
                 atl08_intensity = np.zeros(np.size(atl08_lat))
@@ -634,8 +654,8 @@ def getAtlMeasuredSwath(atl03FilePath = False, atl08FilePath = False,
             # Create output ATL03 .csv file
             if(createAtl03CsvFile):
                 
-                writeLog('   Writing ATL03 .csv file...', logFileID)
-                outName = atl03Data.atl03FileName + '_' + atl03Data.gtNum + '.csv'
+                writeLog('   Writing ATL03 .%s file...' % outFileFormat, logFileID)
+                outName = atl03Data.atl03FileName + '_' + atl03Data.gtNum + '.' + outFileFormat
                 outPath = os.path.normpath(outFilePath + '/' + outName)
                 
                 # If output directory does not exist, create it
@@ -644,11 +664,20 @@ def getAtlMeasuredSwath(atl03FilePath = False, atl08FilePath = False,
                 # EndIf
                 
                 # Create arrays for GT Num, Beam Num, and Beam Type
-                gtNumArray = np.c_[np.tile(atl03Data.gtNum, len(atl03Data.lat))]
-                beamNumArray = np.c_[np.tile(atl03Data.beamNum, len(atl03Data.lat))]
-                beamTypeArray = np.c_[np.tile(atl03Data.beamStrength, len(atl03Data.lat))]
-                zoneArray = np.c_[np.tile(atl03Data.zone, len(atl03Data.lat))]
-                hemiArray = np.c_[np.tile(atl03Data.hemi, len(atl03Data.lat))]
+                # (columnar formats store the constants as categoricals)
+                if(outFileFormat == 'csv'):
+                    gtNumArray = np.c_[np.tile(atl03Data.gtNum, len(atl03Data.lat))]
+                    beamNumArray = np.c_[np.tile(atl03Data.beamNum, len(atl03Data.lat))]
+                    beamTypeArray = np.c_[np.tile(atl03Data.beamStrength, len(atl03Data.lat))]
+                    zoneArray = np.c_[np.tile(atl03Data.zone, len(atl03Data.lat))]
+                    hemiArray = np.c_[np.tile(atl03Data.hemi, len(atl03Data.lat))]
+                else:
+                    gtNumArray = atl03Data.gtNum
+                    beamNumArray = atl03Data.beamNum
+                    beamTypeArray = atl03Data.beamStrength
+                    zoneArray = atl03Data.zone
+                    hemiArray = atl03Data.hemi
+                # endIf
                 
                 # Write .csv file
                 if(atl03Data.zone=='3413' or atl03Data.zone=='3976'):
@@ -685,7 +714,11 @@ def getAtlMeasuredSwath(atl03FilePath = False, atl08FilePath = False,
                             atl03Data.classification, atl03Data.signalConf, \
                             atl03Data.solar_elev] 
                 
-                writeArrayToCSV(outPath, namelist, datalist)
+                if(outFileFormat == 'csv'):
+                    writeArrayToCSV(outPath, namelist, datalist)
+                else:
+                    writeArrayToColumnar(outPath, namelist, datalist, outFileFormat)
+                # endIf
                 
             # endIf
             
@@ -694,8 +727,8 @@ def getAtlMeasuredSwath(atl03FilePath = False, atl08FilePath = False,
                 
                 if(atl08FilePath):
                     
-                    writeLog('   Writing ATL08 .csv file...', logFileID)
-                    outName = atl08Data.atl08FileName + '_' + atl08Data.gtNum + '.csv'
+                    writeLog('   Writing ATL08 .%s file...' % outFileFormat, logFileID)
+                    outName = atl08Data.atl08FileName + '_' + atl08Data.gtNum + '.' + outFileFormat
                     outPath = os.path.normpath(outFilePath + '/' + outName)
                     
                     # If output directory does not exist, create it
@@ -704,11 +737,20 @@ def getAtlMeasuredSwath(atl03FilePath = False, atl08FilePath = False,
                     # EndIf
                     
                     # Create arrays for GT Num, Beam Num, and Beam Type
-                    gtNumArray = np.c_[np.tile(atl08Data.gtNum, len(atl08Data.lat))]
-                    beamNumArray = np.c_[np.tile(atl08Data.beamNum, len(atl08Data.lat))]
-                    beamTypeArray = np.c_[np.tile(atl08Data.beamStrength, len(atl08Data.lat))]
-                    zoneArray = np.c_[np.tile(atl08Data.zone, len(atl08Data.lat))]
-                    hemiArray = np.c_[np.tile(atl08Data.hemi, len(atl08Data.lat))]
+                    # (columnar formats store the constants as categoricals)
+                    if(outFileFormat == 'csv'):
+                        gtNumArray = np.c_[np.tile(atl08Data.gtNum, len(atl08Data.lat))]
+                        beamNumArray = np.c_[np.tile(atl08Data.beamNum, len(atl08Data.lat))]
+                        beamTypeArray = np.c_[np.tile(atl08Data.beamStrength, len(atl08Data.lat))]
+                        zoneArray = np.c_[np.tile(atl08Data.zone, len(atl08Data.lat))]
+                        hemiArray = np.c_[np.tile(atl08Data.hemi, len(atl08Data.lat))]
+                    else:
+                        gtNumArray = atl08Data.gtNum
+                        beamNumArray = atl08Data.beamNum
+                        beamTypeArray = atl08Data.beamStrength
+                        zoneArray = atl08Data.zone
+                        hemiArray = atl08Data.hemi
+                    # endIf
                     
                     # Write .csv file
                     if(atl03Data.zone=='3413' or atl03Data.zone=='3976'):
@@ -742,8 +784,12 @@ def getAtlMeasuredSwath(atl03FilePath = False, atl08FilePath = False,
                                 atl08Data.maxCanopy, \
                                 atl08Data.teBestFit, atl08Data.teMedian] 
                     
-                    writeArrayToCSV(outPath, namelist, datalist)
-                
+                    if(outFileFormat == 'csv'):
+                        writeArrayToCSV(outPath, namelist, datalist)
+                    else:
+                        writeArrayToColumnar(outPath, namelist, datalist, outFileFormat)
+                    # endIf
+
                 # endIf
                 
             # endIf
@@ -13,10 +13,11 @@ import ntpath
 
 # Import ICESat-2 modules
 from getAtlMeasuredSwath_auto import getAtlMeasuredSwath
-from icesatIO import (atlTruthStruct, writeLas, writeLog, \
+from icesatIO import (atlTruthStruct, atlTruthAccumulator, writeLas, writeLog, \
                       getTruthFilePaths, getTruthHeaders, \
                       reprojectHeaderData, findMatchingTruthFiles, \
-                      loadTruthFile, makeBuffer)
+                      getTruthTileIndex, loadTruthFile, makeBuffer)
+from icesatUtils import identifyEPSG
 
 
 # Get ATL Truth Swath
@@ -52,9 +53,15 @@ def getAtlTruthSwath(atlMeasuredData, rotationData, truthHeaderDF, truthFilePath
         writeLog('   Reprojecting header file data...', logFileID)
         truthHeaderNewDF = reprojectHeaderData(truthHeaderDF, atlMeasuredData, logFileID)
         
+        # Get reference tile index (stored next to the header file)
+        epsg_atl = identifyEPSG(atlMeasuredData.hemi,atlMeasuredData.zone)
+        indexFileName = 'phoReal_headers_index_%s.npz' %epsg_atl.replace(':','_')
+        indexFilePath = os.path.normpath(os.path.join(ntpath.dirname(truthFilePaths[0]), indexFileName))
+        tileIndex = getTruthTileIndex(truthHeaderNewDF, epsg_atl, indexFilePath, logFileID=logFileID)
+        
         # Find truth files that intersect ICESat-2 track
         writeLog('   Determining which reference files intersect ground track...', logFileID)
-        _, matchingTruthFileInds = findMatchingTruthFiles(truthHeaderNewDF, atlMeasuredData, rotationData, buffer)
+        _, matchingTruthFileInds = findMatchingTruthFiles(truthHeaderNewDF, atlMeasuredData, rotationData, buffer, tileIndex)
         matchingTruthFiles = np.array(truthFilePaths)[matchingTruthFileInds]
         
         # Read truth files that intersect ICESat-2 track
@@ -69,7 +76,7 @@ def getAtlTruthSwath(atlMeasuredData, rotationData, truthHeaderDF, truthFilePath
             
             # Initialize parameters
             fileNum = 1
-            atlTruthData = atlTruthStruct([],[],[],[],[],[],[],[],[],[],[])
+            atlTruthAccum = atlTruthAccumulator()
         
             # Loop over matching files
             for i in range(0,len(matchingTruthFiles)):
@@ -82,7 +89,7 @@ def getAtlTruthSwath(atlMeasuredData, rotationData, truthHeaderDF, truthFilePath
                 
                 # Read truth file
                 writeLog('   %d) %s' %(fileNum, baseName), logFileID)
-                atlTruthDataSingle = loadTruthFile(truthFilePath, atlMeasuredData, rotationData, truthFileType, outFilePath, logFileID)
+                atlTruthDataSingle = loadTruthFile(truthFilePath, atlMeasuredData, rotationData, truthFileType, outFilePath, logFileID, buffer)
                   
                 # Get truth file buffer
                 if(bool(atlTruthDataSingle)):
@@ -91,7 +98,7 @@ def getAtlTruthSwath(atlMeasuredData, rotationData, truthHeaderDF, truthFilePath
                     atlTruthDataBuffer = makeBuffer(atlTruthDataSingle, atlMeasuredData, rotationData, buffer)
                 
                     # Append truth files
-                    atlTruthData.append(atlTruthDataBuffer)
+                    atlTruthAccum.append(atlTruthDataBuffer)
     
                     # Increment counter
                     fileNum += 1
@@ -99,6 +106,9 @@ def getAtlTruthSwath(atlMeasuredData, rotationData, truthHeaderDF, truthFilePath
                 # endIf
                 
             # endFor
+            
+            # Join truth files once
+            atlTruthData = atlTruthAccum.getTruthStruct()
         
         else:
             
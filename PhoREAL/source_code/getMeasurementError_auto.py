@@ -20,9 +20,131 @@ from getAtlMeasuredSwath_auto import getAtlMeasuredSwath
 from getAtlTruthSwath_auto import getAtlTruthSwath
 from icesatIO import (writeLas, writeLog, getTruthFilePaths, getTruthHeaders,
                       atlMeasuredDataReducedStruct, atlCorrectionsStruct, offsetsStruct)
-from icesatUtils import (ismember, getRaster, getIntersection2d, getCoordRotRev, getUTM2LatLon)
+from icesatUtils import (ismember, getRaster, getIntersection2d, getCoordRotRev, getUTM2LatLon,
+                         getRasterPyramid, getPyramidRaster, getIntersectionGrid)
 from icesatPlot import (plotContour, plotZY, plotZT)
 
+# Function to compute offset search error surfaces for every shift at once
+def getOffsetSurfaces(truthGrid, truthRowsInit, truthColsInit, measZCommon,
+                      crossTrackOffsets, alongTrackOffsets, rasterResolution,
+                      fixedVerticalShift = None, maxChunkElements = 4000000):
+    
+    # Inputs:
+    # truthGrid - gridded TRUTH Z raster (rows = along-track, inverted)
+    # truthRowsInit, truthColsInit - TRUTH row/col of each common cell
+    # measZCommon - MEASURED Z of each common cell
+    # crossTrackOffsets, alongTrackOffsets - offsets to test (m)
+    # rasterResolution - raster resolution (m)
+    # fixedVerticalShift - vertical shift to apply, or None to use the
+    #                      median Z error of each offset
+    #
+    # Outputs (numAlongTrack x numCrossTrack arrays):
+    # cross-track shift, along-track shift, vertical shift, MAE, RMSE, ME
+    #
+    # Each offset moves the TRUTH cells by whole raster cells, so every shift
+    # is a gather from the TRUTH raster. Shifts are evaluated in chunks as
+    # rows of a (shifts x cells) matrix with out-of-bounds cells set to NaN,
+    # and the median vertical shift comes from a row-wise sort, which keeps
+    # the results identical to the per-offset nanmedian/nanmean loop.
+    
+    numHorzCombos = np.size(crossTrackOffsets)
+    numVertCombos = np.size(alongTrackOffsets)
+    numCombos = numHorzCombos*numVertCombos
+    
+    # Offset grids in [J,I] (along-track, cross-track) order
+    resultsCrossTrackShift, resultsAlongTrackShift = \
+        np.meshgrid(crossTrackOffsets, alongTrackOffsets)
+    resultsCrossTrackShift = resultsCrossTrackShift.astype(float)
+    resultsAlongTrackShift = resultsAlongTrackShift.astype(float)
+    moveIndsX = (np.ravel(resultsCrossTrackShift)/rasterResolution).astype(int)
+    moveIndsY = (np.ravel(resultsAlongTrackShift)/rasterResolution).astype(int)
+    
+    if(fixedVerticalShift is not None):
+        resultsVerticalShift = np.full(numCombos, float(fixedVerticalShift))
+    else:
+        resultsVerticalShift = np.full(numCombos, np.nan)
+    # endIf
+    resultsMAE = np.full(numCombos, np.nan)
+    resultsRMSE = np.full(numCombos, np.nan)
+    resultsME = np.full(numCombos, np.nan)
+    
+    # NaN MEASURED cells never contribute to the nan-statistics
+    measZCommon = np.ravel(measZCommon)
+    measValid = np.logical_not(np.isnan(measZCommon))
+    measZ = measZCommon[measValid]
+    truthRows = np.ravel(truthRowsInit)[measValid]
+    truthCols = np.ravel(truthColsInit)[measValid]
+    numRows, numCols = np.shape(truthGrid)
+    truthFlat = np.ravel(truthGrid)
+    
+    numCells = len(measZ)
+    chunkSize = max(1, int(maxChunkElements/max(numCells, 1)))
+    for start in range(0, numCombos if numCells > 0 else 0, chunkSize):
+        
+        stop = min(start + chunkSize, numCombos)
+        
+        # Get new TRUTH data from shifted X,Y indices (y array is inverted)
+        colsCurrent = truthCols[np.newaxis,:] + moveIndsX[start:stop,np.newaxis]
+        rowsCurrent = truthRows[np.newaxis,:] - moveIndsY[start:stop,np.newaxis]
+        indsToKeep = (colsCurrent>=0) & (colsCurrent<numCols) & \
+                     (rowsCurrent>=0) & (rowsCurrent<numRows)
+        linInds = np.where(indsToKeep, rowsCurrent*numCols + colsCurrent, 0)
+        truthZCurr = truthFlat[linInds]
+        truthZCurr[np.logical_not(indsToKeep)] = np.nan
+        
+        # Determine vertical shift
+        if(fixedVerticalShift is not None):
+            
+            # Use defined vertical shift
+            verticalShift = np.full(stop - start, float(fixedVerticalShift))
+            
+        else:
+            
+            # MAE is tied to median error (RMSE to mean error); NaNs sort
+            # to the end of each row, so the median is taken from the
+            # first numValid values
+            zError = truthZCurr - measZ[np.newaxis,:]
+            numValid = np.sum(np.logical_not(np.isnan(zError)), axis = 1)
+            zError.sort(axis = 1)
+            rowInds = np.arange(stop - start)
+            lo = zError[rowInds, np.maximum((numValid - 1)//2, 0)]
+            hi = zError[rowInds, numValid//2]
+            verticalShift = (lo + hi)/2
+            verticalShift[numValid == 0] = np.nan
+            
+        # endIf
+        
+        # Apply vertical shift and get new Z error
+        measZShifted = measZ[np.newaxis,:] + verticalShift[:,np.newaxis]
+        zError = truthZCurr - measZShifted
+        
+        # Get Mean Absolute Error and RMSE (nanmean with one shared mask)
+        zValid = np.logical_not(np.isnan(zError))
+        numValid = np.sum(zValid, axis = 1)
+        zError[np.logical_not(zValid)] = 0
+        resultsVerticalShift[start:stop] = verticalShift
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            resultsMAE[start:stop] = np.sum(abs(zError), axis = 1)/numValid
+            resultsRMSE[start:stop] = np.sqrt(np.sum(zError**2, axis = 1)/
+                                              numValid)
+            resultsME[start:stop] = np.sum(zError, axis = 1)/numValid
+        # endWith
+        
+    # endFor
+    
+    # Populate NaN shifts with default values
+    shiftIsNan = np.isnan(resultsVerticalShift)
+    resultsMAE[shiftIsNan] = np.nan
+    resultsRMSE[shiftIsNan] = np.nan
+    resultsME[shiftIsNan] = np.nan
+    
+    shape = (numVertCombos, numHorzCombos)
+    return resultsCrossTrackShift, resultsAlongTrackShift, \
+        resultsVerticalShift.reshape(shape), resultsMAE.reshape(shape), \
+        resultsRMSE.reshape(shape), resultsME.reshape(shape)
+
+# endDef
+
 # Function to get ICESat-2 offsets relative to reference data
 def getMeasurementError(atlMeasuredData, atlTruthData, refHeightType, 
                         rotationData, outFilePath, 
@@ -146,6 +268,17 @@ def getMeasurementError(atlMeasuredData, atlTruthData, refHeightType,
             alongTrackMinBound = (np.fix(alongTrackBounds[0]/rasterResolutions[0])*rasterResolutions[0]).astype(int)
             alongTrackMaxBound = (np.fix((alongTrackBounds[-1])/rasterResolutions[0])*rasterResolutions[0]).astype(int)
             
+            # Format TRUTH data
+            truthXRotReduced = np.ravel(truthXRot)
+            truthYRotReduced = np.ravel(truthYRot)
+            truthZReduced = np.ravel(truthZ)
+            
+            # Bin MEASURED and TRUTH data once for all raster resolutions;
+            # each level is then block-summed from the base cells (None if 
+            # the resolutions have no common base cell, then grid per level)
+            measPyramid = getRasterPyramid(measXRot, measYRot, measZ, rasterResolutions, measT)
+            truthPyramid = getRasterPyramid(truthXRotReduced, truthYRotReduced, truthZReduced, rasterResolutions)
+            
             # Loop through all raster resolutions (multi-resolutional approach)
             totRasterResolutions = len(rasterResolutions)
             # for i in range(0,totRasterResolutions):
@@ -211,20 +344,30 @@ def getMeasurementError(atlMeasuredData, atlTruthData, refHeightType,
                 crossTrackOffsets = crossTrackOffsets.astype(int)
                 alongTrackOffsets = (np.flipud(alongTrackOffsets)).astype(int)
                 
-                # Format TRUTH data
-                truthXRotReduced = np.ravel(truthXRot)
-                truthYRotReduced = np.ravel(truthYRot)
-                truthZReduced = np.ravel(truthZ)
-                
                 # Rasterize MEASURED data
                 gridMethod = 'Mean'
                 fillValue = np.nan
                 writeLog('   Gridding ICESat-2 Data at %s m Resolution using %s Values...' % (rasterResolution, gridMethod), logFileID)
-                measRasterRot = getRaster(measXRot, measYRot, measZ, rasterResolution, gridMethod, fillValue, measT)
+                if(measPyramid is not None):
+                    measRasterRot = getPyramidRaster(measPyramid, rasterResolution, gridMethod, fillValue)
+                else:
+                    measRasterRot = getRaster(measXRot, measYRot, measZ, rasterResolution, gridMethod, fillValue, measT)
+                # endIf
                 
                 # Rasterize TRUTH data
                 writeLog('   Gridding Reference Data at %s m Resolution using %s Values...' % (rasterResolution, gridMethod), logFileID)
-                truthRasterRot = getRaster(truthXRotReduced, truthYRotReduced, truthZReduced, rasterResolution, gridMethod, fillValue)
+                if(truthPyramid is not None):
+                    # Only TRUTH cells the offset search can reach are needed:
+                    # the MEASURED raster grown by the largest offset
+                    xMargin = np.max(np.abs(crossTrackOffsets)) + rasterResolution
+                    yMargin = np.max(np.abs(alongTrackOffsets)) + rasterResolution
+                    truthXBounds = [np.min(measRasterRot.x) - xMargin, np.max(measRasterRot.x) + xMargin]
+                    truthYBounds = [np.min(measRasterRot.y) - yMargin, np.max(measRasterRot.y) + yMargin]
+                    truthRasterRot = getPyramidRaster(truthPyramid, rasterResolution, gridMethod, fillValue,
+                                                      truthXBounds, truthYBounds)
+                else:
+                    truthRasterRot = getRaster(truthXRotReduced, truthYRotReduced, truthZReduced, rasterResolution, gridMethod, fillValue)
+                # endIf
                 
                 # Find offsets with minimum MAE
                 writeLog('   Finding Offsets with Minimum MAE...', logFileID)
@@ -235,19 +378,9 @@ def getMeasurementError(atlMeasuredData, atlTruthData, refHeightType,
                 measRasterZ    = np.c_[np.ravel(measRasterRot.grid)]
                 measRasterT    = np.c_[np.ravel(measRasterRot.t)]
                 
-                # Store TRUTH data into array variables
-                truthRasterXRot = np.c_[np.ravel(truthRasterRot.x)]
-                truthRasterYRot = np.c_[np.ravel(truthRasterRot.y)]
-                truthRasterZ    = np.c_[np.ravel(truthRasterRot.grid)]
-    
-                # Create 2 column array of all MEASURED X,Y data
-                measXYall = np.column_stack([measRasterXRot, measRasterYRot])
-                
-                # Create 2 column array of all TRUTH X,Y data
-                truthXYall = np.column_stack([truthRasterXRot, truthRasterYRot])
-    
-                # Find common TRUTH and MEASURED indices
-                _, truthIndsCommon, measIndsCommon = getIntersection2d(truthXYall, measXYall, assume_unique=True)
+                # Find common TRUTH and MEASURED indices (both rasters share
+                # one lattice, so only their x,y axes are intersected)
+                _, truthIndsCommon, measIndsCommon = getIntersectionGrid(truthRasterRot, measRasterRot)
                 
                 # Only use MEASURED indices in common with TRUTH indices            
                 measRasterXRot_common = measRasterXRot[measIndsCommon]
@@ -265,95 +398,18 @@ def getMeasurementError(atlMeasuredData, atlTruthData, refHeightType,
                 truthMinYBounds = 0
                 truthMaxYBounds = np.shape(truthRasterRot.grid)[0]
                         
-                # Pre-allocate results data
-                numHorzCombos = np.size(crossTrackOffsets)
-                numVertCombos = np.size(alongTrackOffsets)
-                resultsCrossTrackShift = np.zeros((numVertCombos,numHorzCombos))
-                resultsAlongTrackShift = np.zeros((numVertCombos,numHorzCombos))
-                resultsVerticalShift = np.zeros((numVertCombos,numHorzCombos))
-                resultsMAE = np.zeros((numVertCombos,numHorzCombos))
-                resultsRMSE = np.zeros((numVertCombos,numHorzCombos))
-                resultsME = np.zeros((numVertCombos,numHorzCombos))
-                
-                # Loop through all combos and find min MAE
-                for I in range(0,numHorzCombos):
-                    for J in range(0,numVertCombos):
-                        
-                        # Get cross-track/along-track offset values
-                        crossTrackShift = crossTrackOffsets[I]
-                        alongTrackShift = alongTrackOffsets[J]
-                    
-                        # Get amount to shift X,Y indices
-                        moveIndsX = (crossTrackShift/rasterResolution).astype(int)
-                        moveIndsY = (alongTrackShift/rasterResolution).astype(int)
-                        
-                        # Get new TRUTH data from shifted X,Y indices
-                        truthColsCurrent = truthColsInit + moveIndsX
-                        truthRowsCurrent = truthRowsInit - moveIndsY # y array is inverted
-    
-                        # Determine indices in bounds
-                        colsToKeep = (truthColsCurrent>=truthMinXBounds) & (truthColsCurrent<truthMaxXBounds)
-                        rowsToKeep = (truthRowsCurrent>=truthMinYBounds) & (truthRowsCurrent<truthMaxYBounds)
-                        indsToKeep = colsToKeep & rowsToKeep
-                        
-                        # Get current TRUTH Z points
-                        truthColsCurrent = truthColsCurrent[indsToKeep]
-                        truthRowsCurrent = truthRowsCurrent[indsToKeep]
-                        truthRasterZCurr = np.c_[np.ravel(truthRasterRot.grid[truthRowsCurrent, truthColsCurrent])]
-                        
-                        # Get current MEASURED Z points
-                        measRasterZCurr = measRasterZ_common[indsToKeep]
-                        
-                        # Find Z error
-                        zError = truthRasterZCurr - measRasterZCurr
-                        
-                        # Determine vertical shift
-                        if(offsets.useVerticalShift == 1):
-                                
-                            # Use defined vertical shift
-                            verticalShift = offsets.verticalShift
-                                
-                        else:
-                                
-                            # MAE is tied to median error (RMSE to mean error)
-                            verticalShift = np.nanmedian(zError)
-                                
-                        # Endif
-                        
-                        if(np.logical_not(np.isnan(verticalShift))):
-                        
-                            # Apply vertical shift
-                            measRasterZShifted = measRasterZCurr + verticalShift
-                            
-                            # Get new Z error
-                            zError = truthRasterZCurr - measRasterZShifted
-                            
-                            # Get Mean Absolute Error and RMSE
-                            MAE = np.nanmean(abs(zError))
-                            RMSE = np.sqrt(np.nanmean(zError**2))
-                            ME = np.nanmean(zError)
-                        
-                        else:
-                        
-                            # Populate with default values
-                            verticalShift = np.nan
-                            MAE = np.nan
-                            RMSE = np.nan
-                            ME = np.nan
-                        
-                        # endIf
-                        
-                        # Store results
-                        resultsCrossTrackShift[J,I] = crossTrackShift
-                        resultsAlongTrackShift[J,I] = alongTrackShift
-                        resultsVerticalShift[J,I] = verticalShift
-                        resultsMAE[J,I] = MAE
-                        resultsRMSE[J,I] = RMSE
-                        resultsME[J,I] = ME
-                    
-                    # endFor
-                    
-                # endFor
+                # Compute MAE/RMSE/ME surfaces for all offsets at once
+                if(offsets.useVerticalShift == 1):
+                    fixedVerticalShift = offsets.verticalShift
+                else:
+                    fixedVerticalShift = None
+                # endIf
+                resultsCrossTrackShift, resultsAlongTrackShift, \
+                resultsVerticalShift, resultsMAE, resultsRMSE, resultsME = \
+                    getOffsetSurfaces(truthRasterRot.grid, truthRowsInit, 
+                                      truthColsInit, measRasterZ_common, 
+                                      crossTrackOffsets, alongTrackOffsets, 
+                                      rasterResolution, fixedVerticalShift)
             
     #            # TEST!!!
     #            # Set first/last rows/columns to NaN on first iteration to avoid choosing edge cases           
@@ -7,15 +7,9 @@ Created on Tue Oct 13 13:45:53 2020
 """
 import os
 import argparse
-import ctypes
 from shutil import copyfile    
-from numpy.ctypeslib import ndpointer 
 import pandas as pd
 import numpy as np
-try:
-    from scipy import stats
-except:
-    print('scipy.stats import failed')
 from scipy import interpolate
 import h5py
 import time
@@ -23,253 +17,7 @@ import time
 
 from icesatReader import get_atl03_struct
 from icesatReader import get_atl08_struct
-
-
-root = os.path.dirname(__file__)
-superFilterFile_windows = os.path.join(root,'closest_x64.dll')
-superFilterFile_linux = os.path.join(root,'phorealc.so')
-
-def indexMatch(measuredArray,truthArray):
-    A = np.array(measuredArray)
-    B = np.array(truthArray)
-    C = np.empty((len(B)))
-    
-    
-    if os.name == 'nt':
-        lib = ctypes.cdll.LoadLibrary(os.path.abspath(superFilterFile_windows))
-    else:
-        lib = ctypes.cdll.LoadLibrary(os.path.abspath(superFilterFile_linux))
-    fun = lib.cfun
-    fun.restype = None
-    fun.argtypes = [ndpointer(ctypes.c_double, flags="C_CONTIGUOUS"),
-            ctypes.c_size_t,
-            ndpointer(ctypes.c_double, flags="C_CONTIGUOUS"),
-            ndpointer(ctypes.c_double, flags="C_CONTIGUOUS"),
-            ctypes.c_size_t]
-    fun(A, A.size, B, C, B.size)
-    # print("Complete")
-    return np.array(C).astype(int)
-
-def get_max100(series):
-    try:
-        max98 = np.nanmax(series)
-    except:
-        max98 = np.nan
-    return max98
-
-def get_max98(series):
-    try:
-        max98 = np.percentile(series, 98)
-    except:
-        max98 = np.nan
-    return max98
-
-def get_max95(series):
-    try:
-        max95 = np.percentile(series, 95)
-    except:
-        max95 = np.nan
-    return max95
-
-def get_max90(series):
-    try:
-        max90 = np.percentile(series, 90)
-    except:
-        max90 = np.nan
-    return max90
-
-def get_max85(series):
-    try:
-        max85 = np.percentile(series, 85)
-    except:
-        max85 = np.nan
-    return max85
-
-def get_max80(series):
-    try:
-        max80 = np.percentile(series, 80)
-    except:
-        max80 = np.nan
-    return max80
-
-def get_max75(series):
-    try:
-        max75 = np.percentile(series, 75)
-    except:
-        max75 = np.nan
-    return max75
-
-def get_max70(series):
-    try:
-        max70 = np.percentile(series, 70)
-    except:
-        max70 = np.nan
-    return max70
-
-def get_max65(series):
-    try:
-        max65 = np.percentile(series, 65)
-    except:
-        max65 = np.nan
-    return max65
-
-def get_max60(series):
-    try:
-        max60 = np.percentile(series, 60)
-    except:
-        max60 = np.nan
-    return max60
-
-def get_max55(series):
-    try:
-        max55 = np.percentile(series, 55)
-    except:
-        max55 = np.nan
-    return max55
-
-def get_max50(series):
-    try:
-        max50 = np.percentile(series, 50)
-    except:
-        max50 = np.nan
-    return max50
-
-def get_max45(series):
-    try:
-        max45 = np.percentile(series, 45)
-    except:
-        max45 = np.nan
-    return max45
-
-def get_max40(series):
-    try:
-        max40 = np.percentile(series, 40)
-    except:
-        max40 = np.nan
-    return max40
-
-def get_max35(series):
-    try:
-        max35 = np.percentile(series, 35)
-    except:
-        max35 = np.nan
-    return max35
-
-def get_max30(series):
-    try:
-        max30 = np.percentile(series, 30)
-    except:
-        max30 = np.nan
-    return max30
-
-def get_max25(series):
-    try:
-        max25 = np.percentile(series, 25)
-    except:
-        max25 = np.nan
-    return max25
-
-def get_max20(series):
-    try:
-        max20 = np.percentile(series, 20)
-    except:
-        max20 = np.nan
-    return max20
-
-def get_max15(series):
-    try:
-        max15 = np.percentile(series, 15)
-    except:
-        max15 = np.nan
-    return max15
-
-def get_max10(series):
-    try:
-        max10 = np.percentile(series, 10)
-    except:
-        max10 = np.nan
-    return max10
-
-def get_max5(series):
-    try:
-        max5 = np.percentile(series, 5)
-    except:
-        max5 = np.nan
-    return max5
-
-def get_min(series):
-    try:
-        min0 = np.percentile(series, 0)
-    except:
-        min0 = np.nan
-    return min0
-
-def get_len(series):
-    try:
-        length = len(series)
-    except:
-        length = np.nan
-    return length
-
-def get_len_unique(series):
-    try:
-        length = len(np.unique(series))
-    except:
-        length = np.nan
-    return length
-
-def get_range(series):
-    try:
-        r = np.ptp(series)
-    except:
-        r = np.nan
-    return r
-
-def get_std(series):
-    try:
-        s = np.std(series)
-    except:
-        s = np.nan
-    return s
-
-def get_mode(series):
-    try:
-        mode = stats.mode(np.array(series))[0][0]
-    except:
-        mode = np.nan
-    return mode
-    
-def get_mean(series):
-    try:
-        m = np.mean(series)
-    except:
-        m = np.nan
-    return m
-
-def above_op(series):
-    q_list = [0,10,20,25,30,40,50,60,70,75,80,90,98,100]
-    try:
-        all_percent = [np.percentile(series, q_list)]
-    except:
-        # all_percent = np.nan
-        all_percent = np.array([np.nan, np.nan,np.nan,np.nan,np.nan,np.nan,
-                                np.nan,np.nan,np.nan,np.nan,np.nan,np.nan,
-                                np.nan,np.nan])
-    return all_percent
-
-def calculate_seg_meteric(df_in, df_out, classification, operation, field, 
-                          outfield, key_field = 'bin_id',
-                          classfield = 'classification'):
-    df_filter = df_in[df_in[classfield].isin(classification)]
-    zgroup = df_filter.groupby(key_field)
-    zout = zgroup.aggregate(operation)
-    zout[key_field] = zout.index
-    zout = zout.reset_index(drop = True)
-    # zout['segment_id_beg'] = zout['seg_id']
-    zout[outfield] = zout[field]
-    zout = zout.filter([outfield,key_field])
-    df_out = df_out.merge(zout, on=key_field,how='left')  
-    return df_out
+from icesatUtils import indexMatch
 
 def create_key_df(df, field, res):
     start = np.min(df[field])
@@ -278,17 +26,58 @@ def create_key_df(df, field, res):
     mid = beg + (res / 2)
     end = beg + (res)
     res_field = end - beg
-    key_df = pd.DataFrame(beg,columns=['beg_id'])
-    key_df = pd.concat([key_df,pd.DataFrame(mid
-                                        ,columns=['mid_id'])],axis=1)
-    key_df = pd.concat([key_df,pd.DataFrame(
-        end,columns=['end_id'])],axis=1)
-    key_df = pd.concat([key_df,pd.DataFrame(
-        res_field,columns=['res'])],axis=1)
-    key_df = pd.concat([key_df,pd.DataFrame(
-        mid,columns=['bin_id'])],axis=1)
+    key_df = pd.DataFrame({'beg_id': beg, 'mid_id': mid, 'end_id': end,
+                           'res': res_field, 'bin_id': mid})
     return key_df
 
+def nearest_sorted_index(target, values):
+    # Index of the closest target for each value (target sorted ascending):
+    # icesatUtils.indexMatch (ties go to the upper target) clipped to the
+    # last target.
+    minInd = indexMatch(target, values)
+    return np.minimum(minInd, max(len(target) - 1, 0))
+
+def match_keys(target_mid, values, res):
+    # Nearest key for every value and whether it lies within res / 2.
+    # Regular grids are binned arithmetically, irregular keys through
+    # nearest_sorted_index.
+    target_mid = np.asarray(target_mid, dtype = float)
+    values = np.asarray(values, dtype = float)
+    if len(target_mid) == 1:
+        minInd = np.zeros(len(values), dtype = int)
+    elif np.allclose(np.diff(target_mid), res):
+        beg = target_mid[0] - (res / 2)
+        minInd = np.floor((values - beg) / res).astype(int)
+        minInd = np.clip(minInd, 0, len(target_mid) - 1)
+    else:
+        minInd = nearest_sorted_index(target_mid, values)
+    diff = np.abs(target_mid[minInd] - values)
+    include = (diff <= (res / 2)).astype(float)
+    return minInd, include
+
+class StageTimer:
+    '''
+    Description
+    ----------
+    Instrumentation hook for multi-stage routines. Each call to stage()
+    records the wall time since the previous stage and passes it to the
+    optional callback, e.g. StageTimer(lambda stage, t: print(stage, t)).
+    '''
+
+    def __init__(self, callback = None):
+        self.callback = callback
+        self.times = {}
+        self._t = time.time()
+
+    def stage(self, name):
+        now = time.time()
+        elapsed = now - self._t
+        self.times[name] = self.times.get(name, 0) + elapsed
+        self._t = now
+        if self.callback is not None:
+            self.callback(name, elapsed)
+        return elapsed
+
 def get_target_keys(key_df, df, field, res = -1):
  
     if len(np.unique(key_df.res)) == 1:
@@ -297,31 +86,160 @@ def get_target_keys(key_df, df, field, res = -1):
         res = res
     else:
         res = key_df.res[0]
-    # res = 1
-    mid = np.array(df[field])
 
-    target_mid = np.array(key_df.mid_id)
-
-    minInd = indexMatch(target_mid, mid)
-    
-    datalen = len(target_mid)
-    minInd[minInd >= datalen] = (datalen - 1)
-    include = np.zeros(len(mid))
-    seg_at_comp = np.array([target_mid[x] for x in minInd])
-    # seg_id_truth = np.array([seg_id[x] for x in index])
-    diff = np.abs(seg_at_comp - mid)
-    
-    include[diff <= (res/2)] = 1    
-    
-    target_key = np.array(key_df.bin_id[minInd])
+    minInd, include = match_keys(key_df.mid_id, df[field], res)
+    target_key = np.asarray(key_df.bin_id)[minInd]
     
     return target_key, include
 
-def agg_keys(key_df, df, agg_list, key = 'bin_id'):
+class BinStats:
+    '''
+    Description
+    ----------
+    Single-pass bin statistics engine. Photons are sorted once per field by
+    (bin, value); a class filter is a boolean mask on that order, so each
+    bin is a contiguous, value-sorted segment and every statistic (counts,
+    percentiles, unique counts, moments, mode) is computed for all bins at
+    once from the segment boundaries.
+
+    Parameters
+    ----------
+    df : Pandas DF
+        Photons with a bin key column.
+    key : String
+        Name of the bin key column.
+    '''
+
+    def __init__(self, df, key = 'bin_id'):
+        self.df = df
+        self.key = key
+        self.keys = np.asarray(df[key])
+        self._order = {}
+        self._groups = {}
+
+    def groups(self, field, classfield, class_list):
+        cache_key = (field, classfield, tuple(class_list))
+        if cache_key in self._groups:
+            return self._groups[cache_key]
+        
+        # Sort by bin, then value, once per field
+        if field not in self._order:
+            values = np.asarray(self.df[field], dtype = float)
+            self._order[field] = np.lexsort((values, self.keys))
+        order = self._order[field]
+        
+        mask = np.isin(np.asarray(self.df[classfield])[order], class_list)
+        keys = self.keys[order][mask]
+        values = np.asarray(self.df[field], dtype = float)[order][mask]
+        if len(keys) > 0:
+            starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+            n_valid = np.add.reduceat((~np.isnan(values)).astype(int), starts)
+        else:
+            starts = np.zeros(0, dtype = int)
+            n_valid = np.zeros(0, dtype = int)
+        counts = np.diff(np.r_[starts, len(keys)])
+        group = {'bins': keys[starts], 'values': values, 'starts': starts,
+                 'counts': counts, 'n_valid': n_valid}
+        self._groups[cache_key] = group
+        return group
+
+    def percentiles(self, group, q_list):
+        # Linear interpolation between closest ranks, as np.percentile;
+        # bins holding NaN values return NaN
+        values = group['values']
+        starts = group['starts'][:, None]
+        pos = (np.asarray(q_list, dtype = float)[None, :] / 100.0) *\
+            (group['counts'][:, None] - 1)
+        lo = np.floor(pos).astype(int)
+        hi = np.ceil(pos).astype(int)
+        out = values[starts + lo] + (values[starts + hi] -
+                                     values[starts + lo]) * (pos - lo)
+        out[group['n_valid'] < group['counts']] = np.nan
+        return out
+
+    def operation(self, group, operation):
+        values = group['values']
+        starts = group['starts']
+        counts = group['counts']
+        if len(starts) == 0:
+            return np.zeros(0)
+        
+        if operation in ('count', 'len'):
+            return counts
+        elif operation == 'count_unique':
+            change = np.r_[True, (values[1:] != values[:-1]) &
+                           ~(np.isnan(values[1:]) & np.isnan(values[:-1]))]
+            change[starts] = True
+            return np.add.reduceat(change.astype(int), starts)
+        elif operation == 'max100':
+            # Ignores NaN like np.nanmax
+            out = np.full(len(starts), np.nan)
+            valid = group['n_valid'] > 0
+            out[valid] = values[starts[valid] + group['n_valid'][valid] - 1]
+            return out
+        elif operation == 'median':
+            return self.percentiles(group, [50])[:, 0]
+        elif operation == 'min':
+            return self.percentiles(group, [0])[:, 0]
+        elif operation == 'range':
+            out = self.percentiles(group, [0, 100])
+            return out[:, 1] - out[:, 0]
+        elif operation.startswith('max') and operation[3:].isdigit():
+            return self.percentiles(group, [int(operation[3:])])[:, 0]
+        elif operation in ('mean', 'std'):
+            # Ignores NaN like Series.mean/Series.std (ddof=0 via np.std)
+            n_valid = group['n_valid']
+            valid = ~np.isnan(values)
+            with np.errstate(invalid = 'ignore', divide = 'ignore'):
+                mean = np.add.reduceat(np.where(valid, values, 0), 
+                                       starts) / n_valid
+                if operation == 'mean':
+                    return mean
+                resid = np.where(valid, values - np.repeat(mean, counts), 0)
+                return np.sqrt(np.add.reduceat(resid * resid, starts) / 
+                               n_valid)
+        elif operation == 'mode':
+            # Longest run of equal values, smallest value on ties
+            run_start = np.r_[True, values[1:] != values[:-1]]
+            run_start[starts] = True
+            run_idx = np.flatnonzero(run_start)
+            run_len = np.diff(np.r_[run_idx, len(values)])
+            run_bin = np.repeat(np.arange(len(starts)), 
+                                np.diff(np.r_[np.searchsorted(run_idx, starts),
+                                              len(run_idx)]))
+            rank = run_bin * (run_len.max() + 1) + (run_len.max() - run_len)
+            best = np.argsort(rank, kind = 'stable')
+            first = np.r_[True, run_bin[best][1:] != run_bin[best][:-1]]
+            out = values[run_idx[best[first]]]
+            out[group['n_valid'] < counts] = np.nan
+            return out
+        else:
+            raise ValueError('Unknown aggregation operation: %s' % operation)
+
+
+def aggregate_bins(df, agg_list, key = 'bin_id'):
+    '''
+    Description
+    ----------
+    Compute every statistic of agg_list for all bins in one vectorized pass.
+    See get_bin_df for the agg_list format. Operations may be written with or
+    without a 'get_' prefix (e.g. 'get_max98', 'max98', 'count_unique').
+
+    Returns
+    -------
+    stats_df : Pandas DF
+        Wide DF with one row per bin holding photons, the key column and one
+        column per output field.
+    '''
+    bin_stats = BinStats(df, key = key)
+    columns = {}
+    
+    def stat(field, classfield, class_list, operation):
+        group = bin_stats.groups(field, classfield, class_list)
+        return pd.Series(bin_stats.operation(group, operation), 
+                         index = group['bins'])
+    
     for i in agg_list:
-        # print(i)
-        dt2 = time.time()
-       
         agg = i.split(';')
         if 'perfect' in agg[2]:
             c = 'perfect_class'
@@ -336,175 +254,43 @@ def agg_keys(key_df, df, agg_list, key = 'bin_id'):
         if len(class_list_str) > 0:
             for j in range(0,len(class_list_str)):
                 class_list.append(int(class_list_str[j]))
-        if 'median' in agg[3]:
-            key_df = calculate_seg_meteric(df, key_df, class_list, 
-                                             np.median,agg[2],agg[1], 
-                                             key_field = key,
-                                             classfield = c)
-        elif 'count' in agg[3]:
-            key_df = calculate_seg_meteric(df, key_df, class_list, 
-                         np.size,agg[2],agg[1], key_field = key,
-                                             classfield = c)
-        elif 'count_unique' in agg[3]:
-            key_df = calculate_seg_meteric(df, key_df, class_list, 
-                         get_len_unique,agg[2],agg[1], key_field = key,
-                                             classfield = c)
-        elif 'range' in agg[3]:
-            key_df = calculate_seg_meteric(df, key_df, class_list, 
-                         np.ptp,agg[2],agg[1], key_field = key,
-                                             classfield = c)
-        elif 'max100' in agg[3]:
-            key_df = calculate_seg_meteric(df, key_df, class_list, 
-                         get_max100,agg[2],agg[1], key_field = key,
-                                             classfield = c)
-        elif 'max98' in agg[3]:
-            key_df = calculate_seg_meteric(df, key_df, class_list, 
-                         get_max98,agg[2],agg[1], key_field = key,
-                                             classfield = c)
-        elif 'max95' in agg[3]:
-            key_df = calculate_seg_meteric(df, key_df, class_list, 
-                         get_max95,agg[2],agg[1], key_field = key,
-                                             classfield = c)
-        elif 'max90' in agg[3]:
-            key_df = calculate_seg_meteric(df, key_df, class_list, 
-                         get_max90,agg[2],agg[1], key_field = key,
-                                             classfield = c)
-        elif 'max85' in agg[3]:
-            key_df = calculate_seg_meteric(df, key_df, class_list, 
-                         get_max85,agg[2],agg[1], key_field = key,
-                                             classfield = c)
-        elif 'max80' in agg[3]:
-            key_df = calculate_seg_meteric(df, key_df, class_list, 
-                         get_max95,agg[2],agg[1], key_field = key,
-                                             classfield = c)
-        elif 'max75' in agg[3]:
-            key_df = calculate_seg_meteric(df, key_df, class_list, 
-                         get_max75,agg[2],agg[1], key_field = key,
-                                             classfield = c)
-        elif 'max70' in agg[3]:
-            key_df = calculate_seg_meteric(df, key_df, class_list, 
-                         get_max70,agg[2],agg[1], key_field = key,
-                                             classfield = c)
-        elif 'max65' in agg[3]:
-            key_df = calculate_seg_meteric(df, key_df, class_list, 
-                         get_max65,agg[2],agg[1], key_field = key,
-                                             classfield = c)
-        elif 'max60' in agg[3]:
-            key_df = calculate_seg_meteric(df, key_df, class_list, 
-                         get_max60,agg[2],agg[1], key_field = key,
-                                             classfield = c)
-        elif 'max55' in agg[3]:
-            key_df = calculate_seg_meteric(df, key_df, class_list, 
-                         get_max55,agg[2],agg[1], key_field = key,
-                                             classfield = c)
-        elif 'max50' in agg[3]:
-            key_df = calculate_seg_meteric(df, key_df, class_list, 
-                         get_max50,agg[2],agg[1], key_field = key,
-                                             classfield = c)
-        elif 'max45' in agg[3]:
-            key_df = calculate_seg_meteric(df, key_df, class_list, 
-                         get_max45,agg[2],agg[1], key_field = key,
-                                             classfield = c)
-        elif 'max40' in agg[3]:
-            key_df = calculate_seg_meteric(df, key_df, class_list, 
-                         get_max40,agg[2],agg[1], key_field = key,
-                                             classfield = c)
-        elif 'max35' in agg[3]:
-            key_df = calculate_seg_meteric(df, key_df, class_list, 
-                         get_max35,agg[2],agg[1], key_field = key,
-                                             classfield = c)
-        elif 'max30' in agg[3]:
-            key_df = calculate_seg_meteric(df, key_df, class_list, 
-                         get_max30,agg[2],agg[1], key_field = key,
-                                             classfield = c)
-        elif 'max25' in agg[3]:
-            key_df = calculate_seg_meteric(df, key_df, class_list, 
-                        get_max25,agg[2],agg[1], key_field = key,
-                                             classfield = c)
-        elif 'max20' in agg[3]:
-            key_df = calculate_seg_meteric(df, key_df, class_list, 
-                         get_max20,agg[2],agg[1], key_field = key,
-                                             classfield = c)
-        elif 'max15' in agg[3]:
-            key_df = calculate_seg_meteric(df, key_df, class_list, 
-                        get_max15,agg[2],agg[1], key_field = key,
-                                             classfield = c)
-        elif 'max10' in agg[3]:
-            key_df = calculate_seg_meteric(df, key_df, class_list, 
-                         get_max10,agg[2],agg[1], key_field = key,
-                                             classfield = c)
-        elif 'max5' in agg[3]:
-            key_df = calculate_seg_meteric(df, key_df, class_list, 
-                        get_max5,agg[2],agg[1], key_field = key,
-                                             classfield = c)
-        elif 'min' in agg[3]:
-            key_df = calculate_seg_meteric(df, key_df, class_list, 
-                         get_min,agg[2],agg[1], key_field = key,
-                                             classfield = c)
-        elif 'mode' in agg[3]:
-            key_df = calculate_seg_meteric(df, key_df, class_list, 
-                          get_mode,agg[2],agg[1], key_field = key,
-                                              classfield = c)        
-        elif 'std' in agg[3]:
-            key_df = calculate_seg_meteric(df, key_df, class_list, 
-                         get_std,agg[2],agg[1], key_field = key,
-                                             classfield = c) 
-        elif 'mean' in agg[3]:
-            key_df = calculate_seg_meteric(df, key_df, class_list, 
-                         get_mean,agg[2],agg[1], key_field = key,
-                                             classfield = c)
-        elif 'get_len' in agg[3]:
-            key_df = calculate_seg_meteric(df, key_df, class_list, 
-                         get_len,agg[2],agg[1], key_field = key,
-                                             classfield = c)
-        elif 'rh_canopy' in agg[3]:
-            key_df = calculate_seg_meteric(df, key_df, [1], 
-                         np.median,agg[2],'ground', key_field = key,
-                                             classfield = c) 
-            key_df = calculate_seg_meteric(df, key_df, [2,3], 
-                         np.median,agg[2],'canopy', key_field = key,
-                                             classfield = c) 
-            key_df[agg[1]] = key_df.canopy - key_df.ground
-            key_df[agg[1]][key_df[agg[1]] < 0] = 0
-            key_df[agg[1]][key_df[agg[1]] > 130] = np.nan
-            key_df = key_df.drop(columns=['ground','canopy'])
-        elif 'radiometry' in agg[3]:
-            
-            key_df = calculate_seg_meteric(df, key_df, [-1,0,1,2,3], 
-                         get_len_unique,agg[2],'unique_time', key_field = key,
-                                             classfield = c) 
-            key_df = calculate_seg_meteric(df, key_df, class_list, 
-                         np.size,agg[2],'target_time', key_field = key,
-                                             classfield = c) 
-            t = np.asarray(key_df.target_time)
-            a = np.asarray(key_df.unique_time)
-            key_df[agg[1]] = np.divide(t,a,out=np.zeros_like(t),where=a!=0)
-            key_df = key_df.drop(columns=['unique_time','target_time'])
-        elif 'above_percentile' in agg[3]:
-            d3 = time.time()
+        
+        operation = agg[3]
+        if operation.startswith('get_'):
+            operation = operation[4:]
+        
+        if operation == 'rh_canopy':
+            ground = stat(agg[2], c, [1], 'median')
+            canopy = stat(agg[2], c, [2,3], 'median')
+            rh = canopy.sub(ground)
+            rh[rh < 0] = 0
+            rh[rh > 130] = np.nan
+            columns[agg[1]] = rh
+        elif operation == 'radiometry':
+            unique_time = stat(agg[2], c, [-1,0,1,2,3], 'count_unique')
+            target_time = stat(agg[2], c, class_list, 'count')
+            columns[agg[1]] = target_time.div(unique_time)
+        elif operation == 'above_percentile':
             q_list = [10,20,25,30,40,50,60,70,75,80,90,98,100]
-            df_filter = df[df[c].isin(class_list)]
-            zgroup = df_filter.groupby(key)
-            zout = zgroup.aggregate(above_op)
-            zout[key] = zout.index
-            zout = zout.reset_index(drop = True)
-            field = agg[2]
-            outfield = 'outfield'
-            # zout['segment_id_beg'] = zout['seg_id']
-            zout[outfield] = zout[field]
-            zout = zout.filter([outfield,key])
-            print(zout.outfield[0][0])
-            print(time.time() - d3)
-            for i in range(0,len(q_list)):
-                arr = []
-                for j in range(0,len(zout.outfield)):
-                    arr.append(zout.outfield[j][0][i])
-                title = agg[1] + str(q_list[i])
-                print(title)
-                zout[title] = np.array(arr)
-            zout.drop(columns=['outfield'], inplace=True)
-            key_df = key_df.merge(zout, on=key,how='left')  
-        # print(time.time() - dt2)
+            group = bin_stats.groups(agg[2], c, class_list)
+            out = bin_stats.percentiles(group, q_list)
+            for k in range(0,len(q_list)):
+                columns[agg[1] + str(q_list[k])] = pd.Series(
+                    out[:, k], index = group['bins'])
+        else:
+            try:
+                columns[agg[1]] = stat(agg[2], c, class_list, operation)
+            except ValueError:
+                print('Unknown aggregation, skipping: %s' % i)
+    
+    stats_df = pd.DataFrame(columns)
+    stats_df.insert(0, key, stats_df.index.values)
+    stats_df = stats_df.reset_index(drop = True)
+    return stats_df
+
+def agg_keys(key_df, df, agg_list, key = 'bin_id'):
+    stats_df = aggregate_bins(df, agg_list, key = key)
+    key_df = key_df.merge(stats_df, on=key, how='left')
     return key_df
 
 def orient_df(df, field):
@@ -545,8 +331,8 @@ def get_bin_df(df, unit, res, agg_list):
     key_df = create_key_df(df, unit, res)
     target_key, include = get_target_keys(key_df, df, unit)
     df = df.reset_index(drop = True)
-    df = pd.concat([df,pd.DataFrame(target_key,columns=['bin_id'])],axis=1)
-    df = pd.concat([df,pd.DataFrame(include,columns=['include'])],axis=1)
+    df['bin_id'] = target_key
+    df['include'] = include
     df = df[df.include == 1]
     df_bin = agg_keys(key_df, df, agg_list, key = 'bin_id')
     return df_bin
@@ -609,10 +395,11 @@ def compute_rh(canopy, ground):
     rh[canopy.isnull() & ground.isnull()] = np.nan
     return rh
 
-def create_atl08_bin(atl03, atl08, res_at = 30):
-    import time
+def create_atl08_bin(atl03, atl08, res_at = 30, timer = None):
+    # timer: optional StageTimer receiving the time spent in each stage
+    if timer is None:
+        timer = StageTimer()
     #Create Key DF based on ATL08
-    dt = time.time()
     atl03_df = orient_df(atl03.df, 'alongtrack')
     atl08_df = orient_df(atl08.df, 'alongtrack')
     
@@ -623,34 +410,22 @@ def create_atl08_bin(atl03, atl08, res_at = 30):
                'longitude','segment_id_beg','segment_id_end']
     
     for domain in domain_list:
-        domain_interp = interpolate_domain(atl08_df.alongtrack, 
-                                           atl08_df[domain], key_df.bin_id)
-        key_df = pd.concat([key_df,pd.DataFrame(domain_interp,
-                                                columns=[domain])],axis=1)
+        key_df[domain] = interpolate_domain(atl08_df.alongtrack, 
+                                            atl08_df[domain], key_df.bin_id)
 
-    key_id = key_df.bin_id
-    atl08_id = atl08_df.alongtrack
-    print('Part1')
-    print(time.time() - dt)
-    dt = time.time()
+    key_id = np.asarray(key_df.bin_id)
+    atl08_id = np.asarray(atl08_df.alongtrack)
+    timer.stage('key_df')
 
-    
-    minInd = indexMatch(atl08_id,key_id)
+    # Nearest ATL08 segment of each bin
+    minInd = nearest_sorted_index(atl08_id, key_id)
     res = res_at
-    datalen = len(atl08_id)
-    minInd[minInd >= datalen] = (datalen - 1)
-    include = np.zeros(len(key_id))
-    seg_at_comp = np.array([atl08_id[x] for x in minInd])
-    diff = np.abs(seg_at_comp - key_id)
-    
-    include[diff <= (res)] = 1  
+    diff = np.abs(atl08_id[minInd] - key_id)
+    include = (diff <= (res)).astype(float)
     
     atl08_df = atl08_df.loc[minInd]
     atl08_df = atl08_df.drop(columns = domain_list)
-
-    print('Part2')
-    print(time.time() - dt)
-    dt = time.time()
+    timer.stage('atl08_match')
 
     df_bin_08 = pd.concat([key_df.reset_index(drop=True),
                      atl08_df.reset_index(drop=True)], axis=1)
@@ -660,10 +435,6 @@ def create_atl08_bin(atl03, atl08, res_at = 30):
     
     #Compute the ATL03 
     
-    print(time.time() - dt)
-    dt = time.time()
-    print('Part3')
-    
     agg_list = ['atl03;atl03_ground_median;h_ph;median;[1]',
             'atl03;atl03_canopy_h;h_ph;get_max98;[2,3]',                
             'atl03;gedi_rh_;h_ph;above_percentile;[1,2,3]',
@@ -678,25 +449,13 @@ def create_atl08_bin(atl03, atl08, res_at = 30):
     
     target_key, include = get_target_keys(key_df, atl03_df, 'alongtrack')
     atl03_df = atl03_df.reset_index(drop = True)
-    atl03_df = pd.concat([atl03_df,pd.DataFrame(target_key,columns=['bin_id'])],axis=1)
-    atl03_df = pd.concat([atl03_df,pd.DataFrame(include,columns=['include'])],axis=1)
+    atl03_df['bin_id'] = target_key
+    atl03_df['include'] = include
     atl03_df = atl03_df[atl03_df.include == 1]
-    
-    print(time.time() - dt)
-    dt = time.time()
-    print('Part4a')
+    timer.stage('atl03_keys')
         
     df_bin_03 = agg_keys(key_df, atl03_df, agg_list, key = 'bin_id')
-
-    print(time.time() - dt)
-    dt = time.time()
-    print('Part4b')
-
-    atl03_df = pd.concat([atl03_df,pd.DataFrame(target_key,columns=['bin_id'])],axis=1)
-
-    print(time.time() - dt)
-    dt = time.time()
-    print('Part5')
+    timer.stage('atl03_agg')
     
     df_bin_03.drop(df_bin_03.columns.difference(['bin_id','atl03_ground_median',
                                                  'atl03_canopy_h',
@@ -717,11 +476,7 @@ def create_atl08_bin(atl03, atl08, res_at = 30):
                                          'atl03_n_canopy','atl03_n_hi_canopy'
                                          ]),
                    1,inplace=True)
-        
-    print(time.time() - dt)
-    dt = time.time()
-    print('Part6')
-    
+
     df_bin = pd.merge(df_bin_08, df_bin_03, on="bin_id",how='left')       
     
     df_bin['gedi_rh_100'] = compute_rh(df_bin['gedi_rh_100'], 
@@ -780,9 +535,7 @@ def create_atl08_bin(atl03, atl08, res_at = 30):
         df_bin['atl03_n_hi_canopy']) / (df_bin['atl03_n_canopy'] +\
                         df_bin['atl03_n_hi_canopy'] + df_bin['atl03_n_ground'])
 
-    print('Part7')
-    print(time.time() - dt)
-    dt = time.time()
+    timer.stage('merge_rh')
                                         
     # df_bin.drop(columns = ['beg_id', 'mid_id', 'end_id', 'res','bin_id',
     #                        'time','easting','northing','crosstrack',
@@ -790,17 +543,15 @@ def create_atl08_bin(atl03, atl08, res_at = 30):
     
     df_bin.drop(columns = ['beg_id', 'mid_id', 'end_id'],
                 axis = 1, inplace = True)
-
-    print('Part8')
-    print(time.time() - dt)
-    dt = time.time()
+    timer.stage('finalize')
     
     return df_bin
 
-def create_truth_bin(df_truth, atl08, res_at = 30):
-    import time
+def create_truth_bin(df_truth, atl08, res_at = 30, timer = None):
+    # timer: optional StageTimer receiving the time spent in each stage
+    if timer is None:
+        timer = StageTimer()
     #Create Key DF based on ATL08
-    dt = time.time()
     df_truth = orient_df(df_truth, 'alongtrack')
     atl08_df = orient_df(atl08.df, 'alongtrack')
     
@@ -811,33 +562,22 @@ def create_truth_bin(df_truth, atl08, res_at = 30):
                'longitude','segment_id_beg','segment_id_end','crosstrack']
     
     for domain in domain_list:
-        domain_interp = interpolate_domain(atl08_df.alongtrack, 
-                                           atl08_df[domain], key_df.bin_id)
-        key_df = pd.concat([key_df,pd.DataFrame(domain_interp,
-                                                columns=[domain])],axis=1)
+        key_df[domain] = interpolate_domain(atl08_df.alongtrack, 
+                                            atl08_df[domain], key_df.bin_id)
 
-    key_id = key_df.bin_id
-    atl08_id = atl08_df.alongtrack
+    key_id = np.asarray(key_df.bin_id)
+    atl08_id = np.asarray(atl08_df.alongtrack)
+    timer.stage('key_df')
 
-    print(dt - time.time())
-    dt = time.time()
-
-    
-    minInd = indexMatch(atl08_id,key_id)
+    # Nearest ATL08 segment of each bin
+    minInd = nearest_sorted_index(atl08_id, key_id)
     res = res_at
-    datalen = len(atl08_id)
-    minInd[minInd >= datalen] = (datalen - 1)
-    include = np.zeros(len(key_id))
-    seg_at_comp = np.array([atl08_id[x] for x in minInd])
-    diff = np.abs(seg_at_comp - key_id)
-    
-    include[diff <= (res)] = 1  
+    diff = np.abs(atl08_id[minInd] - key_id)
+    include = (diff <= (res)).astype(float)
     
     atl08_df = atl08_df.loc[minInd]
     atl08_df = atl08_df.drop(columns = domain_list)
-
-    print(dt - time.time())
-    dt = time.time()
+    timer.stage('atl08_match')
 
     df_bin_08 = pd.concat([key_df.reset_index(drop=True),
                      atl08_df.reset_index(drop=True)], axis=1)
@@ -847,10 +587,6 @@ def create_truth_bin(df_truth, atl08, res_at = 30):
     
     #Compute the ATL03 
     
-    print(dt - time.time())
-    dt = time.time()
-    print('part4')
-    
     agg_list = ['truth;truth_ground_median;z;median;[2]',
             'truth;truth_canopy_max98;z;get_max98;[4]',
             'atl03;gedi_rh_;z;above_percentile;[2,4]',
@@ -860,21 +596,13 @@ def create_truth_bin(df_truth, atl08, res_at = 30):
     
     target_key, include = get_target_keys(key_df, df_truth, 'alongtrack')
     df_truth = df_truth.reset_index(drop = True)
-    df_truth = pd.concat([df_truth,pd.DataFrame(target_key,columns=['bin_id'])],axis=1)
-    df_truth = pd.concat([df_truth,pd.DataFrame(include,columns=['include'])],axis=1)
+    df_truth['bin_id'] = target_key
+    df_truth['include'] = include
     df_truth = df_truth[df_truth.include == 1]
-    
-    print(dt - time.time())
-    dt = time.time()
-    print('part5')
+    timer.stage('truth_keys')
         
     df_bin_truth = agg_keys(key_df, df_truth, agg_list, key = 'bin_id')
-    
-    df_truth = pd.concat([df_truth,pd.DataFrame(target_key,columns=['bin_id'])],axis=1)
-
-    print(dt - time.time())
-    dt = time.time()
-    print('part6')
+    timer.stage('truth_agg')
     
     df_bin_truth.drop(df_bin_truth.columns.difference(['bin_id','truth_ground_median',
                                          'truth_canopy_max98',
@@ -952,11 +680,8 @@ def create_truth_bin(df_truth, atl08, res_at = 30):
         (df_bin_truth['truth_n_canopy'] + df_bin_truth['truth_n_ground'])
 
 
-    print(dt - time.time())
-    dt = time.time()
-    print('part6')
-    
     df_bin_truth = pd.merge(df_bin_08, df_bin_truth, on="bin_id",how='left')       
+    timer.stage('merge_rh')
     
     return df_bin_truth
 
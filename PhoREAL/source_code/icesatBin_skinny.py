@@ -6,37 +6,10 @@ Created on Tue Oct 13 13:45:53 2020
 @author: eguenther
 """
 import os
-import ctypes
-from numpy.ctypeslib import ndpointer 
 import pandas as pd
 import numpy as np
 
-root = os.path.dirname(__file__)
-superFilterFile_windows = os.path.join(root,'closest_x64.dll')
-superFilterFile_linux = os.path.join(root,'phorealc.so')
-
-
-def indexMatch(measuredArray,truthArray):
-    # print("Match corresponding indices...", end = " ")
-    A = np.array(measuredArray)
-    B = np.array(truthArray)
-    C = np.empty((len(B)))
-    
-    
-    if os.name == 'nt':
-        lib = ctypes.cdll.LoadLibrary(os.path.abspath(superFilterFile_windows))
-    else:
-        lib = ctypes.cdll.LoadLibrary(os.path.abspath(superFilterFile_linux))
-    fun = lib.cfun
-    fun.restype = None
-    fun.argtypes = [ndpointer(ctypes.c_double, flags="C_CONTIGUOUS"),
-            ctypes.c_size_t,
-            ndpointer(ctypes.c_double, flags="C_CONTIGUOUS"),
-            ndpointer(ctypes.c_double, flags="C_CONTIGUOUS"),
-            ctypes.c_size_t]
-    fun(A, A.size, B, C, B.size)
-    # print("Complete")
-    return np.array(C).astype(int)
+from icesatUtils import indexMatch
 
 def get_max100(series):
     try:
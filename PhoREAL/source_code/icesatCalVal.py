@@ -94,9 +94,44 @@ def includeFilter(sortedMeasured, superTruth):
 
 
 
+#Get KD-tree over truth along-track/z for the given classes
+#(build once per swath and pass to perfectClassifier as truthTree to reuse)
+def getTruthTree(superTruth, classes):
+    truthy = superTruth.alongTrack
+    truthz = superTruth.z
+    truthc = superTruth.classification
+    
+    # Build compiled tree from contiguous (n,2) array
+    classfilt = np.isin(truthc.ravel(), np.ravel(classes))
+    pts = np.column_stack((truthy.ravel()[classfilt], 
+                           truthz.ravel()[classfilt])).astype(np.float64)
+    tree = spatial.cKDTree(pts)
+    tc = truthc.ravel()[classfilt]
+    
+    return tree, tc
+
+#Query KD-tree with all available cores
+def queryTree(tree, pts, distance_upper_bound=np.inf):
+    try:
+        dist, index = tree.query(pts, distance_upper_bound=distance_upper_bound,
+                                 workers=-1)
+    except TypeError:
+        # Older scipy (< 1.6)
+        dist, index = tree.query(pts, distance_upper_bound=distance_upper_bound,
+                                 n_jobs=-1)
+    return dist, index
+
+#Get first index where arr > val (arr is usually sorted along-track)
+def getFirstIndexAbove(arr, val):
+    if np.all(arr[1:] >= arr[:-1]):
+        return int(np.searchsorted(arr, val, side='right'))
+    else:
+        return int(np.argmax(arr > val))
+
 #Perfect Classifier
 def perfectClassifier(sortedMeasured, superTruth,ground = [2],canopy = [4], 
-                      unclassed = [1, 6, 7, 18], keepsize = True):
+                      unclassed = [1, 6, 7, 18], keepsize = True,
+                      truthTree = None):
     # Find max/min along track
     print('Run Perfect Classifier')
     maxy = np.max(superTruth.alongTrack.ravel())
@@ -114,11 +149,11 @@ def perfectClassifier(sortedMeasured, superTruth,ground = [2],canopy = [4],
     # Calculate filter offsets for later
     if keepsize == True:
         if np.min(measy) < miny:
-            minmeasindex = next(x for x, val in enumerate(measy) if val > miny)
+            minmeasindex = getFirstIndexAbove(measy, miny)
         else:
             minmeasindex = 0
         if np.max(measy) > maxy:
-            maxmeasindex = next(x for x, val in enumerate(measy) if val > maxy)
+            maxmeasindex = getFirstIndexAbove(measy, maxy)
         else:
             maxmeasindex = 0
 #        if (minmeasindex == 0) and (maxmeasindex == 0):
@@ -133,25 +168,22 @@ def perfectClassifier(sortedMeasured, superTruth,ground = [2],canopy = [4],
     measyfilt = measy[measfilt]
     measzfilt = measz[measfilt]
     meascfilt = measc[measfilt]
-    classfilt = [np.isin(superTruth.classification,ground) | np.isin(superTruth.classification,canopy)]
-    ty = superTruth.alongTrack[classfilt]
-    tz = superTruth.z[classfilt]
-    tc = superTruth.classification[classfilt]
-    #Create KDtree and then query the tree
-    pts = np.vstack((measyfilt,measzfilt)).T
+    #Create (or reuse) KDtree and then query the tree
+    pts = np.column_stack((measyfilt,measzfilt)).astype(np.float64)
     print('    Building KDtree')
-    tree = spatial.KDTree(list(zip(ty.ravel(), tz.ravel())))
+    if truthTree is None:
+        truthTree = getTruthTree(superTruth, np.append(ground, canopy))
+    tree, tc = truthTree
     print('    Querying KDtree')
-    dist, index = tree.query(pts)
-    
-    # Pre-populate all photon classed array with zeroes
-    measpc = np.zeros(len(index))
-    measpc = measpc - 1
+    maxdist = 1.5
+    dist, index = queryTree(tree, pts, 
+                            distance_upper_bound=np.nextafter(maxdist, np.inf))
     
     # Populate all photon classed array from ATL08 classifications
-    measpc = tc[index]
-
-    measpc[dist > 1.5] = 0
+    # (photons with no truth point within maxdist get 0)
+    nearTF = dist <= maxdist
+    measpc = np.zeros(len(index), dtype=tc.dtype)
+    measpc[nearTF] = tc[index[nearTF]]
 
     # Reclass everything to generic classes
     measpc[np.isin(measpc,unclassed)] = 0
@@ -32,6 +32,7 @@ import socket
 import shutil
 import pandas as pd
 import rasterio
+from rasterio.windows import Window
 try:
   import laspy
   from laspy.file import File
@@ -55,6 +56,15 @@ except ImportError:
                 'createShapefiles']
   print('warning: module osgeo not found')
   print('affected functions:', osgeo_func)
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pyarrow.feather as feather
+except ImportError:
+  pyarrow_func = ['writeArrayToColumnar', 'readColumnarFile']
+  print('warning: module pyarrow not found')
+  print('affected functions:', pyarrow_func)
+# endTry
 try:
     from gdalconst import GA_ReadOnly
 except ImportError:
@@ -286,6 +296,113 @@ class atlTruthStruct:
         
     # endDef
 # endClass
+
+# Truth accumulator class (collects atlTruthStruct chunks, joins them once)
+class atlTruthAccumulator:
+    
+    # Column names and compact dtypes for getColumns
+    columnDtypes = [('easting', np.float64), ('northing', np.float64), 
+                    ('crossTrack', np.float64), ('alongTrack', np.float64), 
+                    ('lat', np.float64), ('lon', np.float64), 
+                    ('z', np.float32), ('classification', np.uint8), 
+                    ('intensity', np.uint16), ('time', np.float64), 
+                    ('deltaTime', np.float64)]
+    
+    # Define class with designated fields
+    def __init__(self, zone=[], hemi=[], epsg=False):
+        
+        self.chunks = {name: [] for name, _ in self.columnDtypes}
+        self.zone = zone
+        self.hemi = hemi
+        self.epsg = epsg
+        self.truthStruct = None
+        self.columns = None
+    # endDef
+    
+    # Define append method (same call as atlTruthStruct.append)
+    def append(self, newClass):
+        
+        for name, _ in self.columnDtypes:
+            self.chunks[name].append(np.ravel(getattr(newClass, name)))
+        # endFor
+        self.zone = newClass.zone
+        self.hemi = newClass.hemi
+        self.epsg = newClass.epsg
+        self.truthStruct = None
+        self.columns = None
+        
+    # endDef
+    
+    # Define length method (number of points collected)
+    def __len__(self):
+        
+        return int(sum(len(chunk) for chunk in self.chunks['easting']))
+    
+    # endDef
+    
+    # Define method to get 1-D columns in compact dtypes
+    def getColumns(self):
+        
+        if(self.columns is None):
+            self.columns = {}
+            for name, dtype in self.columnDtypes:
+                if(len(self.chunks[name])>0):
+                    self.columns[name] = np.concatenate(self.chunks[name]).astype(dtype, copy=False)
+                else:
+                    self.columns[name] = np.zeros(0, dtype=dtype)
+                # endIf
+            # endFor
+        # endIf
+        
+        return self.columns
+    
+    # endDef
+    
+    # Define method to get legacy atlTruthStruct ((n,1) float columns)
+    def getTruthStruct(self):
+        
+        if(self.truthStruct is None):
+            
+            # Join each column once (dtypes as atlTruthStruct.append gives)
+            cols = {}
+            for name, _ in self.columnDtypes:
+                chunks = self.chunks[name]
+                dtype = np.result_type(np.float64, *[chunk.dtype for chunk in chunks])
+                if(len(chunks)>0):
+                    cols[name] = np.concatenate(chunks).astype(dtype, copy=False)
+                else:
+                    cols[name] = np.zeros(0, dtype=dtype)
+                # endIf
+            # endFor
+            
+            self.truthStruct = atlTruthStruct(cols['easting'], cols['northing'], 
+                                              cols['crossTrack'], cols['alongTrack'], 
+                                              cols['lat'], cols['lon'], cols['z'], 
+                                              cols['classification'], 
+                                              cols['intensity'], 
+                                              self.zone, self.hemi, self.epsg)
+            self.truthStruct.time = np.c_[cols['time']]
+            self.truthStruct.deltaTime = np.c_[cols['deltaTime']]
+            
+        # endIf
+        
+        return self.truthStruct
+    
+    # endDef
+# endClass
+
+# Object for getSwathMask function
+class swathMaskStruct:
+    
+    # Define class with designated fields
+    def __init__(self, xCell0, yCell0, cellSize, mask):
+        
+        self.xCell0 = xCell0
+        self.yCell0 = yCell0
+        self.cellSize = cellSize
+        self.mask = mask
+    # endDef
+# endClass
         
 class offsetsStruct:
     
@@ -483,15 +600,19 @@ def readHeaderMatFile(headerFilePath):
         crs_mode = pyproj.CRS.from_proj4(proj4_mode)
         epsg_mode = crs_mode.to_epsg()
 
-        for k, proj4 in enumerate(proj4_all):
-            crs_las = pyproj.CRS.from_proj4(proj4)
-            epsg_las = crs_las.to_epsg()
+        # Resolve each distinct proj4 string once, then transform all
+        # tiles of one EPSG code together
+        proj4_unique, proj4_inv = np.unique(proj4_all, return_inverse=True)
+        epsg_unique = np.array([int(pyproj.CRS.from_proj4(str(proj4)).to_epsg())
+                                for proj4 in proj4_unique])
+        epsg_las_v = epsg_unique[proj4_inv.reshape(-1)]
 
-            epsg_in = int(epsg_las)
-            epsg_out = int(epsg_mode)
+        epsg_out = int(epsg_mode)
+        for epsg_in in np.unique(epsg_las_v):
             if epsg_in != epsg_out:
-                xmin0, ymin0 = transform(epsg_in, epsg_out, xmin[k], ymin[k])
-                xmax0, ymax0 = transform(epsg_in, epsg_out, xmax[k], ymax[k])
+                k = epsg_las_v == epsg_in
+                xmin0, ymin0 = transform(int(epsg_in), epsg_out, xmin[k], ymin[k])
+                xmax0, ymax0 = transform(int(epsg_in), epsg_out, xmax[k], ymax[k])
                 xmin[k], ymin[k] = xmin0, ymin0
                 xmax[k], ymax[k] = xmax0, ymax0
 
@@ -659,6 +780,106 @@ def readAtlH5(in_file, fieldName):
         print('Python message: %s\n' % e)
     return dataOut
 
+
+##### Function to read many ATL .h5 datasets with a single file open
+def readAtlH5Multi(in_file, fieldNames, labels=None, dtypes=None,
+                   rowRange=None):
+
+    # Inputs:
+    # in_file - ATL03/ATL08 .h5 file path
+    # fieldNames - list of fields, e.g. ['/heights/lat_ph', '/heights/h_ph']
+    # labels - ground track (e.g. 'gt1r'), list of ground tracks, or None
+    #          for absolute field names
+    # dtypes - optional dict of {fieldName: dtype} to read into
+    # rowRange - optional (start, stop) tuple applied to every field, or
+    #            dict of {fieldName: (start, stop)}
+    #
+    # Outputs:
+    # dict of {fieldName: array} for a single label, or
+    # dict of {label: {fieldName: array}} for a list of labels
+    #
+    # Missing datasets are returned as [] (same as readAtl03H5).
+    # signal_conf_ph is reduced to its first (land) column.
+
+    if(dtypes is None):
+        dtypes = {}
+    # endIf
+
+    singleLabel = not isinstance(labels, (list, tuple))
+    labelList = [labels] if singleLabel else list(labels)
+    dataOut = dict((label, dict((fieldName, []) for fieldName in fieldNames))
+                   for label in labelList)
+
+    if not os.path.isfile(in_file):
+        print('ATL file does not exist')
+    # endIf
+
+    try:
+        with h5py.File(in_file, 'r') as f:
+            for label in labelList:
+
+                # Skip beams that are not in the granule
+                if(label and (label not in f)):
+                    continue
+                # endIf
+
+                for fieldName in fieldNames:
+                    dsname = ''.join([label, fieldName]) if label else fieldName
+                    if dsname not in f:
+                        continue
+                    # endIf
+                    dset = f[dsname]
+
+                    # Build hyperslab selection
+                    if(isinstance(rowRange, dict)):
+                        fieldRange = rowRange.get(fieldName)
+                    else:
+                        fieldRange = rowRange
+                    # endIf
+                    if(fieldRange is None):
+                        rows = slice(0, dset.shape[0]) if dset.ndim else ()
+                    else:
+                        rows = slice(*fieldRange)
+                    # endIf
+                    if('signal_conf_ph' in fieldName.lower() and dset.ndim == 2):
+                        sel = (rows, 0)
+                    else:
+                        sel = rows
+                    # endIf
+
+                    # Read straight into a buffer of the requested dtype
+                    dtype = dtypes.get(fieldName, dset.dtype)
+                    if(dset.ndim == 0):
+                        dataOut[label][fieldName] = np.array(dset[()], dtype=dtype)
+                        continue
+                    # endIf
+                    start, stop, step = rows.indices(dset.shape[0])
+                    nRows = len(range(start, stop, step))
+                    if(isinstance(sel, tuple)):
+                        shape = (nRows,)
+                    else:
+                        shape = (nRows,) + dset.shape[1:]
+                    # endIf
+                    buffer = np.empty(shape, dtype=dtype)
+                    if(nRows > 0):
+                        dset.read_direct(buffer, source_sel=np.s_[sel])
+                    # endIf
+                    dataOut[label][fieldName] = buffer
+                # endFor
+            # endFor
+    except Exception as e:
+        print('Python message: %s\n' % e)
+    # endTry
+
+    if(singleLabel):
+        return dataOut[labels]
+    else:
+        return dataOut
+    # endIf
+
+# endDef
+
+
 ##### Function to read ATL03 .h5 files for mapping
 def readAtl03DataMapping(in_file03, label, return_delta_time=False):
 #
@@ -862,6 +1083,44 @@ def readLas(lasFilePath, metadata=None):
         
 # endDef
 
+### Function to read only .las points that fall inside a swath mask
+def readLasSubset(lasFilePath, swathMask, chunkSize=5000000):
+    
+    # Read contents of .las file (points stay memory-mapped)
+    with File(lasFilePath, mode = 'r') as lasFile:
+        
+        # Get raw integer x/y and scale/offset
+        X = lasFile.X
+        Y = lasFile.Y
+        xScale, yScale, zScale = lasFile.header.scale
+        xOffset, yOffset, zOffset = lasFile.header.offset
+        
+        # Find points inside swath mask chunk by chunk
+        keepInds = []
+        for i in range(0,len(X),chunkSize):
+            xChunk = X[i:i+chunkSize]*xScale + xOffset
+            yChunk = Y[i:i+chunkSize]*yScale + yOffset
+            keepInds.append(i + np.where(inSwathMask(swathMask, xChunk, yChunk))[0])
+        # endFor
+        keepInds = np.concatenate(keepInds) if len(keepInds)>0 else np.zeros(0, dtype=np.int64)
+        
+        # Store output for kept points only
+        x = X[keepInds]*xScale + xOffset
+        y = Y[keepInds]*yScale + yOffset
+        z = lasFile.Z[keepInds]*zScale + zOffset
+        classification = lasFile.classification[keepInds]
+        intensity = lasFile.intensity[keepInds]
+        headerData = lasFile.header
+        
+        # Store output into class structure
+        lasData = lasStruct(x, y, z, classification, intensity, headerData)
+        
+    # EndWith
+    
+    return lasData
+
+# endDef
+    
 ##### Functions to write .las files
 def selectwkt(proj,hemi=None,zone=None):
     if proj.lower() == "utm":
@@ -1357,6 +1616,125 @@ def writeArrayToCSV(csv_out,namelist,datalist,header=True):
     
 # endDef
     
+##### Function to write arrays to a typed columnar (Parquet/Feather/NPZ) file
+def writeArrayToColumnar(out_file, namelist, datalist, fileFormat=None):
+
+    # Typed alternative to writeArrayToCSV. Numeric columns keep their dtype,
+    # scalar entries of datalist (e.g. GT Num, Beam Num, UTM Zone) and string
+    # arrays are stored as categoricals instead of one string per photon.
+    # fileFormat is 'parquet', 'feather' or 'npz' (default: file extension).
+
+    if(fileFormat is None):
+        fileFormat = os.path.splitext(out_file)[1].lstrip('.')
+    # endIf
+    fileFormat = fileFormat.lower()
+
+    # Number of rows from the array columns
+    nRows = max([np.size(data) for data in datalist if np.ndim(data) > 0] +
+                [0])
+
+    columns = {}
+    for name, data in zip(namelist, datalist):
+        if(np.ndim(data) == 0):
+            if(pd.isna(data)):
+                columns[name] = pd.Categorical.from_codes(
+                    np.full(nRows, -1, dtype=np.int8), categories=[])
+            else:
+                columns[name] = pd.Categorical.from_codes(
+                    np.zeros(nRows, dtype=np.int8), categories=[data])
+            # endIf
+        else:
+            data = np.ravel(data)
+            if(data.dtype.kind in 'OUS'):
+                columns[name] = pd.Categorical(data)
+            else:
+                columns[name] = data
+            # endIf
+        # endIf
+    # endFor
+
+    if(fileFormat == 'parquet'):
+        table = pa.Table.from_pandas(pd.DataFrame(columns),
+                                     preserve_index=False)
+        pq.write_table(table, out_file)
+    elif(fileFormat == 'feather'):
+        # Uncompressed so readColumnarFile can memory-map it
+        feather.write_feather(pd.DataFrame(columns), out_file,
+                              compression='uncompressed')
+    elif(fileFormat == 'npz'):
+        arrays = {}
+        for name, data in columns.items():
+            if(isinstance(data, pd.Categorical)):
+                # Keep numeric categories (e.g. Beam Num) numeric
+                categories = np.asarray(data.categories)
+                if(categories.dtype.kind == 'O'):
+                    categories = categories.astype(str)
+                # endIf
+                arrays[name] = data.codes
+                arrays[name + '.categories'] = categories
+            else:
+                arrays[name] = data
+            # endIf
+        # endFor
+        with open(out_file, 'wb') as npzFile:
+            np.savez(npzFile, **arrays)
+    else:
+        raise ValueError('Unsupported columnar file format: %s' % fileFormat)
+    # endIf
+
+# endDef
+
+##### Function to read a file written by writeArrayToColumnar
+def readColumnarFile(in_file, columns=None, memoryMap=True):
+
+    # Returns a DataFrame with the requested columns (all by default).
+    # Feather files are memory-mapped, Parquet files are read through a
+    # memory map and NPZ members are only decoded for the requested columns.
+
+    fileFormat = os.path.splitext(in_file)[1].lstrip('.').lower()
+
+    if(fileFormat == 'parquet'):
+        table = pq.read_table(in_file, columns=columns,
+                              memory_map=memoryMap)
+        df = table.to_pandas()
+        # Parquet only restores string categoricals; restore numeric and
+        # empty ones from the pandas metadata as the other formats do
+        for column in table.schema.pandas_metadata['columns']:
+            name = column['name']
+            if(column['pandas_type'] == 'categorical' and name in df and
+               not isinstance(df[name].dtype, pd.CategoricalDtype)):
+                df[name] = df[name].astype('category')
+            # endIf
+        # endFor
+    elif(fileFormat == 'feather'):
+        table = feather.read_table(in_file, columns=columns,
+                                   memory_map=memoryMap)
+        df = table.to_pandas()
+    elif(fileFormat == 'npz'):
+        with np.load(in_file, allow_pickle=False) as npzFile:
+            names = [name for name in npzFile.files
+                     if not name.endswith('.categories')]
+            if(columns is not None):
+                names = [name for name in names if name in columns]
+            # endIf
+            data = {}
+            for name in names:
+                if(name + '.categories' in npzFile.files):
+                    data[name] = pd.Categorical.from_codes(
+                        npzFile[name], npzFile[name + '.categories'])
+                else:
+                    data[name] = npzFile[name]
+                # endIf
+            # endFor
+        df = pd.DataFrame(data)
+    else:
+        raise ValueError('Unsupported columnar file format: %s' % fileFormat)
+    # endIf
+
+    return df
+
+# endDef
+    
 def writeATL08toCSV(in_file08,groundtrack,csv_out):
     delta_time = readAtl08H5(in_file08, '/land_segments/delta_time', 
                                  groundtrack)
@@ -1403,6 +1781,117 @@ def isconnected():
         return False
 # endDef 
     
+def getViewerLOD(ytrack, classification, num_columns = 960, 
+                 max_per_column = 2, max_levels = 20):
+    
+    # Level of detail of every photon for the HTML viewer. Level L splits
+    # the along-track extent into num_columns*2**L columns and keeps at most
+    # max_per_column photons of each class per column (evenly spaced along
+    # track). A photon's level is the coarsest level that keeps it, so the
+    # photons drawn at level L (levels 0..L) always include those of the
+    # coarser levels. Returns the level of each photon and the number of
+    # levels.
+    
+    numPhotons = len(ytrack)
+    if(numPhotons == 0):
+        return np.zeros(0, dtype = np.int64), 0
+    # endIf
+    
+    span = np.max(ytrack) - np.min(ytrack)
+    if(span <= 0):
+        span = 1.0
+    # endIf
+    
+    # Sort by class, then along-track, so each (class, column) is one run
+    order = np.lexsort((ytrack, classification))
+    ySorted = (ytrack[order] - np.min(ytrack))/span
+    cSorted = classification[order]
+    classChange = cSorted[1:] != cSorted[:-1]
+    
+    levelSorted = np.full(numPhotons, -1, dtype = np.int64)
+    for level in range(0, max_levels):
+        numCols = num_columns*2**level
+        cols = np.minimum((ySorted*numCols).astype(np.int64), numCols - 1)
+        newRun = np.concatenate([[True], classChange | (cols[1:] != cols[:-1])])
+        runIds = np.cumsum(newRun) - 1
+        
+        # Fill what is left of each column's quota from its unpicked photons
+        unpicked = levelSorted < 0
+        numUnpicked = np.bincount(runIds, weights = unpicked).astype(np.int64)
+        quota = max_per_column - (np.bincount(runIds) - numUnpicked)
+        numBefore = np.cumsum(unpicked) - unpicked
+        unpickedRank = numBefore - numBefore[np.flatnonzero(newRun)][runIds]
+        step = -(-numUnpicked//np.maximum(quota, 1))
+        picked = unpicked & (quota[runIds] > 0) & \
+                 (unpickedRank % np.maximum(step[runIds], 1) == 0)
+        levelSorted[picked] = level
+        if(np.all(levelSorted >= 0)):
+            break
+        # endIf
+    # endFor
+    
+    # Anything left over is drawn at the finest level
+    levelSorted[levelSorted < 0] = level
+    
+    photonLevel = np.empty(numPhotons, dtype = np.int64)
+    photonLevel[order] = levelSorted
+    
+    return photonLevel, level + 1
+
+# endDef
+
+def getViewerLODScript(ytrack, h_ph, classification, lat = None, lon = None,
+                       num_columns = 960, max_per_column = 2):
+    
+    # JavaScript "var lod = {...};" for the HTML viewer templates. Each
+    # level holds its photons (sorted along-track) as base64 typed arrays:
+    # float32 offsets from the minimum along-track/lat/lon, float32 heights
+    # and uint8 classes. The viewer decodes a level the first time a zoom
+    # needs it.
+    import base64
+    import json
+    
+    def encode(values, dtype):
+        return base64.b64encode(np.ascontiguousarray(values, 
+                                dtype = dtype).tobytes()).decode('ascii')
+    # endDef
+    
+    photonLevel, numLevels = getViewerLOD(ytrack, classification, 
+                                          num_columns, max_per_column)
+    order = np.lexsort((ytrack, photonLevel))
+    levelStarts = np.searchsorted(photonLevel[order], 
+                                  np.arange(numLevels + 1))
+    
+    lod = {'numColumns': int(num_columns), 'levels': []}
+    if(len(ytrack) > 0):
+        lod.update({'ymin': float(np.min(ytrack)), 
+                    'ymax': float(np.max(ytrack)),
+                    'zmin': float(np.min(h_ph)), 'zmax': float(np.max(h_ph))})
+        if(lat is not None):
+            lod.update({'latmin': float(np.min(lat)), 
+                        'latmax': float(np.max(lat)),
+                        'lonmin': float(np.min(lon)), 
+                        'lonmax': float(np.max(lon))})
+        # endIf
+    # endIf
+    
+    for level in range(0, numLevels):
+        inds = order[levelStarts[level]:levelStarts[level + 1]]
+        levelData = {'n': int(len(inds)),
+                     'ytrack': encode(ytrack[inds] - lod['ymin'], '<f4'),
+                     'zheight': encode(h_ph[inds], '<f4'),
+                     'cls': encode(classification[inds], 'u1')}
+        if(lat is not None):
+            levelData['lat'] = encode(lat[inds] - lod['latmin'], '<f4')
+            levelData['lon'] = encode(lon[inds] - lod['lonmin'], '<f4')
+        # endIf
+        lod['levels'].append(levelData)
+    # endFor
+    
+    return 'var lod = ' + json.dumps(lod) + ';\n'
+
+# endDef
+
 def createHTMLChart(ytrack, h_ph, classification, lat, lon, 
                     direction = 'Descending',
                     online = None,
@@ -1411,7 +1900,13 @@ def createHTMLChart(ytrack, h_ph, classification, lat, lon,
                     output_folder = "",
                     in_file03_name = "ATL03", 
                     blank = viewerBlank_html, 
-                    blanki = viewerBlankOnline_html):
+                    blanki = viewerBlankOnline_html,
+                    num_columns = 960,
+                    max_per_column = 2):
+    
+    # Photons are embedded as a level of detail pyramid (getViewerLODScript)
+    # and the viewer only draws the photons of the zoomed along-track range,
+    # so export size/time and browser load time stay bounded.
     
     if len(ytrack.shape) == 2:
         ytrack = ytrack[:,0]
@@ -1442,83 +1937,30 @@ def createHTMLChart(ytrack, h_ph, classification, lat, lon,
         tarPath = os.path.normpath(output_folder + '\\d3')
         shutil.copytree(srcPath, tarPath)
 
-    #Copy the Blank Template into 
-    with open(blank) as f:
-        lines = f.readlines()
-        lines = [l for l in lines]
-        with open(viewer_output, "w") as f1:
-            f1.writelines(lines)
-
+    # Keep photons of the classes to plot (the viewer colors classes 0-3)
+    classToPlot = np.isin(classification, classification_list) & \
+                  np.isin(classification, [0,1,2,3])
+    ytrack = np.asarray(ytrack, dtype = float)[classToPlot]
+    h_ph = np.asarray(h_ph, dtype = float)[classToPlot]
+    classification = np.asarray(classification)[classToPlot].astype(np.uint8)
+    if online == True:
+        lat = np.asarray(lat, dtype = float)[classToPlot]
+        lon = np.asarray(lon, dtype = float)[classToPlot]
+    else:
+        lat, lon = None, None
     
-    #Read file and load it to memory
-    with open(viewer_output, "r") as in_file:
-        buffer = in_file.readlines()
+    lodScript = getViewerLODScript(ytrack, h_ph, classification, lat, lon,
+                                   num_columns, max_per_column)
+
+    #Read the Blank Template
+    with open(blank) as f:
+        buffer = f.readlines()
 
     #Write data into the HTML file
     with open(viewer_output, "w") as out_file:
         for line in buffer:
-            if line == "var data = [\n":
-                for j in range(0,len(classification)):
-                    if online == True:
-                        if ((classification[j] == 0) &
-                            (0 in classification_list)):
-                            line = line + ("{ytrack: " 
-                                             + str(ytrack[j]) + ", zheight: " 
-                                             + str(h_ph[j]) +
-                                             ", color: '#C2C5CC', lat: " 
-                                             + str(lat[j]) + ", lon: " 
-                                             + str(lon[j]) + "}, \n") 
-                        elif ((classification[j] == 1) &
-                              (1 in classification_list)):
-                            line = line + ("{ytrack: "
-                                             + str(ytrack[j]) + ", zheight: "
-                                             + str(h_ph[j]) +
-                                             ", color: '#D2B826', lat: " 
-                                             + str(lat[j]) + ", lon: " 
-                                             + str(lon[j]) + "}, \n") 
-                        elif ((classification[j] == 2) &
-                              (2 in classification_list)):
-                            line = line + ("{ytrack: " 
-                                             + str(ytrack[j])  
-                                             + ", zheight: " + str(h_ph[j]) 
-                                             + ", color: '#45811A', lat: " 
-                                             + str(lat[j]) + ", lon: " 
-                                             + str(lon[j]) + "}, \n") 
-                        elif ((classification[j] == 3) & 
-                              (3 in classification_list)):
-                            line = line + ("{ytrack: " 
-                                             + str(ytrack[j]) + ", zheight: " 
-                                             + str(h_ph[j]) 
-                                             + ", color: '#85F334', lat: " 
-                                             + str(lat[j]) + ", lon: " 
-                                             + str(lon[j]) + "}, \n") 
-                            j += 1
-                    else:
-                        if ((classification[j] == 0) &
-                            (0 in classification_list)):
-                            line = line + ("{ytrack: " 
-                                             + str(ytrack[j]) + ", zheight: " 
-                                             + str(h_ph[j]) +
-                                             ", color: '#C2C5CC' }, \n") 
-                        elif ((classification[j] == 1) &
-                              (1 in classification_list)):
-                            line = line + ("{ytrack: " 
-                                             + str(ytrack[j]) + ", zheight: " 
-                                             + str(h_ph[j]) +
-                                             ", color: '#D2B826' }, \n")
-                        elif ((classification[j] == 2) &
-                              (2 in classification_list)):
-                            line = line + ("{ytrack: " 
-                                             + str(ytrack[j])  
-                                             + ", zheight: " + str(h_ph[j]) 
-                                             + ", color: '#45811A' }, \n")
-                        elif ((classification[j] == 3) & 
-                              (3 in classification_list)):
-                            line = line + ("{ytrack: " 
-                                             + str(ytrack[j]) + ", zheight: " 
-                                             + str(h_ph[j]) 
-                                             + ", color: '#85F334' }, \n")
-                            j += 1
+            if line == "//INCLUDE LOD\n":
+                line = line + lodScript
             if line == "//INCLUDE BASELINE\n":
                 if direction == 'Ascending':
                     line = line + "baseline = L.polyline([[lat1, lon0],\n" + \
@@ -1610,6 +2052,74 @@ def formatDEM(file, epsg_backup = 0):
     return xarr, yarr, zarr, intensity, classification, epsg
 # endDef
     
+def getDEMWindowArrays(file, bounds):
+    
+    # Suppress warnings that may come from rasterio
+    if not sys.warnoptions:
+        warnings.simplefilter("ignore")
+    # endif
+    
+    with rasterio.open(file) as ds:
+        
+        # Get pixel window covering bounds (xmin, xmax, ymin, ymax)
+        gt = ds.transform
+        cols = np.sort([(bounds[0] - gt.c)/gt.a, (bounds[1] - gt.c)/gt.a])
+        rows = np.sort([(bounds[3] - gt.f)/gt.e, (bounds[2] - gt.f)/gt.e])
+        colStart = int(np.clip(np.floor(cols[0]), 0, ds.width))
+        colEnd = int(np.clip(np.ceil(cols[1]) + 1, 0, ds.width))
+        rowStart = int(np.clip(np.floor(rows[0]), 0, ds.height))
+        rowEnd = int(np.clip(np.ceil(rows[1]) + 1, 0, ds.height))
+        if(colEnd<=colStart or rowEnd<=rowStart):
+            return np.zeros((0,0)), np.zeros((0,0)), np.zeros((0,0))
+        # endIf
+        window = Window(colStart, rowStart, colEnd - colStart, rowEnd - rowStart)
+        
+        # Read DEM window as NP Array
+        data = np.array(ds.read(1, window=window))
+        
+    # endWith
+    
+    # Generate X/Y Arrays (same pixel convention as getDEMArrays)
+    cols = np.arange(colStart, colStart + data.shape[1]).astype('float')
+    rows = np.arange(rowStart, rowStart + data.shape[0]).astype('float')
+    xarr, yarr = np.meshgrid(gt.c + gt.a*cols, gt.f + gt.e*rows)
+    
+    return data, xarr, yarr
+# endDef
+    
+def formatDEMWindow(file, swathMask, epsg_backup = 0):
+    
+    # Read only the DEM window around the swath mask
+    bounds = getSwathMaskBounds(swathMask)
+    if(bounds is None):
+        data, xarr, yarr = np.zeros((0,0)), np.zeros((0,0)), np.zeros((0,0))
+    else:
+        data, xarr, yarr = getDEMWindowArrays(file, bounds)
+    # endIf
+    
+    epsg = readDEMepsg(file)
+    
+    if epsg == None:
+        if epsg_backup == 0:
+            print('Missing Projection Information')
+        else:
+            epsg = epsg_backup
+    
+    data = data.flatten()
+    xarr = xarr.flatten()
+    yarr = yarr.flatten()
+    
+    # Keep valid pixels inside the swath mask
+    keepInds = (data > -999) & inSwathMask(swathMask, xarr, yarr)
+    xarr = xarr[keepInds]
+    yarr = yarr[keepInds]
+    zarr = data[keepInds]
+    intensity = np.ones(len(zarr))
+    classification = np.ones(len(zarr)) * 2
+    
+    return xarr, yarr, zarr, intensity, classification, epsg
+# endDef
+    
 def write_geotiff(data, epsg, x_min, y_max, x_pixel, y_pixel, outputfile, 
                     nodata = None, write_raster = False):
 
@@ -2038,11 +2548,164 @@ def writeLog(message, fileID=False):
     
 # endDef
     
-### Function to load .las/.laz file
-def loadLasFile(truthFilePath, atlMeasuredData, rotationData, logFileID=False):
+### Function to get a grid mask of the buffered ground track swath
+def getSwathMask(atlMeasuredData, rotationData, buffer, epsg_truth, 
+                 truthExtents=None, cellSize=False):
+    
+    """
+    This function rasterizes the +/- buffer swath around the ICESat-2 track
+    into a boolean grid in the reference file's coordinate system, so 
+    reference points can be dropped before they are reprojected/rotated.
+    
+    The mask is a superset of what makeBuffer (superFilter) keeps: each 
+    along-track bin uses the cross-track range of its neighbouring bins, and 
+    bins past the track ends (within truthExtents) use the range at the end 
+    of the track, since superFilter matches those points to the end photon.
+    
+    INPUTS:
+        1) atlMeasuredData - ATL03 measured data (crossTrack/alongTrack)
+        2) rotationData - rotation data used for crossTrack/alongTrack
+        3) buffer - cross-track buffer distance (m)
+        4) epsg_truth - EPSG code of the reference file
+        5) truthExtents - reference file [xmin, xmax, ymin, ymax] in 
+           epsg_truth (limits the swath to the file's along-track span)
+        6) cellSize - mask cell size (default: max of buffer/2 and 5 m)
+    
+    OUTPUTS:
+        1) swathMask - swathMaskStruct object
+    """
+    
+    # Get mask cell size and along-track sample spacing
+    if(not(cellSize)):
+        cellSize = max(float(buffer)/2, 5.0)
+    # endIf
+    step = cellSize/2
+    
+    # Get MEASURED track in CT/AT plane
+    epsg_atl = identifyEPSG(atlMeasuredData.hemi,atlMeasuredData.zone)
+    crossTrack = np.ravel(atlMeasuredData.crossTrack).astype('float')
+    alongTrack = np.ravel(atlMeasuredData.alongTrack).astype('float')
+    
+    # Get along-track span of swath (reference file span if given)
+    if(truthExtents is not None):
+        xCorners = np.array([truthExtents[0], truthExtents[0], truthExtents[1], truthExtents[1]], dtype='float')
+        yCorners = np.array([truthExtents[2], truthExtents[3], truthExtents[2], truthExtents[3]], dtype='float')
+        if(epsg_truth != epsg_atl):
+            xCorners, yCorners = transform(epsg_truth, epsg_atl, xCorners, yCorners)
+        # endIf
+        _, atCorners, _, _, _, _ = getCoordRotFwd(np.asarray(xCorners), np.asarray(yCorners), 
+                                                   rotationData.R_mat, 
+                                                   rotationData.xRotPt, 
+                                                   rotationData.yRotPt, 
+                                                   rotationData.desiredAngle)
+        atMin = np.min(atCorners) - cellSize
+        atMax = np.max(atCorners) + cellSize
+    else:
+        atMin = np.min(alongTrack) - cellSize
+        atMax = np.max(alongTrack) + cellSize
+    # endIf
+    
+    # Get cross-track min/max in each along-track bin
+    binStart = np.floor(atMin/step)
+    nBins = int(np.floor(atMax/step) - binStart) + 1
+    binInds = np.floor(alongTrack/step) - binStart
+    validInds = np.isfinite(crossTrack) & np.isfinite(binInds)
+    binInds = np.clip(binInds[validInds], 0, nBins - 1).astype(np.int64)
+    ctMin = np.full(nBins, np.inf)
+    ctMax = np.full(nBins, -np.inf)
+    np.minimum.at(ctMin, binInds, crossTrack[validInds])
+    np.maximum.at(ctMax, binInds, crossTrack[validInds])
+    
+    # Empty bins take the ranges of the nearest filled bins on both sides
+    filledTF = np.isfinite(ctMin)
+    if(not(any(filledTF))):
+        return swathMaskStruct(0, 0, cellSize, np.zeros((0,0), dtype=bool))
+    # endIf
+    filledInds = np.where(filledTF)[0]
+    prevInds = np.maximum.accumulate(np.where(filledTF, np.arange(0,nBins), -1))
+    nextInds = np.minimum.accumulate(np.where(filledTF, np.arange(0,nBins), nBins)[::-1])[::-1]
+    prevInds[prevInds<0] = filledInds[0]
+    nextInds[nextInds>=nBins] = filledInds[-1]
+    ctMin = np.minimum(ctMin[prevInds], ctMin[nextInds])
+    ctMax = np.maximum(ctMax[prevInds], ctMax[nextInds])
+    
+    # Widen each bin by its neighbours and the buffer
+    ctMin = np.minimum(ctMin, np.minimum(np.r_[ctMin[0], ctMin[:-1]], np.r_[ctMin[1:], ctMin[-1]])) - buffer
+    ctMax = np.maximum(ctMax, np.maximum(np.r_[ctMax[0], ctMax[:-1]], np.r_[ctMax[1:], ctMax[-1]])) + buffer
+    
+    # Sample each bin on a step x step lattice across the swath
+    nCross = (np.ceil((ctMax - ctMin)/step)).astype(np.int64) + 1
+    nSamples = 2*nCross
+    sampleBins = np.repeat(np.arange(0,nBins), nSamples)
+    local = np.arange(0,nSamples.sum()) - np.repeat(np.cumsum(nSamples) - nSamples, nSamples)
+    atSamples = (binStart + sampleBins + local // nCross[sampleBins])*step
+    ctSamples = np.minimum(ctMin[sampleBins] + (local % nCross[sampleBins])*step, ctMax[sampleBins])
+    
+    # Get samples in reference file coordinates
+    xSamples, ySamples, _, _, _ = getCoordRotRev(ctSamples, atSamples, rotationData.R_mat, 
+                                                 rotationData.xRotPt, rotationData.yRotPt)
+    xSamples = np.ravel(xSamples)
+    ySamples = np.ravel(ySamples)
+    if(epsg_truth != epsg_atl):
+        xSamples, ySamples = transform(epsg_atl, epsg_truth, xSamples, ySamples)
+        xSamples = np.asarray(xSamples)
+        ySamples = np.asarray(ySamples)
+    # endIf
+    
+    # Mark sampled cells, then dilate by one cell
+    xCell = np.floor(xSamples/cellSize).astype(np.int64)
+    yCell = np.floor(ySamples/cellSize).astype(np.int64)
+    xCell0 = xCell.min() - 1
+    yCell0 = yCell.min() - 1
+    mask = np.zeros((yCell.max() - yCell0 + 2, xCell.max() - xCell0 + 2), dtype=bool)
+    mask[yCell - yCell0, xCell - xCell0] = True
+    maskDilated = mask.copy()
+    maskDilated[1:,:] |= mask[:-1,:]
+    maskDilated[:-1,:] |= mask[1:,:]
+    mask = maskDilated.copy()
+    mask[:,1:] |= maskDilated[:,:-1]
+    mask[:,:-1] |= maskDilated[:,1:]
+    
+    swathMask = swathMaskStruct(xCell0, yCell0, cellSize, mask)
+    
+    return swathMask
+
+# endDef
+    
+### Function to test which x/y points fall inside a swath mask
+def inSwathMask(swathMask, x, y):
+    
+    x = np.ravel(x)
+    y = np.ravel(y)
+    nRows, nCols = swathMask.mask.shape
+    xCell = np.floor(x/swathMask.cellSize) - swathMask.xCell0
+    yCell = np.floor(y/swathMask.cellSize) - swathMask.yCell0
+    inTF = (xCell >= 0) & (xCell < nCols) & (yCell >= 0) & (yCell < nRows)
+    inTF[inTF] = swathMask.mask[yCell[inTF].astype(np.int64), xCell[inTF].astype(np.int64)]
+    
+    return inTF
+
+# endDef
     
-    # Read .las file
-    lasTruthData = readLas(truthFilePath)
+### Function to get the x/y bounds of a swath mask
+def getSwathMaskBounds(swathMask):
+    
+    rows, cols = np.where(swathMask.mask)
+    if(len(rows)==0):
+        return None
+    # endIf
+    xmin = (swathMask.xCell0 + cols.min())*swathMask.cellSize
+    xmax = (swathMask.xCell0 + cols.max() + 1)*swathMask.cellSize
+    ymin = (swathMask.yCell0 + rows.min())*swathMask.cellSize
+    ymax = (swathMask.yCell0 + rows.max() + 1)*swathMask.cellSize
+    
+    return xmin, xmax, ymin, ymax
+
+# endDef
+    
+### Function to load .las/.laz file
+def loadLasFile(truthFilePath, atlMeasuredData, rotationData, logFileID=False, 
+                buffer=False):
     
     # Find EPSG Code from truth file
     truthHeader = readLasHeader(truthFilePath)
@@ -2050,10 +2713,6 @@ def loadLasFile(truthFilePath, atlMeasuredData, rotationData, logFileID=False):
     
     # Find EPSG Code from input file
     epsg_atl = identifyEPSG(atlMeasuredData.hemi,atlMeasuredData.zone)
-    
-    # Get easting/northing
-    lasTruthData_x = lasTruthData.x
-    lasTruthData_y = lasTruthData.y
         
     # Reproject if necessary
     if(epsg_truth == 'None'):
@@ -2063,6 +2722,20 @@ def loadLasFile(truthFilePath, atlMeasuredData, rotationData, logFileID=False):
         
     else:
         
+        # Read .las file (only points near the buffered track if buffer given)
+        if(buffer):
+            truthExtents = truthHeader[['xmin','xmax','ymin','ymax']].to_numpy(dtype='float')[0]
+            swathMask = getSwathMask(atlMeasuredData, rotationData, buffer, 
+                                     epsg_truth, truthExtents)
+            lasTruthData = readLasSubset(truthFilePath, swathMask)
+        else:
+            lasTruthData = readLas(truthFilePath)
+        # endIf
+        
+        # Get easting/northing
+        lasTruthData_x = lasTruthData.x
+        lasTruthData_y = lasTruthData.y
+        
         if(epsg_truth != epsg_atl):
             
             # If EPSG code does not match, reproject to input EPSG code
@@ -2098,10 +2771,20 @@ def loadLasFile(truthFilePath, atlMeasuredData, rotationData, logFileID=False):
 # endDef
     
 ### Function to load .tif file
-def loadTifFile(truthFilePath, atlMeasuredData, rotationData, outFilePath, logFileID=False):
-    
-    # Read Tif file
-    xarr0, yarr0, zarr, intensity, classification, epsg = formatDEM(truthFilePath)
+def loadTifFile(truthFilePath, atlMeasuredData, rotationData, outFilePath, logFileID=False, 
+                buffer=False):
+    
+    # Read Tif file (only the window near the buffered track if buffer given)
+    if(buffer):
+        epsg = readDEMepsg(truthFilePath)
+        truthHeader = readTifHeader(truthFilePath)
+        truthExtents = truthHeader[['xmin','xmax','ymin','ymax']].to_numpy(dtype='float')[0]
+        swathMask = getSwathMask(atlMeasuredData, rotationData, buffer, 
+                                 'epsg:' + str(epsg), truthExtents)
+        xarr0, yarr0, zarr, intensity, classification, epsg = formatDEMWindow(truthFilePath, swathMask)
+    else:
+        xarr0, yarr0, zarr, intensity, classification, epsg = formatDEM(truthFilePath)
+    # endIf
     
     # Convert ints to floats
     xarr0 = xarr0.astype(float)
@@ -2174,7 +2857,8 @@ def loadTifFile(truthFilePath, atlMeasuredData, rotationData, outFilePath, logFi
 # endDef
    
 ### Function to read truth file info
-def loadTruthFile(truthFilePath, atlMeasuredData, rotationData, truthFileType, outFilePath, logFileID=False):
+def loadTruthFile(truthFilePath, atlMeasuredData, rotationData, truthFileType, outFilePath, logFileID=False, 
+                  buffer=False):
     
     # Initialize output
     atlTruthData = []
@@ -2182,10 +2866,10 @@ def loadTruthFile(truthFilePath, atlMeasuredData, rotationData, truthFileType, o
     # Determine which file type to load
     if(('las' in truthFileType.lower()) or ('laz' in truthFileType.lower())):  
         # Get .las header info
-        atlTruthData = loadLasFile(truthFilePath, atlMeasuredData, rotationData, logFileID)             
+        atlTruthData = loadLasFile(truthFilePath, atlMeasuredData, rotationData, logFileID, buffer)             
     elif('tif' in truthFileType):
         # Load .tif file
-        atlTruthData = loadTifFile(truthFilePath, atlMeasuredData, rotationData, outFilePath, logFileID)
+        atlTruthData = loadTifFile(truthFilePath, atlMeasuredData, rotationData, outFilePath, logFileID, buffer)
     # endIf
     
     return atlTruthData
@@ -2197,48 +2881,50 @@ def reprojectHeaderData(truthHeaderDF, atlMeasuredData, logFileID=False):
     
     # Copy dataframe
     truthHeaderNewDF = truthHeaderDF.copy()
+    extentCols = ['xmin','xmax','ymin','ymax']
     
     # Input EPSG code
     epsg_atl = identifyEPSG(atlMeasuredData.hemi,atlMeasuredData.zone)
     
-    # Loop through all truth file EPSG codes
-    for i in range(0,len(truthHeaderDF)):
-#        writeLog(str(i) + ' out of ' + str(len(truthHeaderDF)), logFileID)
+    # Loop through unique truth file EPSG codes (one transform per code)
+    epsgTruthAll = truthHeaderDF['epsg'].astype(str).to_numpy()
+    for epsg_truth in np.unique(epsgTruthAll):
+        
         # Reproject EPSG code to match input EPSG if unmatching
-        epsg_truth = truthHeaderDF['epsg'][i]
-#        writeLog(epsg_truth, logFileID)
-#        writeLog(epsg_atl, logFileID)
         if(epsg_truth!=epsg_atl):
             
-            # Header extents
-            xmin = truthHeaderDF['xmin'][i]
-            xmax = truthHeaderDF['xmax'][i]
-            ymin = truthHeaderDF['ymin'][i]
-            ymax = truthHeaderDF['ymax'][i]
-            x = [xmin, xmax]
-            y = [ymin, ymax]
+            # Header extents as (xmin, ymin) and (xmax, ymax) corners
+            inds = np.where(epsgTruthAll==epsg_truth)[0]
+            x = np.concatenate((truthHeaderDF['xmin'].to_numpy()[inds], 
+                                truthHeaderDF['xmax'].to_numpy()[inds])).astype('float')
+            y = np.concatenate((truthHeaderDF['ymin'].to_numpy()[inds], 
+                                truthHeaderDF['ymax'].to_numpy()[inds])).astype('float')
             
             # Reproject extents to input EPSG code
             try:
 
                 xout, yout = transform(epsg_truth, epsg_atl, x, y)
+                xout = np.asarray(xout)
+                yout = np.asarray(yout)
                 
                 # Store new extents into output dataframe
-                truthHeaderNewDF['xmin'][i] = xout[0]
-                truthHeaderNewDF['xmax'][i] = xout[1]
-                truthHeaderNewDF['ymin'][i] = yout[0]
-                truthHeaderNewDF['ymax'][i] = yout[1]
-                truthHeaderNewDF['epsg'][i] = epsg_atl
+                nInds = len(inds)
+                truthHeaderNewDF.iloc[inds, truthHeaderNewDF.columns.get_loc('xmin')] = xout[:nInds]
+                truthHeaderNewDF.iloc[inds, truthHeaderNewDF.columns.get_loc('xmax')] = xout[nInds:]
+                truthHeaderNewDF.iloc[inds, truthHeaderNewDF.columns.get_loc('ymin')] = yout[:nInds]
+                truthHeaderNewDF.iloc[inds, truthHeaderNewDF.columns.get_loc('ymax')] = yout[nInds:]
+                truthHeaderNewDF.iloc[inds, truthHeaderNewDF.columns.get_loc('epsg')] = epsg_atl
             
             except:
                 
                 # Store new extents into output dataframe
-                writeLog('WARNING: Cannot reproject data, skipping file: %s' %truthHeaderNewDF['fileName'][i], logFileID)
-                truthHeaderNewDF['xmin'][i] = 'None'
-                truthHeaderNewDF['xmax'][i] = 'None'
-                truthHeaderNewDF['ymin'][i] = 'None'
-                truthHeaderNewDF['ymax'][i] = 'None'
-                truthHeaderNewDF['epsg'][i] = 'None'
+                for i in inds:
+                    writeLog('WARNING: Cannot reproject data, skipping file: %s' %truthHeaderNewDF['fileName'].iloc[i], logFileID)
+                # endFor
+                truthHeaderNewDF[extentCols] = truthHeaderNewDF[extentCols].astype(object)
+                for col in extentCols + ['epsg']:
+                    truthHeaderNewDF.iloc[inds, truthHeaderNewDF.columns.get_loc(col)] = 'None'
+                # endFor
             
             # endTry
                 
@@ -2346,8 +3032,8 @@ def readTifHeader(tifFileInput, outputFilePath = False, logFileID = False):
     columnNames = ['fileName','version','xmin','xmax','ymin','ymax','zmin','zmax', 
                    'nPoints','epsg']
     
-    # Set dataframe
-    dataOutDF = pd.DataFrame(columns=columnNames)
+    # Initialize list of header rows
+    dataOutRows = []
     
     if(inputFileCheck):
         
@@ -2386,14 +3072,16 @@ def readTifHeader(tifFileInput, outputFilePath = False, logFileID = False):
             dataOut = [fileName, version, xmin, xmax, ymin, ymax, zmin, zmax,
                        Npoints, epsg]
             
-            # Set dataframe
-            dataOutDFsingle = pd.DataFrame(data=dataOut).T
-            dataOutDFsingle.columns = columnNames
-            
-            # Append dataframe
-            dataOutDF = dataOutDF.append(dataOutDFsingle, ignore_index=True)
+            # Append header row
+            dataOutRows.append(dataOut)
             
         # endFor
+    # endIf
+    
+    # Set dataframe (built once from all rows)
+    dataOutDF = pd.DataFrame(dataOutRows, columns=columnNames)
+    
+    if(inputFileCheck):
         
         # Write output file if requested
         if(outputFilePath):
@@ -2465,8 +3153,8 @@ def readLasHeader(lasFileInput, outputFilePath = False, logFileID = False):
     columnNames = ['fileName','version','xmin','xmax','ymin','ymax','zmin','zmax', 
                    'nPoints','epsg']
     
-    # Set dataframe
-    dataOutDF = pd.DataFrame(columns=columnNames)
+    # Initialize list of header rows
+    dataOutRows = []
     
     if(inputFileCheck):
         
@@ -2547,19 +3235,15 @@ def readLasHeader(lasFileInput, outputFilePath = False, logFileID = False):
                         # Move forward in file from current position
                         file.seek(2, 1)
                         
-                        for j in range(0,16):
-                            uID[0,j] = struct.unpack('B',file.read(1))[0] # uint8
-                        # endFor
+                        uID[0,:] = np.frombuffer(file.read(16), dtype=np.uint8)
                         
                         # Convert userID to ASCII char
-                        userID = ''.join([chr(int(item)) for item in uID[0]])
+                        userID = uID[0].tobytes().decode('latin-1')
                         
                         recordID = struct.unpack('H',file.read(2))[0] # uint16
                         recordLen = struct.unpack('H',file.read(2))[0] # uint16
                     
-                        for j in range(0,32):
-                            desc[0,j] = struct.unpack('B',file.read(1))[0] # uint8
-                        # endFor
+                        desc[0,:] = np.frombuffer(file.read(32), dtype=np.uint8)
                     
                         if('LASF_Projection' in userID):
                             
@@ -2642,30 +3326,23 @@ def readLasHeader(lasFileInput, outputFilePath = False, logFileID = False):
                         # Move forward in file from current position
                         file.seek(2, 1)
                         
-                        for j in range(0,16):
-                            uID[0,j] = struct.unpack('B',file.read(1))[0] # uint8
-                        # endFor
+                        uID[0,:] = np.frombuffer(file.read(16), dtype=np.uint8)
                         
                         # Convert userID to ASCII char
-                        userID = ''.join([chr(int(item)) for item in uID[0]])
+                        userID = uID[0].tobytes().decode('latin-1')
                         
                         recordID = struct.unpack('H',file.read(2))[0] # uint16
                         recordLen = struct.unpack('H',file.read(2))[0] # uint16
                         
-                        for j in range(0,32):
-                            desc[0,j] = struct.unpack('B',file.read(1))[0] # uint8
-                        # endFor
+                        desc[0,:] = np.frombuffer(file.read(32), dtype=np.uint8)
                         
                         # Convert description to ASCII char
-                        description = ''.join([chr(int(item)) for item in desc[0]])
+                        description = desc[0].tobytes().decode('latin-1')
                         
-                        wkt = np.zeros((1,recordLen))
-                        for j in range(0,recordLen):
-                            wkt[0,j] = struct.unpack('B',file.read(1))[0] # uint8
-                        # endFor
+                        wkt = np.frombuffer(file.read(recordLen), dtype=np.uint8).reshape(1,-1)
                         
                         # Convert wkt to ASCII char
-                        wktAll = ''.join([chr(int(item)) for item in wkt[0]])
+                        wktAll = wkt[0].tobytes().decode('latin-1')
                         
                         # Get EPSG code
                         proj = osr.SpatialReference(wkt=wktAll)
@@ -2700,14 +3377,16 @@ def readLasHeader(lasFileInput, outputFilePath = False, logFileID = False):
             dataOut = [fileName, version, xmin, xmax, ymin, ymax, zmin, zmax,
                        Npoints, epsg]
             
-            # Set dataframe
-            dataOutDFsingle = pd.DataFrame(data=dataOut).T
-            dataOutDFsingle.columns = columnNames
-            
-            # Append dataframe
-            dataOutDF = dataOutDF.append(dataOutDFsingle, ignore_index=True)
+            # Append header row
+            dataOutRows.append(dataOut)
         
         # endFor
+    # endIf
+    
+    # Set dataframe (built once from all rows)
+    dataOutDF = pd.DataFrame(dataOutRows, columns=columnNames)
+    
+    if(inputFileCheck):
         
         # Write output file if requested
         if(outputFilePath):
@@ -2729,14 +3408,38 @@ def readLasHeader(lasFileInput, outputFilePath = False, logFileID = False):
 
 # endDef
     
+### Function to get file modification times (NaN for missing files)
+def getFileMtimes(filePaths):
+    
+    fileMtimes = np.full(len(filePaths), np.nan)
+    for i in range(0,len(filePaths)):
+        try:
+            fileMtimes[i] = os.path.getmtime(filePaths[i])
+        except OSError:
+            pass
+        # endTry
+    # endFor
+    
+    return fileMtimes
+
+# endDef
+    
 ### Function to read header info
 def getTruthHeaders(truthFilePath, truthFileType, logFileID=False):
     
-    # Initialize output
-    truthHeaderDF = []
-    writeNew = True
-    appendNew = False
-        
+    """
+    This function returns header info for the reference files in 
+    truthFilePath, in the same order as truthFilePath. Headers are cached in
+    phoReal_headers.csv next to the reference files along with each file's
+    modification time, so only new or changed files are re-read and files
+    removed from disk are dropped from the cache.
+    """
+    
+    # Initialize output (paths normalized the same way as the header readers)
+    truthFilePath = [os.path.normpath(x) for x in truthFilePath]
+    storedHeaderDF = []
+    writeNew = False
+    
     # Create header file output name
     headerFileName = 'phoReal_headers.csv'
     truthFileDir = ntpath.dirname(truthFilePath[0])
@@ -2744,59 +3447,93 @@ def getTruthHeaders(truthFilePath, truthFileType, logFileID=False):
         headerFilePath = os.path.normpath(truthFileDir + '\\' + headerFileName)
     else:
         headerFilePath = os.path.normpath(truthFileDir + '/' + headerFileName)
-
+    
+    # Get modification times for input files
+    fileMtimes = getFileMtimes(truthFilePath)
+    fileMtimeLookup = dict(zip(truthFilePath, fileMtimes))
+    
     # Check if header file exists
     if(os.path.exists(headerFilePath)):
         writeLog('   Previous header file exists', logFileID)
-        stored_truthHeaderDF = pd.read_csv(headerFilePath)
-        stored_truthFilePath = (stored_truthHeaderDF['fileName']).to_list()
-        stored_filesTrue = np.isin(truthFilePath, stored_truthFilePath)
-        stored_filesSame = all(stored_filesTrue)
-        
-        # Determine if files are the same
-        if(stored_filesSame):
-            if(len(truthFilePath)==len(stored_truthFilePath)):
-                writeLog('   Stored header file is up-to-date, using this file', logFileID)
-                truthHeaderDF = stored_truthHeaderDF
-            elif(len(truthFilePath)<len(stored_truthFilePath)):
-                writeLog('   Stored header file is ahead of reference directory, using only reference files selected', logFileID)
-                indsTrue = np.isin(stored_truthFilePath, truthFilePath)
-                truthHeaderDF = stored_truthHeaderDF[indsTrue]
-                truthHeaderDF.reset_index(inplace=True)
-            # endIf
-            writeNew = False
-        else:
-            writeLog('   Stored header file is not up-to-date, updating...', logFileID)
-            newInds = stored_filesTrue==False
-            truthFilePath = (np.array(truthFilePath)[newInds]).tolist()
-            appendNew = True
+        storedHeaderDF = pd.read_csv(headerFilePath)
+        storedHeaderDF.drop_duplicates('fileName', keep='last', inplace=True)
+        storedFilePath = (storedHeaderDF['fileName']).to_list()
+        
+        # Current modification times of stored files (selected files
+        # reuse the times above, others are checked on disk)
+        storedMtimeNow = np.array([fileMtimeLookup[x] if x in fileMtimeLookup 
+                                   else np.nan for x in storedFilePath])
+        otherInds = np.where(~np.isin(storedFilePath, truthFilePath))[0]
+        storedMtimeNow[otherInds] = getFileMtimes([storedFilePath[i] for i in otherInds])
+        
+        # Older header files have no mtime column, treat them as current
+        if('mtime' not in storedHeaderDF.columns):
+            storedHeaderDF['mtime'] = storedMtimeNow
+            writeNew = True
         # endIf
+        
+        # Keep stored headers for files that still exist and are unchanged
+        # (mtimes are compared to 1 ms since they round-trip through .csv)
+        storedMtime = storedHeaderDF['mtime'].to_numpy(dtype='float')
+        storedKeep = np.isfinite(storedMtimeNow) & \
+                     (np.abs(storedMtime - storedMtimeNow) < 1e-3)
+        storedHeaderDF = storedHeaderDF[storedKeep]
+        writeNew = writeNew or not all(storedKeep)
     # endIf
     
-    if(writeNew):
+    # Determine which input files need their headers read
+    if(len(storedHeaderDF)>0):
+        readFilesTF = ~np.isin(truthFilePath, storedHeaderDF['fileName'].to_list())
+    else:
+        readFilesTF = np.ones(len(truthFilePath), dtype=bool)
+    # endIf
+    readFilePath = (np.array(truthFilePath)[readFilesTF]).tolist()
+    writeNew = writeNew or len(readFilePath)>0
+    
+    if(len(readFilePath)>0):
         
         # Message to user
-        numFiles = len(truthFilePath)
-        writeLog('   Reading header info for all %d reference files in: %s' %(numFiles, truthFileDir), logFileID)
+        numFiles = len(readFilePath)
+        if(len(storedHeaderDF)>0):
+            writeLog('   Stored header file is not up-to-date, updating...', logFileID)
+        # endIf
+        writeLog('   Reading header info for %d reference files in: %s' %(numFiles, truthFileDir), logFileID)
     
         if(('las' in truthFileType.lower()) or ('laz' in truthFileType.lower())):  
             # Get .las header info
-            truthHeaderNewDF = readLasHeader(truthFilePath, headerFilePath, logFileID)              
+            truthHeaderNewDF = readLasHeader(readFilePath, False, logFileID)              
         elif('tif' in truthFileType):
             # Load .tif file
-            truthHeaderNewDF = readTifHeader(truthFilePath, headerFilePath, logFileID)  
+            truthHeaderNewDF = readTifHeader(readFilePath, False, logFileID)  
         # endIf
+        truthHeaderNewDF['mtime'] = fileMtimes[readFilesTF]
         
         # Append dataframes together if necessary
-        if(appendNew):
-            frames = [stored_truthHeaderDF, truthHeaderNewDF]
-            truthHeaderDF = pd.concat(frames, ignore_index=True)
+        if(len(storedHeaderDF)>0):
+            frames = [storedHeaderDF, truthHeaderNewDF]
+            storedHeaderDF = pd.concat(frames, ignore_index=True)
         else:
-            truthHeaderDF = truthHeaderNewDF
+            storedHeaderDF = truthHeaderNewDF
         # endIf
-        
+    
+    else:
+        writeLog('   Stored header file is up-to-date, using this file', logFileID)
+    # endIf
+    
+    # Rewrite header file if anything was added, changed or removed
+    if(writeNew):
+        try:
+            writeLog('   Writing output header file: %s' %headerFilePath, logFileID)
+            storedHeaderDF.to_csv(headerFilePath, index=False)
+        except:
+            writeLog('   WARNING: Could not write output .csv file with headers.', logFileID)
+        # endTry
     # endIf
     
+    # Return headers in the same order as the input files
+    truthHeaderDF = storedHeaderDF.set_index('fileName', drop=False)
+    truthHeaderDF = truthHeaderDF.loc[truthFilePath].reset_index(drop=True)
+    
     # Write a blank line for readability
     writeLog('', logFileID)
     
@@ -2955,8 +3692,296 @@ def makeBuffer_legacy(atlTruthData, atlMeasuredData, rotationData, buffer):
             
 # endDef
     
+### Function to get sorted-grid cell keys from x/y cell numbers
+def getTileCellKeys(xCell, yCell):
+    
+    # Pack x/y cell numbers into one sortable int64 key
+    cellKeys = xCell.astype(np.int64)*(2**32) + (yCell.astype(np.int64) + 2**31)
+    
+    return cellKeys
+
+# endDef
+    
+### Function to get grid cell keys covered by reference tile extents
+def getTileCellPairs(extents, cellSize):
+    
+    # Get min/max grid cells of each tile
+    xCellMin = np.floor(extents[:,0]/cellSize).astype(np.int64)
+    xCellMax = np.floor(extents[:,1]/cellSize).astype(np.int64)
+    yCellMin = np.floor(extents[:,2]/cellSize).astype(np.int64)
+    yCellMax = np.floor(extents[:,3]/cellSize).astype(np.int64)
+    
+    # Expand every tile to all of its (cell, tile) pairs
+    nx = xCellMax - xCellMin + 1
+    ny = yCellMax - yCellMin + 1
+    counts = nx*ny
+    tileNums = np.repeat(np.arange(0,len(extents)), counts)
+    local = np.arange(0,counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    xCell = xCellMin[tileNums] + local % nx[tileNums]
+    yCell = yCellMin[tileNums] + local // nx[tileNums]
+    cellKeys = getTileCellKeys(xCell, yCell)
+    
+    return cellKeys, tileNums
+
+# endDef
+    
+### Function to build a sorted grid index over reference tile extents
+def buildTruthTileIndex(fileNames, extents, epsg, cellSize=False):
+    
+    """
+    This function builds a sorted grid index over reference tile extents.
+    Every tile is listed under each grid cell its extent covers, and the
+    (cell, tile) pairs are sorted by cell key so a query is a searchsorted.
+    
+    INPUTS:
+        1) fileNames - array of reference file names
+        2) extents - (n,4) array of xmin, xmax, ymin, ymax per file
+        3) epsg - EPSG code of the extents
+        4) cellSize - grid cell size (default: median tile width/height)
+    
+    OUTPUTS:
+        1) tileIndex - dict with fileName, extents, epsg, cellSize, 
+                       cellKeys and cellTiles arrays
+    """
+    
+    fileNames = np.asarray(fileNames).astype('str')
+    extents = np.asarray(extents, dtype='float').reshape(-1,4)
+    
+    # Tiles with failed reprojections are not indexed
+    goodInds = np.all(np.isfinite(extents), axis=1)
+    fileNames = fileNames[goodInds]
+    extents = extents[goodInds]
+    
+    # Default cell size from typical tile size
+    if(not(cellSize)):
+        if(len(extents)>0):
+            tileSize = np.maximum(extents[:,1] - extents[:,0], extents[:,3] - extents[:,2])
+            cellSize = float(max(np.median(tileSize), 1.0))
+        else:
+            cellSize = 1000.0
+        # endIf
+    # endIf
+    
+    # Get sorted (cell, tile) pairs
+    cellKeys, cellTiles = getTileCellPairs(extents, cellSize)
+    sortInds = np.argsort(cellKeys, kind='stable')
+    
+    tileIndex = {'fileName': fileNames,
+                 'extents': extents,
+                 'epsg': str(epsg),
+                 'cellSize': float(cellSize),
+                 'cellKeys': cellKeys[sortInds],
+                 'cellTiles': cellTiles[sortInds]}
+    
+    return tileIndex
+
+# endDef
+    
+### Function to update a tile index for added, changed or removed tiles
+def updateTruthTileIndex(tileIndex, fileNames, extents):
+    
+    fileNames = np.asarray(fileNames).astype('str')
+    extents = np.asarray(extents, dtype='float').reshape(-1,4)
+    goodInds = np.all(np.isfinite(extents), axis=1)
+    fileNames = fileNames[goodInds]
+    extents = extents[goodInds]
+    
+    # Match current tiles to indexed tiles by file name
+    sortInds = np.argsort(tileIndex['fileName'])
+    sortedNames = tileIndex['fileName'][sortInds]
+    pos = np.clip(np.searchsorted(sortedNames, fileNames), 0, max(len(sortedNames)-1, 0))
+    if(len(sortedNames)>0):
+        oldTiles = sortInds[pos]
+        sameTF = (sortedNames[pos]==fileNames) & \
+                 np.all(tileIndex['extents'][oldTiles]==extents, axis=1)
+    else:
+        oldTiles = np.zeros(len(fileNames), dtype=np.int64)
+        sameTF = np.zeros(len(fileNames), dtype=bool)
+    # endIf
+    
+    # Nothing to do if the tiles are unchanged
+    if(all(sameTF) and len(fileNames)==len(tileIndex['fileName'])):
+        return tileIndex, False
+    # endIf
+    
+    # Keep pairs of unchanged tiles, renumbered to their new positions
+    newTileNums = np.full(len(tileIndex['fileName']), -1, dtype=np.int64)
+    newTileNums[oldTiles[sameTF]] = np.where(sameTF)[0]
+    keptTiles = newTileNums[tileIndex['cellTiles']]
+    keepTF = keptTiles>=0
+    
+    # Add pairs of new or changed tiles
+    addInds = np.where(~sameTF)[0]
+    addKeys, addTiles = getTileCellPairs(extents[addInds], tileIndex['cellSize'])
+    cellKeys = np.concatenate((tileIndex['cellKeys'][keepTF], addKeys))
+    cellTiles = np.concatenate((keptTiles[keepTF], addInds[addTiles]))
+    pairInds = np.argsort(cellKeys, kind='stable')
+    
+    tileIndex = {'fileName': fileNames,
+                 'extents': extents,
+                 'epsg': tileIndex['epsg'],
+                 'cellSize': tileIndex['cellSize'],
+                 'cellKeys': cellKeys[pairInds],
+                 'cellTiles': cellTiles[pairInds]}
+    
+    return tileIndex, True
+
+# endDef
+    
+### Function to write tile index to .npz file
+def writeTruthTileIndex(tileIndex, indexFilePath):
+    
+    # Write to a temporary file first so readers never see a partial index
+    tempFilePath = indexFilePath + '.tmp'
+    with open(tempFilePath, 'wb') as file:
+        np.savez(file, fileName=tileIndex['fileName'], 
+                 extents=tileIndex['extents'],
+                 epsg=np.array(tileIndex['epsg']),
+                 cellSize=np.array(tileIndex['cellSize']),
+                 cellKeys=tileIndex['cellKeys'], 
+                 cellTiles=tileIndex['cellTiles'])
+    # endWith
+    os.replace(tempFilePath, indexFilePath)
+
+# endDef
+    
+### Function to read tile index from .npz file
+def readTruthTileIndex(indexFilePath):
+    
+    with np.load(indexFilePath, allow_pickle=False) as data:
+        tileIndex = {'fileName': data['fileName'],
+                     'extents': data['extents'],
+                     'epsg': str(data['epsg']),
+                     'cellSize': float(data['cellSize']),
+                     'cellKeys': data['cellKeys'],
+                     'cellTiles': data['cellTiles']}
+    # endWith
+    
+    return tileIndex
+
+# endDef
+    
+### Function to get (and keep up-to-date) a reference tile index
+def getTruthTileIndex(truthHeaderNewDF, epsg, indexFilePath=False, 
+                      cellSize=False, logFileID=False):
+    
+    """
+    This function returns a sorted grid index over the reference tile 
+    extents in truthHeaderNewDF (extents already in EPSG code epsg, see 
+    reprojectHeaderData). If indexFilePath is given, the index is read from 
+    that .npz file, updated for added/changed/removed tiles and written 
+    back, so it is only built in full once.
+    """
+    
+    # Get tile names and extents
+    fileNames = truthHeaderNewDF['fileName'].to_numpy().astype('str')
+    extents = np.column_stack([pd.to_numeric(truthHeaderNewDF[col], errors='coerce').to_numpy(dtype='float')
+                               for col in ['xmin','xmax','ymin','ymax']])
+    
+    # Read stored index
+    tileIndex = False
+    if(indexFilePath and os.path.exists(indexFilePath)):
+        try:
+            tileIndex = readTruthTileIndex(indexFilePath)
+            if(tileIndex['epsg']!=str(epsg) or 
+               (cellSize and cellSize!=tileIndex['cellSize'])):
+                tileIndex = False
+            # endIf
+        except:
+            writeLog('   WARNING: Could not read reference tile index, rebuilding...', logFileID)
+            tileIndex = False
+        # endTry
+    # endIf
+    
+    # Build new index or update stored index
+    if(tileIndex):
+        tileIndex, indexChanged = updateTruthTileIndex(tileIndex, fileNames, extents)
+    else:
+        tileIndex = buildTruthTileIndex(fileNames, extents, epsg, cellSize)
+        indexChanged = True
+    # endIf
+    
+    # Write index if needed
+    if(indexFilePath and indexChanged):
+        try:
+            writeTruthTileIndex(tileIndex, indexFilePath)
+        except:
+            writeLog('   WARNING: Could not write reference tile index: %s' %indexFilePath, logFileID)
+        # endTry
+    # endIf
+    
+    return tileIndex
+
+# endDef
+    
+### Function to find tiles in a tile index that contain any x/y point
+def queryTruthTileIndex(tileIndex, x, y):
+    
+    x = np.ravel(x).astype('float')
+    y = np.ravel(y).astype('float')
+    goodInds = np.isfinite(x) & np.isfinite(y)
+    x = x[goodInds]
+    y = y[goodInds]
+    cellSize = tileIndex['cellSize']
+    tileKeys = tileIndex['cellKeys']
+    
+    # Sort points by grid cell
+    xCell = np.floor(x/cellSize).astype(np.int64)
+    yCell = np.floor(y/cellSize).astype(np.int64)
+    ptKeys = getTileCellKeys(xCell, yCell)
+    sortInds = np.argsort(ptKeys, kind='stable')
+    ptKeys = ptKeys[sortInds]
+    x = x[sortInds]
+    y = y[sortInds]
+    cellKeys, cellStarts = np.unique(ptKeys, return_index=True)
+    cellX = xCell[sortInds][cellStarts]
+    cellY = yCell[sortInds][cellStarts]
+    cellEnds = np.append(cellStarts[1:], len(ptKeys))
+    
+    # Get candidate (cell, tile) pairs for occupied cells
+    lo = np.searchsorted(tileKeys, cellKeys, side='left')
+    hi = np.searchsorted(tileKeys, cellKeys, side='right')
+    counts = hi - lo
+    pairCells = np.repeat(np.arange(0,len(cellKeys)), counts)
+    pairInds = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(0,counts.sum())
+    pairTiles = tileIndex['cellTiles'][pairInds]
+    
+    # Tiles covering a whole occupied cell contain its points
+    ext = tileIndex['extents'][pairTiles]
+    pairX = cellX[pairCells]
+    pairY = cellY[pairCells]
+    fullTF = (ext[:,0] <= pairX*cellSize) & (ext[:,1] >= (pairX + 1)*cellSize) & \
+             (ext[:,2] <= pairY*cellSize) & (ext[:,3] >= (pairY + 1)*cellSize)
+    matchTF = np.zeros(len(tileIndex['fileName']), dtype=bool)
+    matchTF[pairTiles[fullTF]] = True
+    
+    # Test points of partly covered cells against tile extents
+    partInds = np.where(~fullTF & ~matchTF[pairTiles])[0]
+    ptCounts = (cellEnds - cellStarts)[pairCells[partInds]]
+    ptPairs = np.repeat(partInds, ptCounts)
+    ptInds = np.repeat(cellStarts[pairCells[partInds]] - np.cumsum(ptCounts) + ptCounts, ptCounts) + \
+             np.arange(0,ptCounts.sum())
+    ext = tileIndex['extents'][pairTiles[ptPairs]]
+    inTF = (x[ptInds] >= ext[:,0]) & (x[ptInds] <= ext[:,1]) & \
+           (y[ptInds] >= ext[:,2]) & (y[ptInds] <= ext[:,3])
+    matchTF[pairTiles[ptPairs[inTF]]] = True
+    
+    matchingFiles = tileIndex['fileName'][matchTF]
+    
+    return matchingFiles
+
+# endDef
+    
 ### Function to find which truth tiles ICESat-2 crosses over
-def findMatchingTruthFiles(truthHeaderNewDF, atlMeasuredData, rotationData, buffer):
+def findMatchingTruthFiles(truthHeaderNewDF, atlMeasuredData, rotationData, buffer, 
+                           tileIndex=False):
+    
+    """
+    This function finds the reference tiles that contain any of the 
+    left/right buffer edge points of the ICESat-2 track. Tiles are looked up
+    in a sorted grid index (see getTruthTileIndex); pass tileIndex to reuse 
+    one across beams, otherwise one is built in memory from truthHeaderNewDF.
+    """
        
     # Get MEASURED rotated buffer bounds data
     xRotL = atlMeasuredData.crossTrack - buffer
@@ -2967,100 +3992,22 @@ def findMatchingTruthFiles(truthHeaderNewDF, atlMeasuredData, rotationData, buff
     xL, yL,  _, _, _ = getCoordRotRev(xRotL, yRot, rotationData.R_mat, rotationData.xRotPt, rotationData.yRotPt)
     xR, yR,  _, _, _ = getCoordRotRev(xRotR, yRot, rotationData.R_mat, rotationData.xRotPt, rotationData.yRotPt)
     
-    # Rotate truth header file min/max x,y points to CT/AT plane
-    xMinyMinHeaderRotX, _,  _, _, _, _ = getCoordRotFwd(((truthHeaderNewDF['xmin']).to_numpy()).astype('float'), 
-                                                        ((truthHeaderNewDF['ymin']).to_numpy()).astype('float'), 
-                                                        rotationData.R_mat, 
-                                                        rotationData.xRotPt, 
-                                                        rotationData.yRotPt, 
-                                                        rotationData.desiredAngle)
-    
-    xMinyMaxHeaderRotX, _,  _, _, _, _ = getCoordRotFwd(((truthHeaderNewDF['xmin']).to_numpy()).astype('float'), 
-                                                        ((truthHeaderNewDF['ymax']).to_numpy()).astype('float'), 
-                                                        rotationData.R_mat, 
-                                                        rotationData.xRotPt, 
-                                                        rotationData.yRotPt, 
-                                                        rotationData.desiredAngle)
-    xMaxyMinHeaderRotX, _,  _, _, _, _ = getCoordRotFwd(((truthHeaderNewDF['xmax']).to_numpy()).astype('float'), 
-                                                        ((truthHeaderNewDF['ymin']).to_numpy()).astype('float'), 
-                                                        rotationData.R_mat, 
-                                                        rotationData.xRotPt, 
-                                                        rotationData.yRotPt, 
-                                                        rotationData.desiredAngle)
-    xMaxyMaxHeaderRotX, _,  _, _, _, _ = getCoordRotFwd(((truthHeaderNewDF['xmax']).to_numpy()).astype('float'), 
-                                                        ((truthHeaderNewDF['ymax']).to_numpy()).astype('float'), 
-                                                        rotationData.R_mat, 
-                                                        rotationData.xRotPt, 
-                                                        rotationData.yRotPt, 
-                                                        rotationData.desiredAngle)
-    
-    # Find min/max x/y header points inside min/max x buffer points
-    xMinyMinXPtsInBuffer = (xMinyMinHeaderRotX >= xRotL.min()) & \
-    (xMinyMinHeaderRotX <= xRotR.max())
-    xMinyMaxXPtsInBuffer = (xMinyMaxHeaderRotX >= xRotL.min()) & \
-    (xMinyMaxHeaderRotX <= xRotR.max())
-    xMaxyMinXPtsInBuffer = (xMaxyMinHeaderRotX >= xRotL.min()) & \
-    (xMaxyMinHeaderRotX <= xRotR.max())
-    xMaxyMaxXPtsInBuffer = (xMaxyMaxHeaderRotX >= xRotL.min()) & \
-    (xMaxyMaxHeaderRotX <= xRotR.max())
-    
-    # Get header points inside MEASURED buffer points
-    xHeaderPtsInBuffer = np.c_[xMinyMinXPtsInBuffer | xMinyMaxXPtsInBuffer| xMaxyMinXPtsInBuffer | xMaxyMaxXPtsInBuffer]
-    
-    # Find min/max x buffer points inside min/max x/y header points
-    xyMinMaxHeaderRot = np.column_stack((xMinyMinHeaderRotX,xMinyMaxHeaderRotX,xMaxyMinHeaderRotX,xMaxyMaxHeaderRotX))
-    xyMinHeaderRot = np.c_[np.amin(xyMinMaxHeaderRot,axis=1)]
-    xyMaxHeaderRot = np.c_[np.amax(xyMinMaxHeaderRot,axis=1)]
-    xMinBufferPtsInFile = (xRotL.min() >= xyMinHeaderRot) & (xRotL.min() <= xyMaxHeaderRot)
-    xMaxBufferPtsInFile = (xRotR.max() >= xyMinHeaderRot) & (xRotR.max() <= xyMaxHeaderRot)
-    
-    # Get MEASURED buffer points inside header points
-    xBufferPtsInHeader = xMinBufferPtsInFile | xMaxBufferPtsInFile
-    
-    # Get any points where buffer points are inside header and vice versa
-    xPtsInFile = np.ravel(np.logical_or(xHeaderPtsInBuffer, xBufferPtsInHeader))
-        
-    # Get matching truth file names and x/y min/max points
-    matchingFilesPre = ((truthHeaderNewDF['fileName'][xPtsInFile]).to_numpy()).astype('str')
-    matchingHeaderXmin = ((truthHeaderNewDF['xmin'][xPtsInFile]).to_numpy()).astype('float')
-    matchingHeaderXmax = ((truthHeaderNewDF['xmax'][xPtsInFile]).to_numpy()).astype('float')
-    matchingHeaderYmin = ((truthHeaderNewDF['ymin'][xPtsInFile]).to_numpy()).astype('float')
-    matchingHeaderYmax = ((truthHeaderNewDF['ymax'][xPtsInFile]).to_numpy()).astype('float')
-    
-    fileNumsAll = np.arange(0,len(truthHeaderNewDF))
-    allFileInds = fileNumsAll[xPtsInFile]
-    
     # Get all MEASURED x,y buffer points
-    xAll = np.concatenate((xL, xR))
-    yAll = np.concatenate((yL, yR))
+    xAll = np.concatenate((np.ravel(xL), np.ravel(xR)))
+    yAll = np.concatenate((np.ravel(yL), np.ravel(yR)))
     
-    matchTF = []
-    if(len(matchingFilesPre)>0):
-        for i in range(0,len(matchingFilesPre)):
-            
-            # Determine TRUTH files where MEASURED data actually crosses over
-            xPtsInFile = (xAll >= matchingHeaderXmin[i]) & (xAll <= matchingHeaderXmax[i])
-            yPtsInFile = (yAll >= matchingHeaderYmin[i]) & (yAll <= matchingHeaderYmax[i])
-            anyPtsInFile = any(xPtsInFile & yPtsInFile)
-    
-            # If a TRUTH file is a match, use it
-            if(anyPtsInFile):
-                matchTF.append(True)
-            else:
-                matchTF.append(False)
-            # endIf
-            
-        # endFor
+    # Get tile index
+    if(not(tileIndex)):
+        epsg_atl = identifyEPSG(atlMeasuredData.hemi,atlMeasuredData.zone)
+        tileIndex = getTruthTileIndex(truthHeaderNewDF, epsg_atl)
     # endIf
     
-    if(len(matchTF)>0):
-        matchTF = np.array(matchTF)
-        matchingFiles = matchingFilesPre[matchTF]
-    else:
-        matchingFiles = []
-    # endIf
+    # Determine TRUTH files where MEASURED data actually crosses over
+    matchingNames = queryTruthTileIndex(tileIndex, xAll, yAll)
+    matchTF = np.isin(truthHeaderNewDF['fileName'].to_numpy().astype('str'), matchingNames)
     
-    matchingFileInds = allFileInds[matchTF]
+    matchingFileInds = np.where(matchTF)[0]
+    matchingFiles = ((truthHeaderNewDF['fileName'][matchTF]).to_numpy()).astype('str')
     
     return matchingFiles, matchingFileInds
 
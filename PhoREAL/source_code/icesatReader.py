@@ -89,45 +89,82 @@ class AtlStruct:
         self.orbit_info = orbit_info
                 
 
-# Read ATL03 Heights, put in Pandas DF
-def read_atl03_heights_data(atl03filepath, gt):
-    # Iterate through keys for "Heights"
-    keys = getH5Keys(atl03filepath,gt + '/heights')
-    
-    # Read each key, put it in pandas df
-    for idx, key in enumerate(keys):
-        data = readAtl03H5(atl03filepath, '/heights/' + key, gt)
-        if idx == 0:
-            df = pd.DataFrame(data,columns=[key])
-        else:
-            df = pd.concat([df,pd.DataFrame(data,columns=[key])],axis=1)
-    return df
-
-def read_atl03_geolocation(atl03filepath, gt):
-    # Iterate through keys for "Heights"
-    keys = getH5Keys(atl03filepath,gt + '/geolocation')
-    key_info = get_H5_keys_info(atl03filepath, gt + '/geolocation')
-    
-    # Read each key, put it in pandas df
-    for idx, key in enumerate(keys):
-        data = readAtl03H5(atl03filepath, '/geolocation/' + key, gt)
-        if key_info[idx][1] != 'Group':
-            if idx == 0:
-                df = pd.DataFrame(data,columns=[key.split('/')[-1]])
+# Minimum ATL03 heights columns needed to build an AtlStruct
+ATL03_STRUCT_COLUMNS = ['delta_time', 'h_ph', 'lat_ph', 'lon_ph',
+                        'signal_conf_ph']
+
+# Read every dataset in an ATL03 group with one file open, put in Pandas DF
+def read_atl_group(atlfilepath, group, columns = None, expand_2d = True,
+                   first_column_only = ['signal_conf_ph']):
+    # Datasets are read straight into preallocated buffers and the
+    # DataFrame is built with a single constructor call. 2D datasets are
+    # split into name_0, name_1, ... columns (expand_2d), except fields in
+    # first_column_only which keep column 0. columns is an optional
+    # whitelist of output (or base dataset) names.
+    names = []
+    datasets = []
+    
+    def visitor(name, node):
+        if isinstance(node, h5py.Dataset):
+            names.append(name)
+    
+    data = {}
+    with h5py.File(atlfilepath, 'r') as h:
+        if group not in h:
+            return pd.DataFrame()
+        h[group].visititems(visitor)
+        for name in names:
+            key = name.split('/')[-1]
+            dset = h[group + '/' + name]
+            if dset.ndim == 0:
+                continue
+            if (dset.ndim == 2) and (key not in first_column_only):
+                if not expand_2d:
+                    continue
+                cols = [key + '_' + str(i) for i in range(dset.shape[1])]
             else:
-                if len(data.shape) == 2:
-                    cols = data.shape[1]
-                    for idx2 in range(0,cols):
-                        df = pd.concat([df,pd.DataFrame(data[:,idx2],columns=\
-                                                        [key.split('/')[-1] +\
-                                                         '_' + str(idx2)])],
-                                       axis=1)                        
-                else:
-                    df = pd.concat([df,pd.DataFrame(data,columns=\
-                                                    [key.split('/')[-1]])],
-                                   axis=1)
-    return df
+                cols = [key]
+            if columns is not None:
+                keep = [c for c in cols if (c in columns) or (key in columns)]
+                if len(keep) == 0:
+                    continue
+            else:
+                keep = cols
+            datasets.append((key, dset, cols, keep))
+        
+        for key, dset, cols, keep in datasets:
+            if dset.ndim == 1:
+                buf = np.empty(dset.shape, dtype = dset.dtype)
+                if dset.size > 0:
+                    dset.read_direct(buf)
+                data[key] = buf
+            elif len(cols) == 1:
+                buf = np.empty(dset.shape[0], dtype = dset.dtype)
+                if dset.size > 0:
+                    dset.read_direct(buf, source_sel = np.s_[:, 0])
+                data[key] = buf
+            else:
+                buf = np.empty(dset.shape, dtype = dset.dtype)
+                if dset.size > 0:
+                    dset.read_direct(buf)
+                for idx2, col in enumerate(cols):
+                    if col in keep:
+                        data[col] = buf[:, idx2]
+    
+    # Mixed lengths are padded with NaN, matching the old concat behavior
+    lengths = set(len(v) for v in data.values())
+    if len(lengths) > 1:
+        data = dict((k, pd.Series(v)) for k, v in data.items())
+    return pd.DataFrame(data)
+
+# Read ATL03 Heights, put in Pandas DF
+def read_atl03_heights_data(atl03filepath, gt, columns = None):
+    return read_atl_group(atl03filepath, gt + '/heights', columns = columns,
+                          expand_2d = False)
 
+def read_atl03_geolocation(atl03filepath, gt, columns = None):
+    return read_atl_group(atl03filepath, gt + '/geolocation', 
+                          columns = columns, first_column_only = [])
     
 # Read ATL03 Heights, put in Pandas DF
 def read_atl08_land_segments(atl08filepath, gt):
@@ -498,8 +535,12 @@ def match_atl_to_atl03(df, atl03struct):
     return df, rotation_data, epsg
         
 def get_atl03_struct(atl03filepath, gt, atl08filepath = None, epsg = None, 
-                     kml_bounds_txt = None, header_file_path = None):
-    df = read_atl03_heights_data(atl03filepath, gt)
+                     kml_bounds_txt = None, header_file_path = None,
+                     columns = None):
+    # columns: optional heights whitelist, e.g. ATL03_STRUCT_COLUMNS
+    if columns is not None:
+        columns = list(set(columns) | set(ATL03_STRUCT_COLUMNS))
+    df = read_atl03_heights_data(atl03filepath, gt, columns = columns)
     if atl08filepath:
         try:
             df = get_atl03_classification(atl03filepath, atl08filepath, df, gt)
@@ -636,24 +677,51 @@ def get_atl09_struct(atl09filepath, gt, atl03struct = None, epsg = None,
 
     return atl09Struct
 
+def get_geolocation_photon_index(height_len, ph_index_beg, segment_ph_cnt):
+    # Photon index and source segment for every photon covered by a segment
+    ph_index_beg = np.asarray(ph_index_beg).astype(np.int64)
+    segment_ph_cnt = np.asarray(segment_ph_cnt).astype(np.int64)
+    seg = np.nonzero(segment_ph_cnt > 0)[0]
+    counts = segment_ph_cnt[seg]
+    starts = ph_index_beg[seg] - 1
+    # Offset of each photon within its segment, built without a loop
+    offsets = np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts) - 
+                                                    counts, counts)
+    ph_index = np.repeat(starts, counts) + offsets
+    seg_index = np.repeat(seg, counts)
+    valid = (ph_index >= 0) & (ph_index < height_len)
+    return ph_index[valid], seg_index[valid]
+
 def get_geolocation_mapping(height_len, ph_index_beg, segment_ph_cnt, target):
+    n_seg = len(target)
+    ph_index, seg_index = \
+        get_geolocation_photon_index(height_len, ph_index_beg[:n_seg], 
+                                     segment_ph_cnt[:n_seg])
     data = np.zeros(height_len)
-    for i_id in range(0,len(target)):
-        data[ph_index_beg[i_id]-1:\
-             ph_index_beg[i_id]-1 + segment_ph_cnt[i_id]] =\
-             np.full((segment_ph_cnt[i_id]), target[i_id]) 
+    data[ph_index] = np.asarray(target)[seg_index]
+    return data
+
+def get_geolocation_mapping_multi(height_len, ph_index_beg, segment_ph_cnt, 
+                                  targets):
+    # Broadcast several segment fields (dict of arrays) to photons at once
+    ph_index, seg_index = \
+        get_geolocation_photon_index(height_len, ph_index_beg, 
+                                     segment_ph_cnt)
+    data = {}
+    for field in targets:
+        data[field] = np.zeros(height_len)
+        data[field][ph_index] = np.asarray(targets[field])[seg_index]
     return data
 
 def append_atl03_geolocation(heights, geolocation, fields = ['segment_id']):
     height_len = len(heights)
     ph_index_beg = np.array(geolocation.ph_index_beg)
     segment_ph_cnt = np.array(geolocation.segment_ph_cnt)
-    for field in fields:
-        target = np.array(geolocation[field])
-        data = get_geolocation_mapping(height_len, ph_index_beg, 
-                                       segment_ph_cnt, target)
-        heights = pd.concat([heights,pd.DataFrame(data,
-                                columns=[field])],axis=1)
+    targets = dict((field, np.array(geolocation[field])) for field in fields)
+    data = get_geolocation_mapping_multi(height_len, ph_index_beg, 
+                                         segment_ph_cnt, targets)
+    heights = pd.concat([heights,pd.DataFrame(data, columns=fields,
+                                              index=heights.index)],axis=1)
     
     return heights
     
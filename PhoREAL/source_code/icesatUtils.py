@@ -29,6 +29,8 @@ import h5py
 import ctypes
 from numpy.ctypeslib import ndpointer 
 import copy
+import threading
+from functools import lru_cache
 try:
     from osgeo import ogr, osr
 except ImportError:
@@ -153,31 +155,30 @@ def cantorPairing(arrayIn):
     return vectorOut
 
     
+##### Function to view the rows of two 2D arrays as single comparable values
+def getRowView(a_vec, b_vec):
+    
+    # Each row becomes one opaque (void) value, so rows can be compared,
+    # sorted and searched without converting them to strings
+    rowType = np.result_type(a_vec, b_vec)
+    a_vec = np.ascontiguousarray(a_vec, dtype=rowType)
+    b_vec = np.ascontiguousarray(b_vec, dtype=rowType)
+    voidType = np.dtype((np.void, rowType.itemsize * a_vec.shape[1]))
+    a_view = a_vec.view(voidType).ravel()
+    b_view = b_vec.view(voidType).ravel()
+    
+    return a_view, b_view
+
+
 ##### Function to determine members of one array in another
 def ismember(a_vec, b_vec, methodType = 'normal'):
     
     """ MATLAB equivalent ismember function """
     
-    # Combine multi column arrays into a 1-D array of strings if necessary
+    # Combine multi column arrays into a 1-D array of row records if necessary
     # This will ensure unique rows when using np.isin below
     if(methodType.lower() == 'rows'):
-        
-        # Turn a_vec into an array of strings
-        a_str = a_vec.astype('str')
-        b_str = b_vec.astype('str')
-        
-        # Concatenate each column of strings with commas into a 1-D array of strings
-        for i in range(0,np.shape(a_str)[1]):
-            a_char = np.char.array(a_str[:,i])
-            b_char = np.char.array(b_str[:,i])
-            if(i==0):
-                a_vec = a_char
-                b_vec = b_char
-            else:
-                a_vec = a_vec + ',' + a_char
-                b_vec = b_vec + ',' + b_char
-            # endIf
-        # endFor
+        a_vec, b_vec = getRowView(a_vec, b_vec)
     # endIf
     
     # Find which values in a_vec are present in b_vec
@@ -216,18 +217,21 @@ def getIntersection2d(a_vec, b_vec, assume_unique=False):
 ##### Function to determine intersection of two arrays
 def getIntersection(a_vec, b_vec):
     
-    # Get set intersection (common values) of two arrays
-    res_set = set(map(tuple, a_vec)) & set(map(tuple, b_vec)) 
-    commonVals = np.array(list(map(list, res_set))) 
+    # Get intersection (common values) of two arrays as row records
+    a_view, b_view = getRowView(np.asarray(a_vec), np.asarray(b_vec))
+    commonTF = np.isin(a_view, b_view)
     
-    if(commonVals.any()):
+    if(commonTF.any()):
     
-        # Get indices of common values for each array
-        _, a_inds = ismember(commonVals, a_vec, 'rows')
+        # Get indices of first occurrence of common values in each array
+        _, a_first = np.unique(a_view, return_index=True)
+        a_inds = np.sort(a_first[commonTF[a_first]])
+        commonVals = np.asarray(a_vec)[a_inds]
         _, b_inds = ismember(commonVals, b_vec, 'rows')
     
     else:
         
+        commonVals = np.array([])
         a_inds = []
         b_inds = []
         
@@ -236,6 +240,56 @@ def getIntersection(a_vec, b_vec):
     return commonVals, a_inds, b_inds
 
 
+##### Function to find the first index of each value in a reference array
+def getSegmentIndex(segment_id, ref_segment_id):
+    
+    # Returns matchingTF, matchingInds like ismember(segment_id, ref_segment_id)
+    # without unique/isin passes. segment_id values are looked up in a dense
+    # offset table when ref_segment_id spans a compact range (the usual case,
+    # since ATL03 segment ids are sorted and nearly contiguous), otherwise
+    # with a binary search.
+    segment_id = np.asarray(segment_id).astype(np.int64, copy=False)
+    ref_segment_id = np.asarray(ref_segment_id).astype(np.int64, copy=False)
+    
+    matchingTF = np.zeros(len(segment_id), dtype=bool)
+    matchingInds = np.zeros(len(segment_id), dtype=np.int64)
+    if((len(segment_id) == 0) or (len(ref_segment_id) == 0)):
+        return matchingTF, matchingInds[matchingTF]
+    # endIf
+    
+    ref_min = np.min(ref_segment_id)
+    ref_range = np.max(ref_segment_id) - ref_min + 1
+    
+    if(ref_range <= 4*len(ref_segment_id) + 1024):
+        
+        # Offset table, written in reverse so duplicate ids keep first index
+        table = np.full(ref_range, -1, dtype=np.int64)
+        ref_inds = np.arange(len(ref_segment_id), dtype=np.int64)
+        table[ref_segment_id[::-1] - ref_min] = ref_inds[::-1]
+        offset = segment_id - ref_min
+        inRange = (offset >= 0) & (offset < ref_range)
+        matchingInds[inRange] = table[offset[inRange]]
+        matchingTF = matchingInds >= 0
+        matchingTF &= inRange
+        
+    else:
+        
+        # Binary search, stable sort keeps the first index of duplicates
+        if(np.all(ref_segment_id[1:] >= ref_segment_id[:-1])):
+            sorter = np.arange(len(ref_segment_id))
+        else:
+            sorter = np.argsort(ref_segment_id, kind='stable')
+        # endIf
+        pos = np.searchsorted(ref_segment_id, segment_id, sorter=sorter)
+        pos[pos >= len(ref_segment_id)] = len(ref_segment_id) - 1
+        matchingInds = sorter[pos]
+        matchingTF = ref_segment_id[matchingInds] == segment_id
+        
+    # endIf
+    
+    return matchingTF, matchingInds[matchingTF]
+
+
 ##### Function to map ATL08 to ATL03 class photons
 def getAtl08Mapping(atl03_ph_index_beg, atl03_segment_id, atl08_classed_pc_indx, atl08_classed_pc_flag, atl08_segment_id):
       
@@ -244,23 +298,36 @@ def getAtl08Mapping(atl03_ph_index_beg, atl03_segment_id, atl08_classed_pc_indx,
     atl03_ph_index_beg = atl03_ph_index_beg[indsNotZero];
     atl03_segment_id = atl03_segment_id[indsNotZero];
     
-    # Find ATL08 segments that have ATL03 segments
-    atl03SegsIn08TF, atl03SegsIn08Inds = ismember(atl08_segment_id,atl03_segment_id)
+    # Find ATL08 segments that have ATL03 segments. Signal photons come in
+    # runs of the same segment_id, so only the first photon of each run is
+    # looked up and the result is repeated over the run.
+    atl08_segment_id = np.asarray(atl08_segment_id)
+    runStart = np.flatnonzero(np.r_[True, atl08_segment_id[1:] != 
+                                    atl08_segment_id[:-1]])
+    runLength = np.diff(np.r_[runStart, len(atl08_segment_id)])
+    runTF, runInds = getSegmentIndex(atl08_segment_id[runStart],
+                                     atl03_segment_id)
     
     # Get ATL08 classed indices and values
-    atl08classed_inds = atl08_classed_pc_indx[atl03SegsIn08TF]
-    atl08classed_vals = atl08_classed_pc_flag[atl03SegsIn08TF]
+    if(runTF.all()):
+        atl08classed_inds = np.asarray(atl08_classed_pc_indx)
+        atl08classed_vals = np.asarray(atl08_classed_pc_flag)
+    else:
+        atl03SegsIn08TF = np.repeat(runTF, runLength)
+        atl08classed_inds = atl08_classed_pc_indx[atl03SegsIn08TF]
+        atl08classed_vals = atl08_classed_pc_flag[atl03SegsIn08TF]
+    # endIf
 
     # Determine new mapping into ATL03 data
-    atl03_ph_beg_inds = atl03SegsIn08Inds;
-    atl03_ph_beg_val = atl03_ph_index_beg[atl03_ph_beg_inds];
-    newMapping = atl08classed_inds + atl03_ph_beg_val - 2;
+    atl03_ph_beg_val = atl03_ph_index_beg[runInds] - 2
+    newMapping = atl08classed_inds + np.repeat(atl03_ph_beg_val, 
+                                               runLength[runTF])
     
     # Get max size of output array
-    sizeOutput = newMapping[-1]
+    sizeOutput = np.max(newMapping)
     
-    # Pre-populate all photon classed array with zeroes
-    allph_classed = (np.zeros(sizeOutput + 1).astype(int)) - 1
+    # Pre-populate all photon classed array with -1 (unclassified)
+    allph_classed = np.full(sizeOutput + 1, -1, dtype=int)
     
     # Populate all photon classed array from ATL08 classifications
     allph_classed[newMapping] = atl08classed_vals;
@@ -581,13 +648,80 @@ def transform_single_point(x, y, coordTransform):
     return x, y
 
 
+# Size of the process-wide Transformer cache (distinct CRS pairs)
+TRANSFORMER_CACHE_SIZE = 64
+
+# Points per GDAL TransformPoints call in the fallback of transform()
+GDAL_TRANSFORM_CHUNK_SIZE = 1000000
+
+# Transformers are thread-safe from pyproj 3.1 on
+PYPROJ_THREADSAFE = \
+    tuple(int(v) for v in proj.__version__.split('.')[:2]) >= (3, 1)
+
+def get_crs_key(epsg):
+    # 32615, '32615', 'epsg:32615' and 'EPSG:32615' share one cache entry;
+    # anything else (proj4, wkt) is used as given
+    if isinstance(epsg, (int, np.integer)):
+        return 'epsg:%d' % epsg
+    epsg = str(epsg).strip()
+    if epsg.isdigit():
+        return 'epsg:' + epsg
+    if epsg.lower().startswith('epsg:'):
+        return 'epsg:' + epsg[5:].strip()
+    return epsg
+
+@lru_cache(maxsize=TRANSFORMER_CACHE_SIZE)
+def get_cached_transformer(crs_in, crs_out, thread_id=None):
+    return proj.Transformer.from_crs(crs_in, crs_out, always_xy=True)
+
+# Get a (cached) pyproj Transformer from epsg_in to epsg_out
+def get_transformer(epsg_in, epsg_out):
+    # Older pyproj gets one Transformer per thread
+    thread_id = None if PYPROJ_THREADSAFE else threading.get_ident()
+    return get_cached_transformer(get_crs_key(epsg_in), 
+                                  get_crs_key(epsg_out), thread_id)
+
+# Apply transformFunc over x/y in chunks of chunk_size points, writing
+# into x/y when inplace and they are contiguous float64 arrays
+def transform_chunks(transformFunc, x, y, chunk_size=None, inplace=False):
+    if chunk_size is None and not inplace:
+        return transformFunc(x, y)
+    # endIf
+    
+    x = np.asarray(x)
+    y = np.asarray(y)
+    
+    if(inplace and x.dtype == np.float64 and y.dtype == np.float64 and
+       x.flags.c_contiguous and y.flags.c_contiguous and 
+       x.flags.writeable and y.flags.writeable):
+        xx, yy = x, y
+    else:
+        xx = np.empty(x.shape, dtype=np.float64)
+        yy = np.empty(y.shape, dtype=np.float64)
+    # endIf
+    
+    xFlat, yFlat = x.reshape(-1), y.reshape(-1)
+    xxFlat, yyFlat = xx.reshape(-1), yy.reshape(-1)
+    n = xFlat.size
+    step = n if chunk_size is None else max(int(chunk_size), 1)
+    for i0 in range(0, n, step):
+        chunk = slice(i0, i0 + step)
+        xxFlat[chunk], yyFlat[chunk] = transformFunc(xFlat[chunk], 
+                                                     yFlat[chunk])
+    # endFor
+    
+    return xx, yy
+
+
 # Transform GCS/PCS based on EPSG and x/y. 
-def transform(epsg_in, epsg_out, x, y, use_old_version=False):
+def transform(epsg_in, epsg_out, x, y, use_old_version=False, 
+              chunk_size=None, inplace=False):
     try:
         # Using pyproj version 2 and above
         # https://pyproj4.github.io/pyproj/stable/gotchas.html#upgrading-to-pyproj-2-from-pyproj-1
-        transformer = proj.Transformer.from_crs(epsg_in, epsg_out, always_xy=True)
-        xx, yy = transformer.transform(x, y)
+        transformer = get_transformer(epsg_in, epsg_out)
+        xx, yy = transform_chunks(transformer.transform, x, y, 
+                                  chunk_size, inplace)
     except:
         print('PYPROJ failed, attemping with GDAL...')
         if isinstance(epsg_in, str):
@@ -604,15 +738,22 @@ def transform(epsg_in, epsg_out, x, y, use_old_version=False):
         outSpatialRef = osr.SpatialReference()
         outSpatialRef.ImportFromEPSG(epsg_out)
 
-        x = x.astype('float')
-        y = y.astype('float')
+        x = np.asarray(x, dtype='float')
+        y = np.asarray(y, dtype='float')
         
         coordTransform = osr.CoordinateTransformation(inSpatialRef, 
                                                       outSpatialRef)
-        pts = np.asarray([transform_single_point(x[i], y[i], coordTransform) \
-                          for i in range(0,len(x))])
-        xx = pts[:,0]
-        yy = pts[:,1]
+        
+        # One TransformPoints call per chunk instead of one per point
+        def transformPoints(xChunk, yChunk):
+            pts = np.asarray(coordTransform.TransformPoints(
+                np.column_stack((xChunk, yChunk)).tolist()), dtype=float)
+            return pts[:,0], pts[:,1]
+        
+        if chunk_size is None:
+            chunk_size = GDAL_TRANSFORM_CHUNK_SIZE
+        xx, yy = transform_chunks(transformPoints, x, y, chunk_size, 
+                                  inplace)
         print('Projection with GDAL successful!')
     
     
@@ -1116,6 +1257,124 @@ def getRaster_legacy(x, y, z, resolution, method, fillValue = -999, time = [], x
     return GridStruct(rasterDataX, rasterDataY, rasterDataZ, rasterDataT)
 
 
+##### Function to aggregate values that share an integer grid cell
+def getGridAggregate(cellInds, valueList, method):
+    
+    # INPUTS
+    # cellInds = integer cell index of each point
+    # valueList = list of value arrays (e.g. [z, time]), same length as cellInds
+    # method = min, max, mean, median, mode, range, std, or numel
+    #
+    # OUTPUTS
+    # cellsOut = occupied cell indices (sorted)
+    # valsOut = list of aggregated values per occupied cell, one per input
+    #
+    # NaNs are ignored (like np.nanmean, np.nanmedian, ...); cells with only
+    # NaN values return NaN. std is the sample std (ddof = 1, NaN for cells
+    # with fewer than 2 values), as the pandas groupby std used before.
+    # Counts/means/std use np.bincount, min/max use ufunc.reduceat and
+    # median/mode a sort within each cell.
+    
+    cellInds = np.asarray(cellInds, dtype = np.int64)
+    cellsOut, cellGroup = np.unique(cellInds, return_inverse = True)
+    cellGroup = np.ravel(cellGroup)
+    numCells = len(cellsOut)
+    
+    # Sort order by cell, shared by the reduceat based methods
+    if(method in ['min', 'max', 'range']):
+        order = np.argsort(cellGroup, kind = 'stable')
+        starts = np.searchsorted(cellGroup[order], np.arange(numCells))
+    # endIf
+    
+    valsOut = []
+    for values in valueList:
+        
+        values = np.asarray(values, dtype = 'float')
+        valid = np.logical_not(np.isnan(values))
+        
+        if(method == 'numel'):
+            agg = np.bincount(cellGroup, minlength = numCells).astype('float')
+        elif(method in ['mean', 'std']):
+            counts = np.bincount(cellGroup, weights = valid, 
+                                 minlength = numCells)
+            validVals = np.where(valid, values, 0)
+            with np.errstate(invalid = 'ignore', divide = 'ignore'):
+                agg = np.bincount(cellGroup, weights = validVals, 
+                                  minlength = numCells)/counts
+                if(method == 'std'):
+                    # Sample std (ddof = 1) like the pandas groupby std
+                    dev = np.where(valid, values - agg[cellGroup], 0)
+                    sumsq = np.bincount(cellGroup, weights = dev**2, 
+                                        minlength = numCells)
+                    agg = np.where(counts > 1, 
+                                   np.sqrt(sumsq/(counts - 1)), np.nan)
+                # endIf
+            # endWith
+        elif(method in ['min', 'max', 'range']):
+            sortedVals = values[order]
+            if(method == 'min'):
+                agg = np.fmin.reduceat(sortedVals, starts)
+            elif(method == 'max'):
+                agg = np.fmax.reduceat(sortedVals, starts)
+            else:
+                agg = np.fmax.reduceat(sortedVals, starts) - \
+                      np.fmin.reduceat(sortedVals, starts)
+            # endIf
+        else:
+            agg = getSortedCellStat(cellGroup[valid], values[valid], 
+                                    numCells, method)
+        # endIf
+        
+        valsOut.append(agg)
+        
+    # endFor
+    
+    return cellsOut, valsOut
+
+# endDef
+
+
+##### Function to compute median/mode of values in each cell by sorting
+def getSortedCellStat(cellGroup, values, numCells, method):
+    
+    agg = np.full(numCells, np.nan)
+    if(len(values) == 0):
+        return agg
+    # endIf
+    
+    # Sort by cell, then by value, so every cell is a sorted segment
+    order = np.lexsort((values, cellGroup))
+    sortedCells = cellGroup[order]
+    sortedVals = values[order]
+    counts = np.bincount(sortedCells, minlength = numCells)
+    starts = np.cumsum(counts) - counts
+    hasVals = counts > 0
+    
+    if(method == 'median'):
+        
+        lo = sortedVals[(starts + (counts - 1)//2)[hasVals]]
+        hi = sortedVals[(starts + counts//2)[hasVals]]
+        agg[hasVals] = (lo + hi)/2
+        
+    else:
+        
+        # Mode: longest run of equal values, smallest value on ties
+        newRun = np.r_[True, (sortedCells[1:] != sortedCells[:-1]) | 
+                       (sortedVals[1:] != sortedVals[:-1])]
+        runStarts = np.flatnonzero(newRun)
+        runLength = np.diff(np.r_[runStarts, len(sortedVals)])
+        runCells = sortedCells[runStarts]
+        best = np.lexsort((-runLength, runCells))
+        firstRun = np.r_[True, runCells[best][1:] != runCells[best][:-1]]
+        agg[runCells[best][firstRun]] = sortedVals[runStarts[best][firstRun]]
+        
+    # endIf
+    
+    return agg
+
+# endDef
+
+
 ##### Function to grid point cloud data
 def getRaster(x, y, z, resolution, method, fillValue = -999, time = [], xAllArray = [], yAllArray = [],
                 origin=None):
@@ -1184,29 +1443,17 @@ def getRaster(x, y, z, resolution, method, fillValue = -999, time = [], xAllArra
         print("Incorrect resolution input")
 
     # Get grid method
-    if(method.lower() == 'min'):
-        npOperation = np.nanmin
-    elif(method.lower() == 'max'):
-        npOperation = np.nanmax
-    elif(method.lower() == 'mean'):
-        npOperation = np.nanmean
-    elif(method.lower() == 'median'):
-        npOperation = np.nanmedian
-    elif(method.lower() == 'mode'):
-        npOperation = mode
-    elif(method.lower() == 'range'):
-        npOperation = np.range
-    elif(method.lower() == 'std'):
-        npOperation = np.nanstd
-    elif(method.lower() == 'numel'):
-        npOperation = np.size
-    else:
-        npOperation = np.mean
+    method = method.lower()
+    if(method not in ['min', 'max', 'mean', 'median', 'mode', 'range', 
+                      'std', 'numel']):
+        method = 'mean'
     # EndIf
-            
-    # Round all incoming X,Y data
-    xRnd = (np.round(x/xResolution)*xResolution)
-    yRnd = (np.round(y/yResolution)*yResolution)
+    
+    # Get integer cell indices of all incoming X,Y data
+    xCell = np.round(np.asarray(x, dtype = 'float')/xResolution)
+    yCell = np.round(np.asarray(y, dtype = 'float')/yResolution)
+    xRnd = xCell*xResolution
+    yRnd = yCell*yResolution
     
     # Get output X,Y grid cells
     if(any(xAllArray) and any(yAllArray)):
@@ -1230,97 +1477,396 @@ def getRaster(x, y, z, resolution, method, fillValue = -999, time = [], xAllArra
     # Get X,Y array of all pts
     xAllArray, yAllArray = np.meshgrid(xAll,yAll)
     
-    # Get raster X, Y, Z space
+    # Get raster X, Y space
     rasterDataX = xAllArray.astype('float')
     rasterDataY = yAllArray.astype('float')
-    rasterDataZ = fillValue*np.ones((np.shape(rasterDataX))).astype('float')
-    
-    # Make sure input data is of type float
-    if(xRnd.dtype!='float64'):
-        xRnd = xRnd.astype('float')
+    numRows, numCols = np.shape(rasterDataX)
+    
+    # Determine row, column indices (relative to the data min) of each point
+    colInds = (xCell - xCell.min()).astype(np.int64)
+    rowInds = (yCell - yCell.min()).astype(np.int64)
+    cellInds = rowInds*numCols + colInds
+    
+    # Aggregate Z (and time) data in each grid cell in one pass
+    valueList = [z]
+    getTime = (len(time) > 0) and np.any(time)
+    if(getTime):
+        valueList.append(time)
     # endIf
-    if(yRnd.dtype!='float64'):
-        yRnd = yRnd.astype('float')
+    cellsOut, valsOut = getGridAggregate(cellInds, valueList, method)
+    
+    # Populate rastered Z data into array
+    rasterDataZ = fillValue*np.ones(numRows*numCols)
+    rasterDataZ[cellsOut] = valsOut[0]
+    rasterDataZ = np.flipud(rasterDataZ.reshape(numRows, numCols))
+    
+    # Populate rastered time data into array if necessary
+    if(getTime):
+        rasterDataT = fillValue*np.ones(numRows*numCols)
+        rasterDataT[cellsOut] = valsOut[1]
+        rasterDataT = np.flipud(rasterDataT.reshape(numRows, numCols))
+    else:
+        rasterDataT = []
+    # EndIf
+
+    # Return output
+    return GridStruct(rasterDataX, rasterDataY, rasterDataZ, rasterDataT)
+
+# endDef
+
+# Object for getRasterPyramid function
+class GridPyramidStruct:
+    
+    # Define class with designated fields
+    def __init__(self, baseResolution, resolutions, xBase, yBase, numBase, 
+                 statsBase, xEdge, yEdge, valsEdge, xBaseLimits, yBaseLimits):
+        self.baseResolution = baseResolution
+        self.resolutions = resolutions
+        self.xBase = xBase
+        self.yBase = yBase
+        self.xBaseLimits = xBaseLimits
+        self.yBaseLimits = yBaseLimits
+        self.numBase = numBase
+        self.statsBase = statsBase
+        self.xEdge = xEdge
+        self.yEdge = yEdge
+        self.valsEdge = valsEdge
+    # endDef
+# endClass
+
+##### Function to get the common base cell size of a set of resolutions
+def getPyramidBaseResolution(resolutions, maxBaseRatio = 64):
+    
+    # getRaster cells are centered on multiples of the resolution, so the 
+    # cell edges of every level fall on multiples of resolution/2. The base
+    # grid uses the largest cell size dividing all of them; None if there
+    # is none (or it would be more than maxBaseRatio times finer than the
+    # finest level).
+    from fractions import Fraction
+    from functools import reduce
+    from math import gcd
+    
+    halves = []
+    for resolution in np.ravel(resolutions):
+        half = Fraction(float(resolution)/2).limit_denominator(10**6)
+        if(float(half) != float(resolution)/2 or half <= 0):
+            return None
+        # endIf
+        halves.append(half)
+    # endFor
+    if(len(halves) == 0):
+        return None
     # endIf
-    if(z.dtype!='float64'):
-        z = z.astype('float')
+    
+    den = reduce(lambda a, b: a*b//gcd(a, b), [h.denominator for h in halves])
+    num = reduce(gcd, [int(h*den) for h in halves])
+    baseResolution = Fraction(num, den)
+    if(min(halves)*2/baseResolution > maxBaseRatio):
+        return None
     # endIf
     
-    # Get x-rastered, y-rastered, and z data into array
-    data = np.column_stack([xRnd, yRnd, z])
+    return float(baseResolution)
+
+# endDef
+
+##### Function to grid points once for several raster resolutions
+def getRasterPyramid(x, y, z, resolutions, time = [], maxBaseRatio = 64):
     
-    # Put array into Pandas dataframe
-    df = pd.DataFrame(data, columns=['xRnd', 'yRnd', 'z'])
+    # INPUTS
+    # x, y, z = input point arrays
+    # resolutions = raster resolutions the pyramid will be sampled at
+    # time = secondary array (like z), as in getRaster
+    #
+    # OUTPUT
+    # GridPyramidStruct, or None if the resolutions have no common base 
+    # cell (use getRaster for each resolution instead)
+    #
+    # Points are binned once into base cells whose edges line up with the
+    # cell edges of every resolution. Each base cell keeps the sum, count
+    # and sum of squares of the non-NaN values, so getPyramidRaster only
+    # block-sums base cells. Points exactly on a base cell edge (where 
+    # np.round ties may apply) are kept aside and rounded per level, which
+    # keeps the cells identical to getRaster.
+    
+    baseResolution = getPyramidBaseResolution(resolutions, maxBaseRatio)
+    if(baseResolution is None):
+        return None
+    # endIf
     
-    # Do groupby.agg to get get rastered operation for group
-    groupedData = df.groupby(['xRnd', 'yRnd']).agg({'z': [npOperation]})
-    groupedData.columns = ['z_agg']
-    groupedData = groupedData.reset_index()
-    zValsNew = np.array(groupedData['z_agg'])
+    xScaled = np.asarray(x, dtype = 'float')/baseResolution
+    yScaled = np.asarray(y, dtype = 'float')/baseResolution
+    xFloor = np.floor(xScaled)
+    yFloor = np.floor(yScaled)
+    onEdge = (xFloor == xScaled) | (yFloor == yScaled)
+    inBase = np.logical_not(onEdge)
+    
+    valueList = [z]
+    if((len(time) > 0) and np.any(time)):
+        valueList.append(time)
+    # endIf
+    valueList = [np.asarray(values, dtype = 'float') for values in valueList]
+    
+    # Unique base cells (sparse, so fine cells over empty areas cost nothing)
+    xBase = xFloor[inBase].astype(np.int64)
+    yBase = yFloor[inBase].astype(np.int64)
+    if(len(xBase) > 0):
+        xBaseMin, yBaseMin = xBase.min(), yBase.min()
+        numBaseCols = xBase.max() - xBaseMin + 1
+        baseKeys = (yBase - yBaseMin)*numBaseCols + (xBase - xBaseMin)
+    else:
+        xBaseMin, yBaseMin, numBaseCols = 0, 0, 1
+        baseKeys = xBase
+    # endIf
+    baseCells, baseGroup = np.unique(baseKeys, return_inverse = True)
+    baseGroup = np.ravel(baseGroup)
+    numCells = len(baseCells)
+    numBase = np.bincount(baseGroup, minlength = numCells)
+    
+    statsBase = []
+    for values in valueList:
+        values = values[inBase]
+        valid = np.logical_not(np.isnan(values))
+        validVals = np.where(valid, values, 0)
+        statsBase.append((np.bincount(baseGroup, weights = validVals, 
+                                      minlength = numCells),
+                          np.bincount(baseGroup, weights = valid, 
+                                      minlength = numCells),
+                          np.bincount(baseGroup, weights = validVals**2, 
+                                      minlength = numCells)))
+    # endFor
+    
+    # Base cells come out sorted by row (yBase), then column
+    xBaseCells = baseCells%numBaseCols + xBaseMin
+    yBaseCells = baseCells//numBaseCols + yBaseMin
+    if(numCells > 0):
+        xBaseLimits = [int(xBaseCells.min()), int(xBaseCells.max())]
+        yBaseLimits = [int(yBaseCells[0]), int(yBaseCells[-1])]
+    else:
+        xBaseLimits, yBaseLimits = [], []
+    # endIf
     
-    # Determine new row, column indices to place rastered Z data into
-    df_xRnd_min = np.min(groupedData['xRnd'])
-    df_yRnd_min = np.min(groupedData['yRnd'])
-    colIndsNew = ((np.array(groupedData['xRnd']) - df_xRnd_min)/xResolution).astype(int)
-    rowIndsNew = ((np.array(groupedData['yRnd']) - df_yRnd_min)/yResolution).astype(int)
+    return GridPyramidStruct(baseResolution, np.ravel(resolutions), 
+                             xBaseCells, yBaseCells, numBase, 
+                             statsBase, np.asarray(x, dtype = 'float')[onEdge],
+                             np.asarray(y, dtype = 'float')[onEdge],
+                             [values[onEdge] for values in valueList],
+                             xBaseLimits, yBaseLimits)
 
-    # Populate rastered Z data into array
-    rasterDataZ[rowIndsNew, colIndsNew] = zValsNew
-    rasterDataZ = np.flipud(rasterDataZ)
+# endDef
+
+##### Function to get a raster from a getRasterPyramid pyramid
+def getPyramidRaster(pyramid, resolution, method = 'mean', fillValue = -999,
+                     xBounds = None, yBounds = None):
     
-    # Grid 'time' array if necessary
-    if(any(time)):
-        
-        # Get x-rastered, y-rastered, and time data into array
-        if(time.dtype!='float64'):
-            time = time.astype('float')
+    # Returns the same GridStruct as 
+    #   getRaster(x, y, z, resolution, method, fillValue, time)
+    # (up to floating point summation order) by summing base cells;
+    # method is mean, std or numel
+    #
+    # xBounds/yBounds = optional [min, max] window; only the cells centered
+    # inside it are returned (the same cells as the full raster there), and
+    # only the base cells in the window are summed
+    
+    method = method.lower()
+    if(method not in ['mean', 'std', 'numel']):
+        method = 'mean'
+    # endIf
+    
+    resolution = float(resolution)
+    baseRatio = int(round(resolution/pyramid.baseResolution))
+    halfRatio = baseRatio//2
+    
+    # Cell range of the whole pyramid (cells are monotonic in base cells)
+    # and of edge points (rounded like getRaster)
+    xEdgeCell = np.round(pyramid.xEdge/resolution).astype(np.int64)
+    yEdgeCell = np.round(pyramid.yEdge/resolution).astype(np.int64)
+    xCellLimits = np.concatenate([(np.array(pyramid.xBaseLimits, 
+                                            dtype = np.int64) + 
+                                   halfRatio)//baseRatio, xEdgeCell])
+    yCellLimits = np.concatenate([(np.array(pyramid.yBaseLimits, 
+                                            dtype = np.int64) + 
+                                   halfRatio)//baseRatio, yEdgeCell])
+    xCellMin, xCellMax = int(xCellLimits.min()), int(xCellLimits.max())
+    yCellMin, yCellMax = int(yCellLimits.min()), int(yCellLimits.max())
+    if(xBounds is not None):
+        xCellMin = max(xCellMin, int(np.ceil(xBounds[0]/resolution)))
+        xCellMax = min(xCellMax, int(np.floor(xBounds[1]/resolution)))
+    # endIf
+    if(yBounds is not None):
+        yCellMin = max(yCellMin, int(np.ceil(yBounds[0]/resolution)))
+        yCellMax = min(yCellMax, int(np.floor(yBounds[1]/resolution)))
+    # endIf
+    
+    # Base cells in the window: base cells are sorted by row, so the rows
+    # are one searchsorted and the columns a mask over those rows
+    rowStart, rowStop = np.searchsorted(pyramid.yBase, 
+                                        [yCellMin*baseRatio - halfRatio,
+                                         (yCellMax + 1)*baseRatio - halfRatio])
+    baseInds = np.arange(rowStart, rowStop)
+    xBaseCell = (pyramid.xBase[baseInds] + halfRatio)//baseRatio
+    inWindow = (xBaseCell >= xCellMin) & (xBaseCell <= xCellMax)
+    baseInds = baseInds[inWindow]
+    edgeInds = np.flatnonzero((xEdgeCell >= xCellMin) & 
+                              (xEdgeCell <= xCellMax) &
+                              (yEdgeCell >= yCellMin) & 
+                              (yEdgeCell <= yCellMax))
+    xCell = np.concatenate([xBaseCell[inWindow], xEdgeCell[edgeInds]])
+    yCell = np.concatenate([(pyramid.yBase[baseInds] + halfRatio)//baseRatio,
+                            yEdgeCell[edgeInds]])
+    
+    # Get output X,Y grid cells (as in getRaster)
+    xRndMin = xCellMin*resolution
+    xRndMax = xCellMax*resolution
+    yRndMin = yCellMin*resolution
+    yRndMax = yCellMax*resolution
+    xAll = np.arange(xRndMin, xRndMax + resolution, resolution)
+    yAll = np.arange(yRndMax, yRndMin - resolution, -resolution)
+    xAllArray, yAllArray = np.meshgrid(xAll,yAll)
+    rasterDataX = xAllArray.astype('float')
+    rasterDataY = yAllArray.astype('float')
+    numRows, numCols = np.shape(rasterDataX)
+    
+    # Block-sum base cells (and edge points) into raster cells
+    cellInds = (yCell - yCellMin)*numCols + (xCell - xCellMin)
+    def sumCells(baseVals, edgeVals):
+        return np.bincount(cellInds, 
+                           weights = np.concatenate([baseVals[baseInds], 
+                                                     edgeVals[edgeInds]]),
+                           minlength = numRows*numCols)
+    # endDef
+    numGrid = sumCells(pyramid.numBase, np.ones(len(pyramid.xEdge)))
+    occupied = numGrid > 0
+    
+    rasters = []
+    for (sums, counts, sumsqs), valuesEdge in zip(pyramid.statsBase, 
+                                                  pyramid.valsEdge):
+        validEdge = np.logical_not(np.isnan(valuesEdge))
+        valsEdge = np.where(validEdge, valuesEdge, 0)
+        rasterData = fillValue*np.ones(numRows*numCols)
+        if(method == 'numel'):
+            rasterData[occupied] = numGrid[occupied]
+        else:
+            sumGrid = sumCells(sums, valsEdge)[occupied]
+            countGrid = sumCells(counts, validEdge)[occupied]
+            with np.errstate(invalid = 'ignore', divide = 'ignore'):
+                cellVals = sumGrid/countGrid
+                if(method == 'std'):
+                    sumsqGrid = sumCells(sumsqs, valsEdge**2)[occupied]
+                    varGrid = (sumsqGrid - countGrid*cellVals**2)/ \
+                              (countGrid - 1)
+                    cellVals = np.where(countGrid > 1, 
+                                        np.sqrt(np.maximum(varGrid, 0)), 
+                                        np.nan)
+                # endIf
+            # endWith
+            rasterData[occupied] = cellVals
         # endIf
-        dataTime = np.column_stack([xRnd, yRnd, time])
-        
-        # Put array into Pandas dataframe
-        dfTime = pd.DataFrame(dataTime, columns=['xRnd', 'yRnd', 'time'])
-        
-        # Do groupby.agg to get get rastered operation for group
-        groupedDataTime = dfTime.groupby(['xRnd', 'yRnd']).agg({'time': [npOperation]})
-        groupedDataTime.columns = ['time_agg']
-        groupedDataTime = groupedDataTime.reset_index()
-        tValsNew = np.array(groupedDataTime['time_agg'])
-        
-        # Populate rastered Z data into array
-        rasterDataT = fillValue*np.ones((np.shape(rasterDataX)))
-        rasterDataT[rowIndsNew, colIndsNew] = tValsNew
-        rasterDataT = np.flipud(rasterDataT)
-        
-    else:
-        
-        rasterDataT = []
-        
-    # EndIf
-
+        rasters.append(np.flipud(rasterData.reshape(numRows, numCols)))
+    # endFor
+    
+    rasterDataZ = rasters[0]
+    rasterDataT = rasters[1] if len(rasters) > 1 else []
+    
     # Return output
     return GridStruct(rasterDataX, rasterDataY, rasterDataZ, rasterDataT)
 
 # endDef
 
+##### Function to find the common cells of two rasters on the same lattice
+def getIntersectionGrid(gridA, gridB):
+    
+    # Same output as getIntersection2d on the raveled x,y cells of two 
+    # GridStruct rasters (cells sorted by x, then y), using only the 1D
+    # x,y axes of each raster
+    xA, yA = gridA.x[0,:], gridA.y[:,0]
+    xB, yB = gridB.x[0,:], gridB.y[:,0]
+    xCommon, colsA, colsB = np.intersect1d(xA, xB, assume_unique = True, 
+                                           return_indices = True)
+    yCommon, rowsA, rowsB = np.intersect1d(yA, yB, assume_unique = True, 
+                                           return_indices = True)
+    
+    a_inds = np.ravel(rowsA[np.newaxis,:]*len(xA) + colsA[:,np.newaxis])
+    b_inds = np.ravel(rowsB[np.newaxis,:]*len(xB) + colsB[:,np.newaxis])
+    commonVals = np.column_stack([np.repeat(xCommon, len(yCommon)), 
+                                  np.tile(yCommon, len(xCommon))])
+    
+    # Return output
+    return commonVals, a_inds, b_inds
+
+# endDef
+
+
+##### Class for a sorted nearest-neighbour index of a 1D array
+class ClosestIndexStruct:
+    
+    # Define class with designated fields
+    def __init__(self, inputArray, sortedVals, firstInd):
+        self.inputArray = inputArray
+        self.sortedVals = sortedVals
+        self.firstInd = firstInd
+    # endDef
+# endClass
+
+##### Function to build a nearest-neighbour index for getClosest
+def getClosestIndex(inputArray):
+    
+    # Sort once (stable, so equal values keep their original order) and
+    # keep, for every sorted position, the first original index holding
+    # that value. getClosest then needs one searchsorted per query.
+    # Column arrays (n,1), as stored in the ATL structs, index by row
+    inputArray = np.ravel(inputArray)
+    sortInd = np.argsort(inputArray, kind = 'stable')
+    sortedVals = inputArray[sortInd]
+    blockStart = np.searchsorted(sortedVals, sortedVals, side = 'left')
+    firstInd = sortInd[blockStart]
+    
+    return ClosestIndexStruct(inputArray, sortedVals, firstInd)
+
+# endDef
 
 ##### Function to find closest points in an array
 def getClosest(inputArray, closestPts):
     
-    # Initialize outputs
-    minInd = np.zeros(np.shape(closestPts), dtype = int)
-    minVal = np.zeros(np.shape(closestPts))
+    # inputArray can be an array or a ClosestIndexStruct from
+    # getClosestIndex (to reuse the index across calls). Returns the
+    # closest value and its index in inputArray for each point; on ties
+    # the lowest index wins, as with np.argmin.
+    if(isinstance(inputArray, ClosestIndexStruct)):
+        closestIndex = inputArray
+    else:
+        closestIndex = getClosestIndex(inputArray)
+    # endIf
+    
+    sortedVals = closestIndex.sortedVals
+    firstInd = closestIndex.firstInd
+    numVals = len(sortedVals)
+    ptsShape = np.shape(closestPts)
+    closestPts = np.ravel(np.asarray(closestPts, dtype = float))
+    if(numVals == 0):
+        raise ValueError('getClosest: inputArray is empty')
+    # endIf
+    
+    # Candidates on either side of each point
+    upper = np.searchsorted(sortedVals, closestPts, side = 'left')
+    lower = np.maximum(upper - 1, 0)
+    upper = np.minimum(upper, numVals - 1)
+    lowerDif = np.abs(closestPts - sortedVals[lower])
+    upperDif = np.abs(sortedVals[upper] - closestPts)
+    lowerInd, upperInd = firstInd[lower], firstInd[upper]
+    useUpper = (upperDif < lowerDif) | \
+               ((upperDif == lowerDif) & (upperInd < lowerInd))
     
-    # Loop through closest points array and find closest point to input array
-    for i in range(0,len(closestPts)):
-        closestPt = closestPts[i]
-        arrayDif = np.abs(inputArray - closestPt)
-        minInd[i] = np.argmin(arrayDif) 
-        minVal[i] = inputArray[minInd[i]]
-    # EndFor
+    # Initialize outputs
+    minInd = np.where(useUpper, upperInd, lowerInd).astype(int)
+    minVal = closestIndex.inputArray[minInd].astype(float)
+    minInd = minInd.reshape(ptsShape)
+    minVal = minVal.reshape(ptsShape)
         
     # Return outputs
     return minVal, minInd
 
+# endDef
+
 def __appendGlobalList(name):
     if name:
         global_list.append(name)
@@ -1394,31 +1940,68 @@ def sortAtlTruth(atlTruthData, verbose=False):
     # endIF
     return atlTruthData
 
-def indexMatch(measuredArray,truthArray,verbose=False):
-    if(verbose):
-        print("Match corresponding indices...", end = " ")
-    # endIf
-    A = np.array(measuredArray)
-    B = np.array(truthArray)
-    C = np.empty((len(B)))
+##### Function to load the ctypes closest library (closest.c), if available
+@lru_cache(maxsize = 1)
+def getClosestLib():
     
-    
-    if os.name == 'nt':
-        lib = ctypes.cdll.LoadLibrary(os.path.abspath(superFilterFile_windows))
-    else:
-        lib = ctypes.cdll.LoadLibrary(os.path.abspath(superFilterFile_linux))
-    fun = lib.cfun
+    try:
+        if os.name == 'nt':
+            lib = ctypes.cdll.LoadLibrary(os.path.abspath(superFilterFile_windows))
+        else:
+            lib = ctypes.cdll.LoadLibrary(os.path.abspath(superFilterFile_linux))
+        # endIf
+        fun = lib.cfun
+    except (OSError, AttributeError):
+        return None
+    # endTry
     fun.restype = None
     fun.argtypes = [ndpointer(ctypes.c_double, flags="C_CONTIGUOUS"),
             ctypes.c_size_t,
             ndpointer(ctypes.c_double, flags="C_CONTIGUOUS"),
             ndpointer(ctypes.c_double, flags="C_CONTIGUOUS"),
             ctypes.c_size_t]
-    fun(A, A.size, B, C, B.size)
+    
+    return fun
+
+# endDef
+
+def indexMatch(measuredArray,truthArray,verbose=False,useLib=False):
+    
+    # Index of the closest measuredArray value for each truthArray value
+    # (both sorted ascending). Ties go to the upper index, values before 
+    # the first measured value get 0 and values at or past the last one get
+    # len(measuredArray), as in closest.c (the NumPy path does not need 
+    # truthArray sorted). useLib = True uses the ctypes library when it can
+    # be loaded.
+    if(verbose):
+        print("Match corresponding indices...", end = " ")
+    # endIf
+    A = np.asarray(measuredArray)
+    B = np.asarray(truthArray)
+    
+    fun = getClosestLib() if useLib else None
+    if(fun is not None):
+        A = np.ascontiguousarray(A, dtype = np.float64)
+        B = np.ascontiguousarray(B, dtype = np.float64)
+        C = np.empty((len(B)))
+        fun(A, A.size, B, C, B.size)
+        C = C.astype(int)
+    elif(len(A) == 0):
+        C = np.zeros(len(B), dtype = int)
+    else:
+        upper = np.searchsorted(A, B, side = 'right')
+        lower = np.maximum(upper - 1, 0)
+        upperClip = np.minimum(upper, len(A) - 1)
+        useUpper = (B - A[lower]) >= (A[upperClip] - B)
+        C = np.where(useUpper, upperClip, lower)
+        C[B < A[0]] = 0
+        C[B >= A[-1]] = len(A)
+    # endIf
+    
     if(verbose):
         print("Complete")
     # endIf
-    return np.array(C).astype(int)
+    return C
 
     
 def superFilter(atlMeasuredData_in, atlTruthData_in, xBuf = 7, classCode = [], verbose=False):
@@ -2189,93 +2772,77 @@ def calc_rdm_segment(t, c, segment_id_beg, segment_id_end, segment_id, ph_index_
         This functions can handle when 03/08 do not totally overlap,
         or when there is no overlap. That said, one should proceed with
         caution knowing 03 and 08 do not overlap at all. NaN values are
-        initialized in rdm vectors based on these cases.
+        initialized in rdm vectors based on these cases. A partially
+        covered 08 segment uses only the 03 geolocation segments inside
+        [segment_id_beg, segment_id_end]; segment_id must be increasing.
 
     """
 
     if np.isnan(c).sum() > 0 and debug:
         print('warning: NaN values found in c')
 
+    segment_id_beg = np.asarray(segment_id_beg)
+    segment_id_end = np.asarray(segment_id_end)
+    segment_id = np.asarray(segment_id)
+    ph_index_beg = np.asarray(ph_index_beg)
+    segment_ph_cnt = np.asarray(segment_ph_cnt)
+
     rdm_ground = np.full(segment_id_beg.shape, np.nan)
     rdm_veg = np.full(segment_id_beg.shape, np.nan)
     rdm_canopy = np.full(segment_id_beg.shape, np.nan)
     n_shots_unique = np.full(segment_id_beg.shape, np.nan)
-    
-    n_id = len(segment_id)
-    for s in range(len(segment_id_beg)):
-#        _, k0 = iu.getClosest(segment_id, [segment_id_beg[s]])
-#        _, k1 = iu.getClosest(segment_id, [segment_id_end[s]])
-        _, k0 = getClosest(segment_id, [segment_id_beg[s]])
-        _, k1 = getClosest(segment_id, [segment_id_end[s]])
-        k0, k1 = int(k0), int(k1)
-        
-        warn = False
-        b_edge = False
-        if segment_id[k0] < segment_id_beg[s]:
-            # left side incomplete
-            # cm.pause('beg')
-            k = k0
-            while segment_id[k] < segment_id_beg[s]:
-                k += 1
-                if k >= n_id:
-                    b_edge = True
-                    break
-
-        elif segment_id[k0] > segment_id_beg[s]:
-            # print('warning: 03 seg id beg %d > 08 seg id beg %d' % (segment_id[k0], segment_id_beg[s]))
-            warn = True
-
-        # else:
-            # equal, totally fine
-
-        # if segment_id[k1] != segment_id_end[s]:
-        if segment_id[k1] > segment_id_end[s]:
-            # right side incomplete
-            # cm.pause('end')
-            k = k1
-            while segment_id[k] > segment_id_end[s]:
-                k -= 1
-                if k < 0:
-                    b_edge = True
-                    break
-
-        elif segment_id[k1] < segment_id_end[s]:
-            # print('warning: 03 seg id beg %d < 08 seg id beg %d' % (segment_id[k0], segment_id_beg[s]))
-            warn = True
-
-        # else:
-            # equal, totally fine
-
-        if b_edge and debug:
-            # 08 segment is entirely outside of 03 segment data
-            print('outside')
-            print('03: [%d, %d]' % (segment_id[k0], segment_id[k1]))
-            print('08: [%d, %d]' % (segment_id_beg[s], segment_id_end[s]))
-            # cm.pause()
-            input('enter to continue')
-            continue
 
-        if warn and debug:
-            print('partial')
-            print('03: [%d, %d]' % (segment_id[k0], segment_id[k1]))
+    n_id = len(segment_id)
+    if n_id == 0 or len(segment_id_beg) == 0:
+        return n_shots_unique, rdm_ground, rdm_veg, rdm_canopy
+
+    # first/last 03 geolocation segment inside each 08 segment
+    # (segment_id is increasing along track)
+    k0 = np.searchsorted(segment_id, segment_id_beg, side='left')
+    k1 = np.searchsorted(segment_id, segment_id_end, side='right') - 1
+    b_inside = (k0 < n_id) & (k1 >= 0) & (k0 <= k1)
+    k0c, k1c = np.minimum(k0, n_id-1), np.maximum(k1, 0)
+
+    if debug:
+        b_partial = b_inside & ((segment_id[k0c] != segment_id_beg) | 
+                                (segment_id[k1c] != segment_id_end))
+        for s in np.flatnonzero(~b_inside | b_partial):
+            # 08 segment is entirely outside of / partially covered by 03 data
+            print('outside' if not b_inside[s] else 'partial')
+            print('03: [%d, %d]' % (segment_id[k0c[s]], segment_id[k1c[s]]))
             print('08: [%d, %d]' % (segment_id_beg[s], segment_id_end[s]))
-            # cm.pause()
             input('enter to continue')
 
-        i0, i1 = ph_index_beg[k0], ph_index_beg[k1] + segment_ph_cnt[k1] - 1
-
-        t_seg = t[i0:i1+1] # inclusive index
-        c_seg = c[i0:i1+1]
-
-        n_shots_total_uq = len(np.unique(t_seg))
-        n_shots_ground = (c_seg == 1).sum()
-        n_shots_veg = (c_seg == 2).sum()
-        n_shots_canopy = (c_seg == 3).sum()
-
-        n_shots_unique[s] = n_shots_total_uq
-        rdm_ground[s] = float(n_shots_ground / n_shots_total_uq)
-        rdm_veg[s] = float(n_shots_veg / n_shots_total_uq)
-        rdm_canopy[s] = float(n_shots_canopy / n_shots_total_uq)
+    # inclusive photon index range of each 08 segment
+    seg = np.flatnonzero(b_inside)
+    i0 = ph_index_beg[k0[seg]].astype(np.int64)
+    i1 = (ph_index_beg[k1[seg]] + segment_ph_cnt[k1[seg]] - 1).astype(np.int64)
+    i0 = np.clip(i0, 0, len(t))
+    n_ph = np.maximum(np.minimum(i1 + 1, len(t)) - i0, 0)
+
+    # photon indices of every segment, labeled by position in seg
+    n_tot = n_ph.sum()
+    label = np.repeat(np.arange(len(seg)), n_ph)
+    idx = np.arange(n_tot) - np.repeat(np.cumsum(n_ph) - n_ph, n_ph) + \
+        np.repeat(i0, n_ph)
+    t_seg, c_seg = np.asarray(t)[idx], np.asarray(c)[idx]
+
+    # unique shot times per segment: sort by (segment, time), count changes
+    order = np.lexsort((t_seg, label))
+    label_sort, t_sort = label[order], t_seg[order]
+    b_new = np.ones(n_tot, dtype=bool)
+    b_new[1:] = (label_sort[1:] != label_sort[:-1]) | (t_sort[1:] != t_sort[:-1])
+    n_shots_total_uq = np.bincount(label_sort[b_new], minlength=len(seg))
+
+    n_shots_ground = np.bincount(label, weights=(c_seg == 1), minlength=len(seg))
+    n_shots_veg = np.bincount(label, weights=(c_seg == 2), minlength=len(seg))
+    n_shots_canopy = np.bincount(label, weights=(c_seg == 3), minlength=len(seg))
+
+    n_shots_unique[seg] = n_shots_total_uq
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rdm_ground[seg] = n_shots_ground / n_shots_total_uq
+        rdm_veg[seg] = n_shots_veg / n_shots_total_uq
+        rdm_canopy[seg] = n_shots_canopy / n_shots_total_uq
 
     return n_shots_unique, rdm_ground, rdm_veg, rdm_canopy
 
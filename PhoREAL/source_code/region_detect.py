@@ -359,7 +359,8 @@ def filt_reg(x, y, regions, equal=False):
     return x_filt, y_filt, jr
 
 
-def density_detect(x, z, r_min=1e-3, r_max=25.0, loading_bar=False, num_cmp=None):
+def density_detect(x, z, r_min=1e-3, r_max=25.0, loading_bar=False, num_cmp=None,
+                    chunk_size=2**22):
 
     """
     This function creates a density map out of point data,
@@ -381,6 +382,8 @@ def density_detect(x, z, r_min=1e-3, r_max=25.0, loading_bar=False, num_cmp=None
         loading_bar - boolean to activate tqdm loading
         num_cmp - option (int) to cap how many points
                     can be used in density calc
+        chunk_size - approximate number of (point, neighbor)
+                    pairs evaluated at once; bounds memory
     
     Output:
         Returns density, rho, and number of points used
@@ -419,6 +422,9 @@ def density_detect(x, z, r_min=1e-3, r_max=25.0, loading_bar=False, num_cmp=None
         fig.show()
 
     Caveats:
+        x does not need to be sorted; neighbors are found
+        with np.searchsorted on a sorted copy of x.
+
         Does not handle effects on ends of data;
         that is, density will appear less on the
         edges since data does not exist further.
@@ -432,74 +438,69 @@ def density_detect(x, z, r_min=1e-3, r_max=25.0, loading_bar=False, num_cmp=None
         limit_cmp = True
         num_cmp = int(num_cmp)
 
+    x = np.asarray(x, dtype=float).ravel()
+    z = np.asarray(z, dtype=float).ravel()
     n = len(x)
     rho = np.zeros(n)
     num_pts = np.zeros(n)
+    if n == 0:
+        return rho, num_pts
 
-    from tqdm import tqdm
-    iterator = range(n)
-    if loading_bar:
-        from tqdm import tqdm
-        iterator = tqdm(range(n))
-
-    for j in iterator:
-
-        x1, x2, x3 = x[j]-r_max, x[j], x[j]+r_max
+    # sort by x so each point's neighbors form one window
+    sort_idx = np.argsort(x, kind='stable')
+    xs, zs = x[sort_idx], z[sort_idx]
 
-        dj = 0
-        while True:
-            if j-dj > 0:
-                if not (x[j-dj] > x1):
-                    dj += 1
-                    break
-            else:
-                break
-            dj += 1
-        dj_lower = dj
-
-        dj = 0
-        while True:
-            if j+dj < n:
-                if not (x[j+dj] < x3):
-                    dj -= 1
-                    break
-            else:
-                break
-            dj += 1
-        dj_upper = dj
+    # window [lo, hi) of points within r_max in x, for all points
+    lo = np.searchsorted(xs, xs - r_max, side='right')
+    hi = np.searchsorted(xs, xs + r_max, side='left')
+    win = hi - lo
 
+    # split points into blocks of about chunk_size (point, neighbor) pairs
+    win_cum = np.cumsum(win)
+    block_ends = np.searchsorted(win_cum, 
+        np.arange(chunk_size, win_cum[-1], chunk_size), side='right')
+    block_ends = np.unique(np.concatenate([block_ends, [n]]))
+    block_ends = block_ends[block_ends > 0]
+    block_starts = np.concatenate([[0], block_ends[:-1]])
 
-        x_reg, z_reg = x[j-dj_lower:j+dj_upper+1], z[j-dj_lower:j+dj_upper+1]
-        # if abs(x_reg[0] - x1) > dr:
-        #   continue
-        # elif abs(x_reg[1] - x3) > dr:
-        #   continue
+    iterator = zip(block_starts, block_ends)
+    if loading_bar:
+        from tqdm import tqdm
+        iterator = tqdm(list(iterator))
 
-        if len(x_reg) == 0:
-            continue
+    rho_s = np.zeros(n)
+    num_s = np.zeros(n)
+    for j0, j1 in iterator:
 
-        dx_reg = abs(x_reg - x[j])
-        dz_reg = abs(z_reg - z[j])
+        # expand each point in block to its window of neighbors
+        w = win[j0:j1]
+        j_pair = np.repeat(np.arange(j0, j1), w)
+        k_pair = np.repeat(lo[j0:j1] - np.cumsum(w) + w, w) + \
+                    np.arange(w.sum())
 
+        dx_reg = xs[k_pair] - xs[j_pair]
+        dz_reg = zs[k_pair] - zs[j_pair]
         r_reg = np.sqrt(dx_reg**2 + dz_reg**2)
-        r_reg = r_reg[(r_reg > r_min) & (r_reg < r_max)]
 
-        if len(r_reg) == 0:
-            continue
-        
-        # up to num_cmp points considered
-        if limit_cmp:
-            r_reg = np.sort(r_reg)
-            nr = min(len(r_reg), num_cmp)
-            r_reg = r_reg[:nr]
-
-        num_pts[j] = len(r_reg)
-        k_reg = 1.0 / r_reg
-
-        # rho[j] = np.mean(k_reg)
-        rho[j] = sum(k_reg)
-        # rho[j] = np.log10(sum(k_reg))
+        keep = (r_reg > r_min) & (r_reg < r_max)
+        j_pair, r_reg = j_pair[keep], r_reg[keep]
 
+        # up to num_cmp (closest) points considered
+        if limit_cmp:
+            order = np.lexsort((r_reg, j_pair))
+            j_pair, r_reg = j_pair[order], r_reg[order]
+            first = np.searchsorted(j_pair, j_pair, side='left')
+            rank = np.arange(len(j_pair)) - first
+            keep = rank < num_cmp
+            j_pair, r_reg = j_pair[keep], r_reg[keep]
+
+        num_s[j0:j1] = np.bincount(j_pair - j0, minlength=j1-j0)
+        rho_s[j0:j1] = np.bincount(j_pair - j0, weights=1.0/r_reg, 
+                                    minlength=j1-j0)
+
+    # back to input order
+    rho[sort_idx] = rho_s
+    num_pts[sort_idx] = num_s
 
     return rho, num_pts
 
@@ -13,45 +13,164 @@ import pickle as pl
 
 
 # List Files
-def create_master(pickle_folder, pickle_list):
-    # Load Pkl
-    idx = 0
-    for file_name in pickle_list:
-        year, month, day = identify_date(file_name)
-        file = pickle_folder + "/" + file_name
-        gtstr = file_name.split('_')[-3]
-        spot, strongbeam, flying, _, _, _ = identify_spot_beam_str(gtstr, 
-                                                                   year, month, 
-                                                                   day)
-        
+def get_pickle_meta(pickle_list):
+    # Vectorized identify_date/identify_spot_beam_str over a list of
+    # per-beam pickle names, one row per file
+    forward = {
+        'gt3r' : 1,
+        'gt3l' : 2,
+        'gt2r' : 3,
+        'gt2l' : 4,
+        'gt1r' : 5,
+        'gt1l' : 6
+        }
+    
+    backward = {
+        'gt3l' : 1,
+        'gt3r' : 2,
+        'gt2l' : 3,
+        'gt2r' : 4,
+        'gt1l' : 5,
+        'gt1r' : 6
+        }
+
+    names = pd.Series(list(pickle_list), dtype=object)
+    date = names.str.split('.pkl').str[0].str.split('_').str[1]
+    year = date.str[0:4].astype(np.int64).values
+    month = date.str[4:6].astype(np.int64).values
+    day = date.str[6:8].astype(np.int64).values
+    gt = names.str.split('_').str[-3]
+
+    is_forward = (((year == 2019) & (month > 9)) |
+                  ((year == 2019) & (month == 9) & (day >= 9)) |
+                  ((year == 2018) & (month == 12) & (day <= 28)) |
+                  ((year == 2018) & (month < 12)))
+    spot = np.where(is_forward, gt.map(forward), gt.map(backward))
+    if np.isnan(spot.astype(float)).any():
+        raise KeyError('unknown ground track in %s' % 
+                       list(names[np.isnan(spot.astype(float))]))
+    side = gt.str[-1].values
+    strongbeam = np.where(is_forward, side == 'r', side == 'l')
+    flying = np.where(is_forward, 'forward', 'backward').astype(object)
+
+    meta = pd.DataFrame({'year': year, 'month': month, 'day': day,
+                         'gt': gt.values.astype(object),
+                         'strongbeam': strongbeam.astype(np.int64),
+                         'spot': spot.astype(np.int64), 
+                         'flying': flying})
+    return meta
+
+def read_segment_pickle(file):
+    # Read one per-beam pickle; None (with the reason) if unreadable
+    try:
+        df = pd.read_pickle(file)
+        df.dropna(subset=['truth_n_ground'],inplace=True)
+    except (OSError, EOFError, KeyError, pl.UnpicklingError) as e:
+        return None, e
+    return df, None
+
+def read_master_cache(cache_file):
+    # Consolidated Parquet cache of per-beam pickles, keyed by the
+    # pickle_file/pickle_mtime columns
+    if cache_file is None or not os.path.exists(cache_file):
+        return None
+    try:
+        return pd.read_parquet(cache_file)
+    except ImportError:
+        print('warning: no parquet engine found, cache not used')
+    except (OSError, ValueError) as e:
+        print('warning: unable to read cache %s: %s' % (cache_file, e))
+    return None
+
+def write_master_cache(cache_file, frames, files, mtimes):
+    # Write the cache atomically, so an interrupted run keeps the old one
+    frames_cache = []
+    for df, file, mtime in zip(frames, files, mtimes):
+        if df is None:
+            continue
+        df = df.copy()
+        df['pickle_file'] = file
+        df['pickle_mtime'] = mtime
+        frames_cache.append(df)
+    if len(frames_cache) == 0:
+        return
+    cache_tmp = cache_file + '.tmp'
+    try:
+        pd.concat(frames_cache).to_parquet(cache_tmp)
+        os.replace(cache_tmp, cache_file)
+    except ImportError:
+        print('warning: no parquet engine found, cache not written')
+    except (OSError, ValueError, TypeError) as e:
+        print('warning: unable to write cache %s: %s' % (cache_file, e))
+        if os.path.exists(cache_tmp):
+            os.remove(cache_tmp)
+
+def create_master(pickle_folder, pickle_list, workers = 8, cache_file = None):
+    # Load every per-beam pickle in pickle_list (thread pool), add the
+    # date/beam columns derived from the file names and concatenate once.
+    # With cache_file (.parquet), pickles whose mtime is unchanged are
+    # read back from the consolidated cache instead.
+    from concurrent.futures import ThreadPoolExecutor
+
+    pickle_list = list(pickle_list)
+    meta = get_pickle_meta(pickle_list)
+    files = [pickle_folder + "/" + file_name for file_name in pickle_list]
+    mtimes = np.full(len(files), np.nan)
+    for i, file in enumerate(files):
         try:
-            print(file)
-            
-            if idx == 0:
-                master = pd.read_pickle(file)
-                master.dropna(subset=['truth_n_ground'],inplace=True)
-                master['year'] = year
-                master['month'] = month
-                master['day'] = day
-                master['gt'] = gtstr
-                master['strongbeam'] = strongbeam
-                master['spot'] = spot
-                master['flying'] = flying
-                idx = idx + 1
-            else:
-                df = pd.read_pickle(file)
-                df.dropna(subset=['truth_n_ground'],inplace=True)
-                df['year'] = year
-                df['month'] = month
-                df['day'] = day
-                df['gt'] = gtstr
-                df['strongbeam'] = strongbeam
-                df['spot'] = spot
-                df['flying'] = flying
-                master = pd.concat([master, df])
-                idx = idx + 1
-        except:
-            print('Does not exist')
+            mtimes[i] = os.path.getmtime(file)
+        except OSError:
+            pass
+
+    # Reuse cached pickles with an unchanged mtime
+    frames = [None] * len(files)
+    cache = read_master_cache(cache_file)
+    frames_other, files_other, mtimes_other = [], [], []
+    if cache is not None:
+        file_index = {}
+        for i, file in enumerate(files):
+            file_index.setdefault(file, []).append(i)
+        for (file, mtime), df in cache.groupby(['pickle_file','pickle_mtime'],
+                                               sort=False):
+            df = df.drop(columns=['pickle_file','pickle_mtime'])
+            hit = [i for i in file_index.get(file, []) if mtimes[i] == mtime]
+            for i in hit:
+                frames[i] = df
+            if file not in file_index:
+                # still valid for other pickle lists
+                try:
+                    if os.path.getmtime(file) == mtime:
+                        frames_other.append(df)
+                        files_other.append(file)
+                        mtimes_other.append(mtime)
+                except OSError:
+                    pass
+    idx_read = [i for i in range(len(files)) if frames[i] is None]
+
+    # Read the rest in parallel
+    with ThreadPoolExecutor(max_workers = max(int(workers),1)) as pool:
+        results = list(pool.map(read_segment_pickle, 
+                                [files[i] for i in idx_read]))
+    for i, (df, error) in zip(idx_read, results):
+        print(files[i])
+        if df is None:
+            print('Unable to read %s: %s' % (files[i], error))
+        frames[i] = df
+
+    if cache_file is not None and len(idx_read) > 0:
+        write_master_cache(cache_file, frames + frames_other, 
+                           files + files_other, 
+                           list(mtimes) + mtimes_other)
+
+    # Concatenate once, then repeat the per-file metadata over the rows
+    valid = [i for i in range(len(frames)) if frames[i] is not None]
+    if len(valid) == 0:
+        return pd.DataFrame()
+    master = pd.concat([frames[i] for i in valid])
+    counts = np.array([len(frames[i]) for i in valid])
+    meta = meta.iloc[valid]
+    for col in meta.columns:
+        master[col] = np.repeat(meta[col].values, counts)
     return master
 
 def identify_strong_beam(atlname):
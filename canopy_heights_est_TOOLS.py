@@ -7,11 +7,15 @@ TODO: GEDI Implementation?
 '''
 
 from getAtlMeasuredSwath_auto import getAtlMeasuredSwath
+from icesatIO import readColumnarFile
 import glob
+import json
 import os
 #import sys
+import traceback
 import urllib
 import zipfile
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from pathlib import Path
 
@@ -23,6 +27,12 @@ import pandas as pd
 #from pandas.core.reshape.reshape import stack_multiple
 #from shapely.validation import make_valid
 from tqdm.notebook import tqdm_notebook
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    print('warning: module pyarrow not found')
+    print('affected functions: CanopyHeightsWriter (parquet output)')
 
 # Import PhoREAL 'getAtlMeasuredSwath' tool
 # print(os.getcwd())
@@ -32,6 +42,17 @@ os.chdir('C:/Users/albp/OneDrive - DHI/Documents/GitHub/icesat2_canopy_heights/P
 # Get todays date for downloading data
 today = datetime.today().strftime('%Y-%m-%d')
 
+# Photon .csv columns needed to estimate canopy heights
+PHOTON_CSV_COLUMNS = ['Beam Num', 'Latitude (deg)', 'Longitude (deg)',
+                      'Along-Track (m)', 'Height (m MSL)', 'Signal Confidence']
+
+# Extensions of per-beam photon files written by getAtlMeasuredSwath
+PHOTON_FILE_EXTENSIONS = ['.csv', '.parquet', '.feather', '.npz']
+
+# Columns of the merged canopy heights output
+CANOPY_COLUMNS = ['Beam Num_mean', 'latitude', 'longitude',
+                  'canopy_height_est', 'year', 'track']
+
 
 def download_icesat(
         data_type='ATL03',
@@ -73,6 +94,342 @@ def download_icesat(
         print('No storage directory given.')
 
 
+def bin_canopy_heights(
+        along_track,
+        height,
+        signal_conf,
+        lat,
+        lon,
+        along_track_res=10):
+    '''
+    Description:
+        Estimate ground, top of canopy (T.O.C.) and canopy height per
+        along-track bin. Photons are sorted once by along-track distance and
+        every bin statistic is reduced with ufunc.reduceat over the bin
+        boundaries. Bins match pd.cut(bins=nbins) over the along-track extent
+        of the photons with signal confidence > 0, with nbins taken from the
+        extent of the med. & high confidence (> 2) photons.
+    Parameters:
+        along_track - Along-track distance of each photon (meters).
+        height - Height of each photon (m MSL).
+        signal_conf - ATL03 signal confidence of each photon.
+        lat - Latitude of each photon (degrees).
+        lon - Longitude of each photon (degrees).
+        along_track_res - Resolution at which to derive canopy heights (meters).
+    Returns:
+        DataFrame with one row per non-empty bin and the columns 'latitude',
+        'longitude', 'ground_est', 'toc_est' and 'canopy_height_est'.
+        Raises ValueError if the photons cannot be binned.
+    '''
+    along_track = np.ravel(along_track)
+    height = np.ravel(height)
+    signal_conf = np.ravel(signal_conf)
+    lat = np.ravel(lat)
+    lon = np.ravel(lon)
+
+    # Calculate # of bins required for given resolution from med. & high
+    # signal confidence returns
+    medhigh = along_track[signal_conf > 2]
+    if medhigh.size == 0:
+        raise ValueError('No med. or high confidence photons to bin.')
+    nbins = int((medhigh.max() - medhigh.min()) / along_track_res)
+    if nbins < 1:
+        raise ValueError('Along-track extent shorter than one bin.')
+
+    # Filter data to x classes for canopy estimations and sort along-track
+    canopy = signal_conf > 0
+    order = np.argsort(along_track[canopy], kind='stable')
+    along_track = along_track[canopy][order]
+    height = height[canopy][order]
+    lat = lat[canopy][order]
+    lon = lon[canopy][order]
+
+    # Equal-width bin edges, right-closed as in pd.cut
+    at_min, at_max = along_track[0], along_track[-1]
+    if at_min == at_max:
+        at_min -= 0.001 * abs(at_min) if at_min != 0 else 0.001
+        at_max += 0.001 * abs(at_max) if at_max != 0 else 0.001
+        edges = np.linspace(at_min, at_max, nbins + 1)
+    else:
+        edges = np.linspace(at_min, at_max, nbins + 1)
+        edges[0] -= (at_max - at_min) * 0.001
+    bin_id = np.clip(np.searchsorted(edges, along_track, side='left') - 1,
+                     0, nbins - 1)
+
+    # Start of each non-empty bin in the sorted photons
+    starts = np.flatnonzero(np.r_[True, bin_id[1:] != bin_id[:-1]])
+    counts = np.diff(np.r_[starts, along_track.size])
+
+    # Lowest return is the 'ground', 95% of the highest return the T.O.C.
+    ground_est = np.fmin.reduceat(height, starts)
+    toc_est = np.fmax.reduceat(height, starts) * 0.95
+
+    d_mean = pd.DataFrame({
+        'latitude': np.add.reduceat(lat, starts) / counts,
+        'longitude': np.add.reduceat(lon, starts) / counts,
+        'ground_est': ground_est,
+        'toc_est': toc_est,
+        'canopy_height_est': toc_est - ground_est})
+
+    # Remove bins with no canopy height estimations
+    return d_mean[~np.isnan(toc_est)].reset_index(drop=True)
+
+
+def estimate_canopy_heights(atl03Data, along_track_res=10):
+    '''
+    Description:
+        Estimate canopy heights of one beam directly from the atl03Struct
+        returned by getAtlMeasuredSwath, without writing photon .csv files.
+    Parameters:
+        atl03Data - atl03Struct of the beam.
+        along_track_res - Resolution at which to derive canopy heights (meters).
+    Returns:
+        DataFrame with the CANOPY_COLUMNS columns.
+    '''
+    d_mean = bin_canopy_heights(
+        along_track=atl03Data.alongTrack,
+        height=atl03Data.zMsl,
+        signal_conf=atl03Data.signalConf,
+        lat=atl03Data.lat,
+        lon=atl03Data.lon,
+        along_track_res=along_track_res)
+
+    # Add beam, track and year columns
+    d_mean.insert(0, 'Beam Num_mean', float(atl03Data.beamNum))
+    d_mean['year'] = atl03Data.year
+    d_mean['track'] = atl03Data.gtNum
+    return d_mean[CANOPY_COLUMNS]
+
+
+def _canopy_heights_chunk(tasks, output_location, along_track_res,
+                          write_photon_csv, photon_file_format='csv'):
+    '''
+    Description:
+        Worker of iter_canopy_heights. Estimates canopy heights of a chunk of
+        (.h5 file, track) tasks, collecting errors per task.
+    Returns:
+        List of (.h5 file, track, DataFrame or None, error message or None).
+    '''
+    results = []
+    for files, track in tasks:
+        try:
+            atl03Data, _, _ = getAtlMeasuredSwath(
+                atl03FilePath=files,
+                outFilePath=output_location,
+                gtNum=track,
+                trimInfo='auto',
+                createAtl03CsvFile=write_photon_csv,
+                outFileFormat=photon_file_format)
+            # Beam not present in granule
+            if not atl03Data:
+                results.append((files, track, None, None))
+                continue
+            d_mean = estimate_canopy_heights(
+                atl03Data, along_track_res=along_track_res)
+            results.append((files, track, d_mean, None))
+        except Exception:
+            results.append((files, track, None, traceback.format_exc()))
+    return results
+
+
+def iter_canopy_heights(
+        tasks,
+        output_location,
+        along_track_res=10,
+        write_photon_csv=False,
+        n_workers=1,
+        chunk_size=1,
+        max_in_flight=None,
+        photon_file_format='csv'):
+    '''
+    Description:
+        Estimate canopy heights of (.h5 file, track) tasks, serially or on a
+        process pool. Tasks are submitted in chunks and at most max_in_flight
+        chunks are outstanding at once, which bounds the memory held by
+        finished but not yet consumed results. Results are yielded in task
+        order regardless of completion order.
+    Parameters:
+        tasks - List of (.h5 file, track) pairs.
+        output_location - Directory for optional photon .csv files.
+        along_track_res - Resolution at which to derive canopy heights (meters).
+        write_photon_csv - Also write the per-beam ATL03 photon files.
+        n_workers - Number of processes, 1 processes tasks serially.
+        chunk_size - Number of tasks submitted to a process at once.
+        max_in_flight - Maximum number of outstanding chunks, 2 * n_workers
+            by default.
+        photon_file_format - Format of the photon files, 'csv', 'parquet',
+            'feather' or 'npz'.
+    Yields:
+        (.h5 file, track, DataFrame or None, error message or None).
+    '''
+    chunk_size = max(1, int(chunk_size))
+    chunks = [tasks[i:i + chunk_size]
+              for i in range(0, len(tasks), chunk_size)]
+    chunk_args = (output_location, along_track_res, write_photon_csv,
+                  photon_file_format)
+
+    if n_workers is None or n_workers <= 1:
+        for chunk in chunks:
+            for result in _canopy_heights_chunk(chunk, *chunk_args):
+                yield result
+        return
+
+    if max_in_flight is None:
+        max_in_flight = 2 * n_workers
+    max_in_flight = max(1, int(max_in_flight))
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        pending = {}
+        next_submit = 0
+        for next_yield in range(len(chunks)):
+            # Keep the pool busy without exceeding max_in_flight chunks
+            while (next_submit < len(chunks) and
+                   next_submit - next_yield < max_in_flight):
+                pending[next_submit] = executor.submit(
+                    _canopy_heights_chunk, chunks[next_submit], *chunk_args)
+                next_submit += 1
+
+            # Wait for the next chunk in task order
+            future = pending.pop(next_yield)
+            try:
+                results = future.result()
+            except Exception:
+                error = traceback.format_exc()
+                results = [(files, track, None, error)
+                           for files, track in chunks[next_yield]]
+            for result in results:
+                yield result
+
+
+class CanopyHeightsWriter:
+    '''
+    Description:
+        Append-only sink for the merged canopy heights. Binned rows are
+        buffered until rows_per_chunk rows are collected and then appended to
+        a .csv file or written as a new part file of a Parquet dataset
+        directory, so only one chunk is held in memory. A progress file next
+        to the output records which sources (granule/beam pairs or .csv
+        files) have been flushed, allowing an interrupted run to resume.
+    Parameters:
+        path - Output .csv file or Parquet dataset directory.
+        output_format - 'csv' or 'parquet'.
+        rows_per_chunk - Number of rows buffered before they are written.
+        resume - Keep previously flushed output and skip its sources.
+    '''
+
+    def __init__(self, path, output_format='csv', rows_per_chunk=100000,
+                 resume=False):
+        if output_format not in ('csv', 'parquet'):
+            raise ValueError(
+                'output_format must be csv or parquet, not {}.'.format(
+                    output_format))
+        self.path = path
+        self.output_format = output_format
+        self.rows_per_chunk = rows_per_chunk
+        self.progress_path = path.rstrip('/\\') + '.progress'
+        self.completed = set()
+        self.n_rows = 0
+        self._buffer = []
+        self._buffer_rows = 0
+        self._buffer_sources = []
+        self._offset = 0
+        self._parts = []
+
+        if resume and os.path.exists(self.progress_path):
+            self._load_progress()
+        else:
+            self._reset()
+
+    def _reset(self):
+        # Start a new run, removing any previous output
+        if os.path.isdir(self.path):
+            for part in glob.glob(os.path.join(self.path, 'part-*.parquet')):
+                os.remove(part)
+        elif os.path.exists(self.path):
+            os.remove(self.path)
+        if os.path.exists(self.progress_path):
+            os.remove(self.progress_path)
+        if self.output_format == 'parquet':
+            Path(self.path).mkdir(parents=True, exist_ok=True)
+
+    def _load_progress(self):
+        # Replay flushed chunks and drop anything written after the last one
+        with open(self.progress_path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Partially written final record
+                    break
+                self.completed.update(tuple(src) for src in record['sources'])
+                self.n_rows += record['rows']
+                if self.output_format == 'csv':
+                    self._offset = record['offset']
+                else:
+                    self._parts.append(record['part'])
+        if self.output_format == 'csv':
+            if os.path.exists(self.path):
+                with open(self.path, 'r+b') as f:
+                    f.truncate(self._offset)
+        else:
+            Path(self.path).mkdir(parents=True, exist_ok=True)
+            for part in glob.glob(os.path.join(self.path, 'part-*.parquet')):
+                if os.path.basename(part) not in self._parts:
+                    os.remove(part)
+        print('Resuming run, {} source(s) and {} canopy heights already '
+              'written.'.format(len(self.completed), self.n_rows))
+
+    def write(self, source, d_mean=None):
+        '''
+        Description:
+            Add the binned rows of one source. Sources without rows (e.g.
+            beams not present in a granule) are recorded as completed too.
+        '''
+        if d_mean is not None and len(d_mean):
+            self._buffer.append(d_mean[CANOPY_COLUMNS])
+            self._buffer_rows += len(d_mean)
+        self._buffer_sources.append(tuple(source))
+        if self._buffer_rows >= self.rows_per_chunk:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer_sources:
+            return
+        record = {'sources': self._buffer_sources, 'rows': self._buffer_rows}
+        if self._buffer:
+            chunk = pd.concat(self._buffer, ignore_index=True)
+        else:
+            chunk = pd.DataFrame(columns=CANOPY_COLUMNS)
+
+        if self.output_format == 'csv':
+            write_header = self._offset == 0
+            if len(chunk) or write_header:
+                with open(self.path, 'a', newline='') as f:
+                    chunk.to_csv(f, sep=',', index=False, header=write_header)
+            self._offset = os.path.getsize(self.path)
+            record['offset'] = self._offset
+        else:
+            part = 'part-{:05d}.parquet'.format(len(self._parts))
+            chunk['year'] = chunk['year'].astype(str)
+            chunk['track'] = chunk['track'].astype(str)
+            pq.write_table(pa.Table.from_pandas(chunk, preserve_index=False),
+                           os.path.join(self.path, part))
+            self._parts.append(part)
+            record['part'] = part
+
+        # Record progress only once the chunk is on disk
+        with open(self.progress_path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+        self.completed.update(self._buffer_sources)
+        self.n_rows += self._buffer_rows
+        self._buffer = []
+        self._buffer_rows = 0
+        self._buffer_sources = []
+
+    def close(self):
+        self.flush()
+
+
 def get_canopy_heights(
         download=False,
         data_type='ATL03',
@@ -84,6 +441,7 @@ def get_canopy_heights(
     email=False,
     working_directory=False,
     generate_csv=True,
+    write_photon_csv=False,
     track_num=[
             'gt1l',
             'gt2l',
@@ -93,7 +451,13 @@ def get_canopy_heights(
             'gt3r'],
         along_track_res=10,
         autocorrelation=False,
-        autocorrelation_dist=250):
+        autocorrelation_dist=250,
+        n_workers=1,
+        chunk_size=1,
+        max_in_flight=None,
+        output_format='csv',
+        resume=False,
+        photon_file_format='csv'):
     '''
     Description:
         get_canopy_heights is a tool that allows users to query, download
@@ -108,17 +472,30 @@ def get_canopy_heights(
         username - NASA EarthData username.
         email - NASA EarthData email.
         working_directory - Location for file storage.
-        generate_csv - Process .h5 files with PhoREAL tool.
+        generate_csv - Process .h5 files with PhoREAL tool. If False, canopy
+            heights are estimated from existing photon files.
+        write_photon_csv - Also write the per-beam ATL03 photon files while
+            processing .h5 files.
         track_num - Select which ATL03 tracks to derive canopy heights from,
             all by default.
         along_track_res - Resolution at which to derive canopy heights (meters).
         autocorrelation - Remove points located within a buffer of other points.
         autocorrelation_dist - Remove data within x meters of each other.
+        n_workers - Number of processes used to process granule/beam pairs,
+            1 processes them serially.
+        chunk_size - Number of granule/beam pairs submitted to a process at
+            once.
+        max_in_flight - Maximum number of submitted chunks whose results are
+            not yet merged, 2 * n_workers by default.
+        output_format - Write canopy heights as a .csv file ('csv') or as a
+            Parquet dataset directory ('parquet').
+        resume - Resume a previously interrupted run, skipping the granules
+            and beams already written.
+        photon_file_format - Format of the per-beam photon files, 'csv' or
+            the typed columnar 'parquet', 'feather' or 'npz'.
 
     TODO: Spatial autocorrelation?.
     TODO: Handle duplicate rows appropriately.
-    TODO: Append dataframes to csv to handle memory?
-        Sundarban 2019-01-01 to 2019-07-31, 117 csv files takes 15:48 to process.
     TODO: Improve canopy detection.
         Only select 95 percentile for canopy?
         DRAGANN Method?
@@ -154,160 +531,100 @@ def get_canopy_heights(
         output_location = working_directory + 'csv/'
         Path(output_location).mkdir(parents=True, exist_ok=True)
 
-        # Process .h5 files with PhoREAL tool to derive stats
-        if generate_csv:
-            # Locate available .h5 files for processing
-            atl03Files = glob.glob(os.path.join(h5_storage, f'*.h5'))
-            # Print file names
-            print('Located {} {} file(s).'.format(len(atl03Files), data_type))
-            for files in tqdm_notebook(atl03Files):
-                for track in track_num:
-                    while True:
-                        try:
-                            getAtlMeasuredSwath(
-                                atl03FilePath=files,
-                                outFilePath=output_location,
-                                gtNum=track,
-                                trimInfo='auto',
-                                createAtl03CsvFile=True)
-                            break
-                        except ValueError:
-                            break
-            print('Completed converting to .csv.')
-        else:
-            print('Not generating .csv files from .h5 files.')
-            pass
-
-        # Locate available csv files for analysis
-        csvFiles = glob.glob(os.path.join(output_location, f'*.csv'))
-        print(
-            'Located {} .csv file(s) for canopy heights estimation.'.format(
-                len(csvFiles)))
-
         # Confirm along-track resolution
         print('Canopy heights will be generated at a resolution of {} meters along-track.'.format(along_track_res))
 
-        # Create empty 'merged' dataframe to concat other dataframes to
-        merged_df = pd.read_csv(csvFiles[0], nrows=0)
+        # Create storage directory for derived heights if necessary
+        csvPath = output_location + '/canopy_estimates/'
+        Path(csvPath).mkdir(parents=True, exist_ok=True)
 
-        # Estimate ground and canopy returns from raw ATL03 data
-        for csvs in tqdm_notebook(csvFiles):
+        # Stream binned canopy estimates of every granule/beam to disk
+        if output_format == 'parquet':
+            merged_path = csvPath + 'canopy_merged.parquet'
+        else:
+            merged_path = csvPath + 'canopy_merged.csv'
+        writer = CanopyHeightsWriter(
+            merged_path, output_format=output_format, resume=resume)
 
-            # Obtain .h5 file name
-            #print('Processing: {}.'.format(csvs))
+        # Process .h5 files with PhoREAL tool to derive stats
+        if generate_csv:
+            # Locate available .h5 files for processing
+            atl03Files = sorted(glob.glob(os.path.join(h5_storage, f'*.h5')))
+            # Print file names
+            print('Located {} {} file(s).'.format(len(atl03Files), data_type))
 
-            # Load CSV file into dataframe
-            df = pd.read_csv(csvs)
+            # Every granule/beam pair is an independent task
+            tasks = [(files, track) for files in atl03Files
+                     for track in track_num
+                     if (files, track) not in writer.completed]
+            errors = []
+            progress = tqdm_notebook(total=len(tasks))
+            for files, track, d_mean, error in iter_canopy_heights(
+                    tasks,
+                    output_location=output_location,
+                    along_track_res=along_track_res,
+                    write_photon_csv=write_photon_csv,
+                    n_workers=n_workers,
+                    chunk_size=chunk_size,
+                    max_in_flight=max_in_flight,
+                    photon_file_format=photon_file_format):
+                progress.update(1)
+                if error:
+                    errors.append((files, track, error))
+                else:
+                    writer.write((files, track), d_mean)
+            progress.close()
+
+            # Report failed granule/beam pairs
+            if errors:
+                print('{} granule/beam pair(s) failed:'.format(len(errors)))
+                for files, track, error in errors:
+                    print('{} {}:\n{}'.format(files, track, error))
+            print('Completed canopy height estimation of .h5 files.')
+        else:
+            print('Not processing .h5 files, using existing photon files.')
 
-            # Sort out erroneous datasets by locating dataframes with 'NaN'
-            # values.
-            while True:
+            # Locate available photon files for analysis
+            csvFiles = sorted(
+                f for ext in PHOTON_FILE_EXTENSIONS
+                for f in glob.glob(os.path.join(output_location, '*' + ext)))
+            print(
+                'Located {} photon file(s) for canopy heights estimation.'.format(
+                    len(csvFiles)))
+
+            # Estimate ground and canopy returns from raw ATL03 data
+            for csvs in tqdm_notebook(csvFiles):
+                if (csvs, '') in writer.completed:
+                    continue
+                if csvs.endswith('.csv'):
+                    df = pd.read_csv(csvs, usecols=PHOTON_CSV_COLUMNS)
+                else:
+                    df = readColumnarFile(csvs, columns=PHOTON_CSV_COLUMNS)
                 try:
-                    nbins = int(((df['Along-Track (m)'].max()) - \
-                                (df['Along-Track (m)'].min())) / along_track_res)
-
-                    # Filter to med. & high signal confidence for ground
-                    # estimates
-                    df_medhigh = df[df['Signal Confidence'] > 2]
-
-                    # Calculate # of bins required for given resolution
-                    nbins = int(((df_medhigh['Along-Track (m)'].max()) - (
-                        df_medhigh['Along-Track (m)'].min())) / along_track_res)
-
-                    # Sort dataframe in ascending order based on bins
-                    df_medhigh.sort_values('Along-Track (m)', inplace=True)
-
-                    # Create binned dataframe
-                    df_ground = df_medhigh.copy()
-                    df_ground['bin'] = pd.cut(df_medhigh['Along-Track (m)'],
-                                              bins=nbins, include_lowest=True)
-
-                    # Located lowest elevation of each bin to define as the
-                    # 'ground'
-                    df_ground['ground_est'] = df_ground.groupby(
-                        'bin')['Height (m MSL)'].transform('min')
-                    #print('Ground returns estimated for {}.'.format(csvs))
-
-                    # Filter data to x classes for canopy estimations
-                    df_canopy = df[df['Signal Confidence'] > 0]
-
-                    # Create binned canopy dataframe
-                    df_canopy['canopy_bin'] = pd.cut(
-                        df_canopy['Along-Track (m)'], bins=nbins, include_lowest=True)
-
-                    # Locate and define 95 Percentile return height for each
-                    # bin
-                    df_canopy['toc_est'] = df_canopy.groupby(
-                        'canopy_bin')['Height (m MSL)'].transform('max')
-                    df_canopy['toc_est'] = df_canopy['toc_est'].mul(0.95)
-
-                    # Remove rows with no canopy height estimations
-                    df_canopy = df_canopy.dropna(subset=['toc_est'])
-
-                    # Remove canopy estimates that fall below ground level
-                    df_canopy['elev_bin'] = pd.cut(
-                        df_canopy['Along-Track (m)'], bins=nbins, include_lowest=True)
-
-                    df_canopy['ground_est'] = df_canopy.groupby(
-                        'elev_bin')['Height (m MSL)'].transform('min')
-
-                    # Aggregate columns by bin and mean value
-                    d_mean = df_canopy.groupby('canopy_bin').agg(['mean'])
-                    # Flatten columns
-                    d_mean.columns = d_mean.columns.map('_'.join)
-                    # Revert back to proper dataframe
-                    d_mean.reset_index()
-
-                    # Calculate height of canopy above ground
-                    d_mean['canopy_height_est'] = (d_mean['toc_est_mean'] -
-                                                   d_mean['ground_est_mean'])
-                    #print('Canopy returns estimated for {}.'.format(csvs))
-
-                    # Remove rows with no coordinates
-                    d_mean.dropna(
-                        subset=['Longitude (deg)_mean'], inplace=True)
-
-                    # Add track and year columns
-                    year = csvs[-39:-35]
-                    trackID = csvs[-8:-4]
-                    d_mean['year'] = year
-                    d_mean['track'] = trackID
-
-                    # Concat final dataframe to merged set
-                    merged_df = pd.concat([merged_df, d_mean])
-                    print(
-                        '{} canopy heights calculated...'.format(
-                            len(merged_df)))
-                    break
-
+                    d_mean = bin_canopy_heights(
+                        along_track=df['Along-Track (m)'].values,
+                        height=df['Height (m MSL)'].values,
+                        signal_conf=df['Signal Confidence'].values,
+                        lat=df['Latitude (deg)'].values,
+                        lon=df['Longitude (deg)'].values,
+                        along_track_res=along_track_res)
                 except ValueError:
                     print('Erroneous data, skipping.')
-                    break
-
-        # Plot overview of created data
-        # print(merged_df.head())
-        #plot_overview(data=merged_df, resolution=along_track_res, save_path=output_location)
-
-        # Drop empty/unnecessary columns
-        merged_df.drop(merged_df.iloc[:, 0:22], axis=1, inplace=True)
-        merged_df.drop(merged_df.iloc[:, 3:15], axis=1, inplace=True)
-
-        # Rename Lat & Lon columns for GEE asset ingestion
-        merged_df.rename(
-            columns={
-                'Latitude (deg)_mean': 'latitude',
-                'Longitude (deg)_mean': 'longitude'},
-            inplace=True)
-
-        # Create storage directory for derived heights if necessary
-        csvPath = output_location + '/canopy_estimates/'
-        Path(csvPath).mkdir(parents=True, exist_ok=True)
-
-        # Drop duplicate rows
-        merged_df.drop_duplicates()
-
-        # Save merged dataframe as csv
-        merged_df.to_csv(csvPath + 'canopy_merged.csv', sep=',', index=False)
+                    writer.write((csvs, ''))
+                    continue
+
+                # Add beam, track and year columns
+                beam_num = pd.to_numeric(
+                    df['Beam Num'].astype(object), errors='coerce')
+                d_mean.insert(0, 'Beam Num_mean', beam_num.mean())
+                file_name = os.path.splitext(csvs)[0]
+                d_mean['year'] = file_name[-35:-31]
+                d_mean['track'] = file_name[-4:]
+                writer.write((csvs, ''), d_mean[CANOPY_COLUMNS])
+
+        # Write remaining buffered rows
+        writer.close()
+        print('{} canopy heights calculated...'.format(writer.n_rows))
         print('Derived and saved merged canopy heights.')
 
         '''WORK IN PROGRESS'''